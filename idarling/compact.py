@@ -0,0 +1,101 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import os
+import sys
+import time
+
+from .shared.storage import Storage, train_dictionary
+
+
+def database_size(path):
+    """Get the size of a database, including its write-ahead log."""
+    size = os.path.getsize(path)
+    if os.path.isfile(path + "-wal"):
+        size += os.path.getsize(path + "-wal")
+    return size
+
+
+def compact(args):
+    """
+    Compress the events already stored in the database of a server, which
+    must not be running. The dictionary is trained on the stored events.
+    """
+    if not os.path.isfile(args.database):
+        print("No database found at %s" % args.database)
+        return 1
+    size = database_size(args.database)
+    start = time.perf_counter()
+
+    storage = Storage(args.database)
+    storage.initialize()
+    count = storage.normalize()
+    if count is not None:
+        print("Keyed %d events by snapshot id" % count)
+
+    if not args.decompress:
+        payloads = storage.sample_payloads(args.samples)
+        if payloads:
+            dictionary = train_dictionary(payloads, args.dictionary_size)
+            dictionary_id = storage.insert_dictionary(dictionary)
+            print(
+                "Trained dictionary %d (%d bytes) on %d events"
+                % (dictionary_id, len(dictionary), len(payloads))
+            )
+    count = storage.compress_events(args.decompress)
+    storage.vacuum()
+
+    print(
+        "%s %d events in %.1fs, database size %d -> %d bytes"
+        % (
+            "Decompressed" if args.decompress else "Compressed",
+            count,
+            time.perf_counter() - start,
+            size,
+            database_size(args.database),
+        )
+    )
+    return 0
+
+
+def main():
+    files_dir = os.path.join(os.path.dirname(__file__), "files")
+    parser = argparse.ArgumentParser(
+        description="Compress the events stored by a stopped IDArling server"
+    )
+    parser.add_argument(
+        "-d",
+        "--database",
+        type=str,
+        default=os.path.join(files_dir, "database.db"),
+        help="the database of the server",
+    )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=Storage.DICTIONARY_SAMPLES * 4,
+        help="the number of events to train the dictionary on",
+    )
+    parser.add_argument(
+        "--dictionary-size",
+        type=int,
+        default=Storage.DICTIONARY_SIZE,
+        help="the size of the dictionary",
+    )
+    # Needed to go back to a version storing them uncompressed
+    parser.add_argument(
+        "--decompress",
+        action="store_true",
+        help="store the events uncompressed instead",
+    )
+    sys.exit(compact(parser.parse_args()))
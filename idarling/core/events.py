@@ -35,7 +35,12 @@ import ida_idc
 import ida_offset
 import idc
 
-from ..shared.local_types import GetTypeString, LocalType, InsertType
+from ..shared.local_types import (
+    GetTypeString,
+    InsertType,
+    LocalType,
+    UnpackTypeList,
+)
 from ..shared.packets import DefaultEvent
 
 if sys.version_info > (3,):
@@ -287,7 +292,7 @@ class TiChangedEvent(Event):
         self.py_type = []
         self.name = name
         if py_type:
-            self.py_type.extend(Event.decode_bytes(t) for t in py_type)
+            self.py_type.extend(py_type)
 
     def __call__(self):
         py_type = [Event.encode_bytes(t) for t in self.py_type]
@@ -300,7 +305,7 @@ class TiChangedEvent(Event):
                     self.ea = r[0].id
             ida_typeinf.apply_type(
                 None,
-                GetTypeString(py_type[0]),
+                GetTypeString(UnpackTypeList(py_type[0])),
                 py_type[1],
                 self.ea,
                 ida_typeinf.TINFO_DEFINITE,
@@ -318,7 +323,11 @@ class LocalTypesChangedEvent(Event):
         for t_old, t_new in self.local_types:
             if t_new:
                 name, parsed_list, type_fields = t_new
-                t_new = LocalType(name=name,parsedList=parsed_list,TypeFields=type_fields.encode())
+                t_new = LocalType(
+                    name=name,
+                    parsedList=UnpackTypeList(parsed_list),
+                    TypeFields=Event.encode(type_fields),
+                )
                 InsertType(t_new,fReplace=True)
         ida_kernwin.request_refresh(ida_kernwin.IWID_LOCTYPS)
         # XXX - old code below to delete?
@@ -1104,10 +1113,16 @@ class UserLvarSettingsEvent(HexRaysEvent):
     @staticmethod
     def _get_tinfo(dct):
         type, fields, fldcmts, parsed_list = dct
-        # type = Event.encode_bytes(type)
         fields = Event.encode_bytes(fields)
         fldcmts = Event.encode_bytes(fldcmts)
-        type = None if parsed_list is None else GetTypeString(pickle.loads(Event.encode_bytes(parsed_list)))
+        if parsed_list is None:
+            type = None
+        elif isinstance(parsed_list, list):
+            type = GetTypeString(UnpackTypeList(parsed_list))
+        else:
+            # Events stored by older versions contain a pickled list
+            parsed_list = pickle.loads(Event.encode_bytes(parsed_list))
+            type = GetTypeString(parsed_list)
         type_ = ida_typeinf.tinfo_t()
         if type is not None:
             type_.deserialize(None, type, fields, fldcmts)
@@ -11,7 +11,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 # import ctypes
-import pickle
 
 import ida_auto
 import ida_bytes
@@ -36,7 +35,11 @@ sys.setrecursionlimit(10000)
 
 from . import events as evt  # noqa: I100,I202
 from .events import Event  # noqa: I201
-from ..shared.local_types import ParseTypeString, ImportLocalType
+from ..shared.local_types import (
+    ImportLocalType,
+    PackTypeList,
+    ParseTypeString,
+)
 
 
 class Hooks(object):
@@ -173,7 +176,8 @@ class IDBHooks(Hooks, ida_idp.IDB_Hooks):
         if ida_struct.is_member_id(ea):
             name = ida_struct.get_struc_name(ea)
         type = ida_typeinf.idc_get_type_raw(ea)
-        self._send_packet(evt.TiChangedEvent(ea, (ParseTypeString(type[0]) if type else [], type[1] if type else None), name))
+        py_type = (PackTypeList(ParseTypeString(type[0])), type[1]) if type else ([], None)
+        self._send_packet(evt.TiChangedEvent(ea, py_type, name))
         return 0
 
     def op_ti_changed(self, ea, n, type, fnames):
@@ -786,11 +790,7 @@ class HexRaysHooks(Hooks):
             return None, None, None, None
 
         type, fields, fldcmts = type.serialize()
-        fields = Event.decode_bytes(fields)
-        fldcmts = Event.decode_bytes(fldcmts)
-        parsed_list = Event.decode_bytes(pickle.dumps(ParseTypeString(type)))
-        type = Event.decode_bytes(type)
-        return type, fields, fldcmts, parsed_list
+        return type, fields, fldcmts, PackTypeList(ParseTypeString(type))
 
     @staticmethod
     def _get_lvar_locator(ll):
@@ -15,7 +15,6 @@ from functools import partial
 import os
 import shutil
 import tempfile
-import bz2
 
 import ida_auto
 import ida_idaapi
@@ -27,7 +26,6 @@ from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QMessageBox, QProgressDialog
 
 from .dialogs import OpenDialog, SaveDialog
-from ..shared.commands import DownloadFile, UpdateFile
 
 
 class Action(object):
@@ -125,9 +123,23 @@ class ActionHandler(ida_kernwin.action_handler_t):
     @staticmethod
     def _on_progress(progress, count, total):
         """Called when some progress has been made."""
+        if not progress.isVisible():
+            progress.show()  # The transfer has been resumed
         progress.setRange(0, total)
         progress.setValue(count)
 
+    @staticmethod
+    def _on_interrupted(plugin, progress):
+        """Called when the connection was lost during a transfer."""
+        progress.hide()
+        plugin.logger.info("Transfer interrupted, will resume on reconnection")
+
+    @staticmethod
+    def _on_error(plugin, progress, error):
+        """Called when the transfer failed, e.g. the query timed out."""
+        progress.close()
+        plugin.logger.exception(error)
+
     def __init__(self, plugin):
         super(ActionHandler, self).__init__()
         self._plugin = plugin
@@ -187,23 +199,6 @@ class OpenActionHandler(ActionHandler):
         icon_path = self._plugin.plugin_resource("download.png")
         progress.setWindowIcon(QIcon(icon_path))
 
-        # Send a packet to download the file
-        packet = DownloadFile.Query(project.name, binary.name, snapshot.name)
-        callback = partial(self._on_progress, progress)
-
-        def set_download_callback(reply):
-            reply.downback = callback
-
-        d = self._plugin.network.send_packet(packet)
-        d.add_initback(set_download_callback)
-        d.add_callback(partial(self._file_downloaded, project, snapshot, progress))
-        d.add_errback(self._plugin.logger.exception)
-        progress.show()
-
-    def _file_downloaded(self, project, snapshot, progress, reply):
-        """Called when the file has been downloaded."""
-        progress.close()
-
         # Get the absolute path of the file
         app_path = QCoreApplication.applicationFilePath()
         app_name = QFileInfo(app_path).fileName()
@@ -211,11 +206,25 @@ class OpenActionHandler(ActionHandler):
         file_name = "%s_%s_%s.%s" % (project.name, snapshot.binary, snapshot.name, file_ext)
         file_path = os.path.join(self._plugin.config["files_dir"], file_name)
 
-        # Write the file to disk
-        decompressed_content = bz2.decompress(reply.content)
-        with open(file_path, "wb") as output_file:
-            output_file.write(decompressed_content)
-        self._plugin.logger.info("Saved file %s" % file_name)
+        # Download the file in chunks, directly to disk
+        transfer = self._plugin.network.download(
+            project.name, binary.name, snapshot.name, file_path
+        )
+        transfer.progress = partial(self._on_progress, progress)
+        transfer.interrupted = partial(
+            self._on_interrupted, self._plugin, progress
+        )
+        d = transfer.deferred
+        d.add_callback(partial(self._file_downloaded, file_path, progress))
+        d.add_errback(partial(self._on_error, self._plugin, progress))
+        progress.show()
+
+    def _file_downloaded(self, file_path, progress, _):
+        """Called when the file has been downloaded."""
+        progress.close()
+        app_path = QCoreApplication.applicationFilePath()
+        app_name = QFileInfo(app_path).fileName()
+        self._plugin.logger.info("Saved file %s" % file_path)
 
         # Save the old database
         database = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
@@ -296,17 +305,13 @@ class SaveActionHandler(ActionHandler):
     _DIALOG = SaveDialog
 
     @staticmethod
-    def upload_file(plugin, packet):
+    def upload_file(plugin, project, binary, snapshot, notify=True):
         # Save the current database with a tick=0 since it is a new snapshot
         plugin.core.tick = 0
         plugin.core.save_netnode()
         input_path = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
         ida_loader.save_database(input_path, 0)
 
-        with open(input_path, "rb") as input_file:
-            uncompressed_content = input_file.read()
-        packet.content = bz2.compress(uncompressed_content)
-
         # Create the upload progress dialog
         text = "Uploading database to server, please wait..."
         progress = QProgressDialog(text, "Cancel", 0, 1)
@@ -318,19 +323,24 @@ class SaveActionHandler(ActionHandler):
         icon_path = plugin.plugin_resource("upload.png")
         progress.setWindowIcon(QIcon(icon_path))
 
-        # Send the packet to upload the file
-        packet.upback = partial(SaveActionHandler._on_progress, progress)
-        d = plugin.network.send_packet(packet)
-        if d:
-            d.add_callback(
-                partial(SaveActionHandler.file_uploaded, plugin, progress)
-            )
-            d.add_errback(plugin.logger.exception)
+        # Upload the file in chunks, compressed on the fly
+        transfer = plugin.network.upload(project, binary, snapshot, input_path)
+        transfer.progress = partial(SaveActionHandler._on_progress, progress)
+        transfer.interrupted = partial(
+            SaveActionHandler._on_interrupted, plugin, progress
+        )
+        d = transfer.deferred
+        d.add_callback(
+            partial(SaveActionHandler.file_uploaded, plugin, progress, notify)
+        )
+        d.add_errback(partial(SaveActionHandler._on_error, plugin, progress))
         progress.show()
 
     @staticmethod
-    def file_uploaded(plugin, progress, _):
+    def file_uploaded(plugin, progress, notify, _):
         progress.close()
+        if not notify:
+            return  # Requested by the server, don't bother the user
 
         # Show a success dialog
         success = QMessageBox()
@@ -358,6 +368,7 @@ class SaveActionHandler(ActionHandler):
         self._plugin.core.binary = binary.name
         self._plugin.core.snapshot = snapshot.name
 
-        # Create the packet that will hold the file
-        packet = UpdateFile.Query(project.name, binary.name, snapshot.name)
-        SaveActionHandler.upload_file(self._plugin, packet)
+        # Upload the file to the server
+        SaveActionHandler.upload_file(
+            self._plugin, project.name, binary.name, snapshot.name
+        )
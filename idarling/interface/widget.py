@@ -115,6 +115,9 @@ class StatusWidget(QWidget):
         # Get the corresponding color, text and icon
         if self._plugin.network.connected:
             color, text, icon = "green", "Connected", "connected.png"
+            catch_up = self._plugin.network.client.catch_up
+            if catch_up:
+                text = "Catching up, %d events left" % (catch_up[1] - catch_up[0])
         elif self._plugin.network.client:
             color, text, icon = "orange", "Connecting", "connecting.png"
         else:
@@ -17,6 +17,7 @@ from PyQt5.QtGui import QImage, QPixmap  # noqa: I202
 
 from ..interface.widget import StatusWidget
 from ..shared.commands import (
+    CatchUpProgress,
     DownloadFile,
     InviteToLocation,
     JoinSession,
@@ -30,6 +31,7 @@ from ..shared.commands import (
 )
 from ..shared.packets import Command, Event
 from ..shared.sockets import ClientSocket
+from ..shared.transfers import checksum
 
 
 class Client(ClientSocket):
@@ -42,6 +44,7 @@ class Client(ClientSocket):
         ClientSocket.__init__(self, plugin.logger, parent)
         self._plugin = plugin
         self._events = []
+        self._catch_up = None
 
         # Setup command handlers
         self._handlers = {
@@ -55,8 +58,14 @@ class Client(ClientSocket):
             DeleteProject: self._handle_delete_project,
             DeleteBinary: self._handle_delete_binary,
             DeleteSnapshot: self._handle_delete_snapshot,
+            CatchUpProgress: self._handle_catch_up_progress,
         }
 
+    @property
+    def catch_up(self):
+        """Get the (tick, last_tick) of the catch-up in progress, if any."""
+        return self._catch_up
+
     def call_events(self):
         while self._events and ida_auto.get_auto_state() == ida_auto.AU_NONE:
             packet = self._events.pop(0)
@@ -100,6 +109,9 @@ class Client(ClientSocket):
         if isinstance(packet, Event):
             self._plugin.core.tick += 1
             packet.tick = self._plugin.core.tick
+        # The catch-up of the previous session, if any, is abandoned
+        if isinstance(packet, (JoinSession, LeaveSession)):
+            self._catch_up = None
         return ClientSocket.send_packet(self, packet)
 
     def disconnect(self, err=None):
@@ -122,6 +134,12 @@ class Client(ClientSocket):
             self._plugin.core.join_session()
         return ret
 
+    def _finish_handshake(self):
+        ClientSocket._finish_handshake(self)
+        # Resume the interrupted file transfers, now that we know whether
+        # the server supports them
+        self._plugin.network.resume_transfers()
+
     def _handle_join_session(self, packet):
         # Update the users list
         user = {"color": packet.color, "ea": packet.ea}
@@ -181,11 +199,26 @@ class Client(ClientSocket):
             ida_kernwin.jumpto(packet.ea)
 
     def _handle_download_file(self, query):
+        # Acknowledge the request, the snapshot is sent as a normal upload
+        reply = DownloadFile.Reply(
+            query, 0, checksum(b""), True, None, 0, 0, "none"
+        )
+        reply.content = b""
+        self.send_packet(reply)
+
         # Upload the current snapshot
         self._plugin.interface.save_action.handler.upload_file(
-            self._plugin, DownloadFile.Reply(query)
+            self._plugin, query.project, query.binary, query.snapshot, False
         )
 
+    def _handle_catch_up_progress(self, packet):
+        if packet.tick >= packet.last_tick:
+            self._catch_up = None
+        else:
+            self._catch_up = (packet.tick, packet.last_tick)
+        # Show the events left in the status bar
+        self._plugin.interface.widget.refresh()
+
     def _handle_delete_project(self, packet):
         # TODO: Handle situation then user snapshot in deleted project
         self.disconnect()
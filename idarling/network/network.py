@@ -19,6 +19,7 @@ from .client import Client
 from .server import IntegratedServer
 from ..module import Module
 from ..shared.discovery import ServersDiscovery
+from ..shared.transfers import DeltaDownload, DeltaUpload, Download, Upload
 
 fDebug = False
 if fDebug:
@@ -39,6 +40,8 @@ class Network(Module):
         self._client = None
         self._server = None
         self._integrated = None
+        # The file transfers not finished yet
+        self._transfers = []
 
     @property
     def client(self):
@@ -108,6 +111,24 @@ class Network(Module):
         idle = self._plugin.config["keep"]["idle"]
         self._client.set_keep_alive(cnt, intvl, idle)
 
+        # Set the socket options, before connecting for the buffer sizes
+        socket_config = self._plugin.config["socket"]
+        self._client.set_socket_options(
+            socket_config["rcvbuf"],
+            socket_config["sndbuf"],
+            socket_config["nodelay"],
+        )
+        self._client.set_read_budget(
+            socket_config["read_time"], socket_config["read_size"]
+        )
+        self._client.set_watermarks(
+            socket_config["high_watermark"], socket_config["low_watermark"]
+        )
+        self._client.set_query_limits(
+            socket_config["query_timeout"], socket_config["max_in_flight"]
+        )
+        self._client.set_handshake_timeout(socket_config["handshake_timeout"])
+
         # Connect the socket
         sock.settimeout(0)  # No timeout
         sock.setblocking(0)  # No blocking
@@ -134,6 +155,45 @@ class Network(Module):
             return self._client.send_packet(packet)
         return None
 
+    def upload(self, project, binary, snapshot, file_path):
+        """Start uploading a database to the server."""
+        # Only send the chunks the server doesn't have, if it supports it
+        cls = DeltaUpload if self.connected and self._client.delta else Upload
+        return self._start_transfer(cls, project, binary, snapshot, file_path)
+
+    def download(self, project, binary, snapshot, file_path):
+        """Start downloading a database from the server."""
+        # Only get the chunks missing from an older copy, if we have one
+        cls = Download
+        if self.connected and self._client.delta and os.path.isfile(file_path):
+            cls = DeltaDownload
+        return self._start_transfer(cls, project, binary, snapshot, file_path)
+
+    def _start_transfer(self, cls, project, binary, snapshot, file_path):
+        # The transfers are spooled in the plugin's directory
+        spool_dir = self._plugin.user_resource("files", "")
+        transfer = cls(self, project, binary, snapshot, file_path, spool_dir)
+        self._transfers.append(transfer)
+        # Otherwise it will be resumed once the handshake is over
+        if self.connected and not self._client.handshaking:
+            if transfer.check():
+                transfer.start()
+        return transfer
+
+    def resume_transfers(self):
+        """
+        Resume the file transfers interrupted by a disconnection, once the
+        protocol features have been agreed upon with the server.
+        """
+        for transfer in list(self._transfers):
+            if transfer.check():
+                transfer.resume()
+
+    def transfer_finished(self, transfer):
+        """Called by a transfer when it has completed or failed."""
+        if transfer in self._transfers:
+            self._transfers.remove(transfer)
+
     def start_server(self):
         """Start the integrated server."""
         if self._integrated:
@@ -23,6 +23,7 @@ import ida_kernwin
 from .core.core import Core
 from .interface.interface import Interface
 from .network.network import Network
+from .shared.sockets import ClientSocket
 from .shared.utils import start_logging
 
 
@@ -92,6 +93,7 @@ class Plugin(ida_idaapi.plugin_t):
             "level": logging.INFO,
             "servers": [],
             "keep": {"cnt": 4, "intvl": 15, "idle": 240},
+            "socket": ClientSocket.default_config(),
             "cursors": {"navbar": True, "funcs": True, "disasm": True},
             "user": {"color": color, "name": "unnamed", "notifications": True},
             "files_dir": file_path,
@@ -231,6 +233,10 @@ class Plugin(ida_idaapi.plugin_t):
                 self._config["servers"][count]["auto_connect"] = False
             count += 1
 
+        socket_config = ClientSocket.default_config()
+        socket_config.update(self._config["socket"])
+        self._config["socket"] = socket_config
+
         self.save_config()
 
     def save_config(self):
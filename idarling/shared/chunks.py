@@ -0,0 +1,344 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import copy
+import hashlib
+import os
+import random
+import re
+import struct
+import zlib
+
+# The bounds of the size of the chunks
+CHUNK_MIN = 16 * 1024
+CHUNK_MAX = 256 * 1024
+# The entries of the manifests: the digest and the size of each chunk
+DIGEST_SIZE = hashlib.sha256().digest_size
+ENTRY = struct.Struct("!%dsI" % DIGEST_SIZE)
+
+
+def _anchor_pattern(seed=0x1DA, width=3, count=7):
+    """
+    Build the pattern marking the end of a chunk: a sequence of bytes each
+    belonging to a set of bytes picked at random. On random data, it occurs
+    every 256 ** width / count ** width bytes, 48 KB on average. As it only
+    depends on the bytes at that position, the chunk boundaries are the same
+    wherever the data is moved to: this is content-defined chunking, with
+    the search itself being done by the regular expression engine.
+    """
+    rand = random.Random(seed)
+    # Avoid the bytes of the runs of padding found in most files
+    candidates = list(range(1, 255))
+    pattern = b""
+    for _ in range(width):
+        chars = rand.sample(candidates, count)
+        pattern += b"[" + b"".join(b"\\x%02x" % c for c in chars) + b"]"
+    return re.compile(pattern)
+
+
+ANCHOR = _anchor_pattern()
+
+
+def chunk_stream(blocks):
+    """Split a stream of blocks of data into content-defined chunks."""
+    buf = bytearray()
+    for block in blocks:
+        buf += block
+        start = 0
+        while True:
+            # A chunk is cut after an anchor, and at most CHUNK_MAX bytes
+            end = min(len(buf), start + CHUNK_MAX)
+            match = ANCHOR.search(buf, start + CHUNK_MIN - 1, end)
+            if match:
+                cut = match.end()
+            elif end - start == CHUNK_MAX:
+                cut = end
+            else:
+                break  # Wait for more data
+            yield bytes(buf[start:cut])
+            start = cut
+        del buf[:start]
+
+    # Whatever remains is too small to contain an anchor
+    while buf:
+        yield bytes(buf[:CHUNK_MAX])
+        del buf[:CHUNK_MAX]
+
+
+def read_manifest(manifest):
+    """Get the digests and sizes of the chunks listed in a manifest."""
+    return list(ENTRY.iter_unpack(manifest))
+
+
+def manifest_digest(manifest):
+    """
+    Get the digest identifying the file described by a manifest. The digests
+    of the chunks being checked when they are stored, it can be trusted.
+    """
+    return hashlib.sha256(manifest).hexdigest()
+
+
+def index_file(file_path):
+    """
+    Split a file into chunks. Return its manifest, and the offset of each
+    of the chunks in the file indexed by digest.
+    """
+    manifest = bytearray()
+    offsets = {}
+    offset = 0
+    with open(file_path, "rb") as input_file:
+        blocks = iter(lambda: input_file.read(CHUNK_MAX), b"")
+        for chunk in chunk_stream(blocks):
+            digest = hashlib.sha256(chunk).digest()
+            manifest += ENTRY.pack(digest, len(chunk))
+            offsets.setdefault(digest, offset)
+            offset += len(chunk)
+    return bytes(manifest), offsets
+
+
+class ChunkReader(object):
+    """A file-like object reading a file from the chunks of its manifest."""
+
+    def __init__(self, store, manifest):
+        self._store = store
+        self._digests = collections.deque(
+            digest for digest, _ in read_manifest(manifest)
+        )
+        self._buffer = b""
+        self._offset = 0
+
+    def read(self, size):
+        while len(self._buffer) - self._offset < size and self._digests:
+            chunk = self._store.read_chunk(self._digests.popleft().hex())
+            self._buffer = self._buffer[self._offset :] + chunk  # noqa: E203
+            self._offset = 0
+        data = self._buffer[self._offset : self._offset + size]  # noqa: E203
+        self._offset += len(data)
+        return data
+
+    def close(self):
+        self._digests.clear()
+        self._buffer = b""
+
+
+class ChunkStore(object):
+    """
+    A content-addressed store for the databases. The files are split into
+    content-defined chunks, stored compressed under their SHA-256 and shared
+    by all the files containing them. A file is only a manifest, the list of
+    the digests and sizes of its chunks. The chunks are reference counted,
+    and deleted once no manifest references them anymore.
+
+    The snapshots of a binary being mostly identical, the disk usage stays
+    close to the one of a single copy, and renaming or deleting a snapshot
+    only touches the database.
+
+    The methods only touching the disk, read_chunk() and write_chunks(), can
+    be called from the worker threads. Once the server is started, the others
+    are called on the threads of the storage engine, see using(): the writer
+    thread is then the only one deleting chunks.
+    """
+
+    def __init__(self, directory, storage):
+        self._directory = directory
+        self._storage = storage
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def using(self, storage):
+        """Get the same store, accessing the database with another storage."""
+        store = copy.copy(self)
+        store._storage = storage
+        return store
+
+    def _chunk_path(self, digest):
+        return os.path.join(self._directory, digest[:2], digest)
+
+    def read_chunk(self, digest):
+        """Read and decompress the chunk with the given digest."""
+        with open(self._chunk_path(digest), "rb") as chunk_file:
+            return zlib.decompress(chunk_file.read())
+
+    def _write_chunk(self, digest, data):
+        """Compress and write a chunk to the disk."""
+        path = self._chunk_path(digest)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + ".tmp", "wb") as chunk_file:
+            chunk_file.write(zlib.compress(data))
+        os.replace(path + ".tmp", path)
+
+    def _delete_chunks(self, digests):
+        for digest in digests:
+            path = self._chunk_path(digest)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _release(self, manifest):
+        """Dereference the chunks of a manifest, deleting the unused ones."""
+        counts = ChunkStore._counts(manifest)
+        self._delete_chunks(self._storage.release_chunks(counts))
+
+    @staticmethod
+    def _counts(manifest):
+        """Count how many times each chunk appears in a manifest."""
+        return collections.Counter(
+            digest.hex() for digest, _ in read_manifest(manifest)
+        )
+
+    def write_chunks(self, chunks):
+        """
+        Write the chunks that aren't on the disk already. Return the manifest
+        of the chunks, and the size of each of them indexed by digest, to be
+        passed to add_chunks().
+        """
+        manifest = bytearray()
+        sizes = {}
+        for chunk in chunks:
+            digest = hashlib.sha256(chunk)
+            hexdigest = digest.hexdigest()
+            if hexdigest not in sizes:
+                if not os.path.exists(self._chunk_path(hexdigest)):
+                    self._write_chunk(hexdigest, chunk)
+                sizes[hexdigest] = len(chunk)
+            manifest += ENTRY.pack(digest.digest(), len(chunk))
+        return bytes(manifest), sizes
+
+    def add_chunks(self, sizes):
+        """
+        Record the chunks written by write_chunks(), unreferenced for now.
+        They will be when the manifest of their file is committed, and are
+        deleted on the next start otherwise. The chunks deleted since they
+        were written are skipped, they will be reported missing.
+        """
+        sizes = dict(
+            (digest, size)
+            for digest, size in sizes.items()
+            if os.path.exists(self._chunk_path(digest))
+        )
+        self._storage.insert_chunks(sizes)
+
+    def missing_chunks(self, manifest):
+        """Get the digests of the chunks of a manifest that we don't have."""
+        missing = collections.OrderedDict()
+        for digest, size in read_manifest(manifest):
+            if digest in missing:
+                continue
+            chunk = self._storage.select_chunk(digest.hex())
+            if not chunk or chunk["size"] != size:
+                missing[digest] = size
+        return list(missing)
+
+    def commit_file(self, project, binary, snapshot, manifest):
+        """
+        Make the file described by a manifest the database of a snapshot,
+        replacing the previous one. All of its chunks must be stored already.
+        Return the file digest.
+        """
+        # Reference the new chunks before releasing the old ones
+        self._storage.acquire_chunks(ChunkStore._counts(manifest))
+        old = self._storage.select_file(project, binary, snapshot)
+        size = sum(size for _, size in read_manifest(manifest))
+        digest = manifest_digest(manifest)
+        self._storage.replace_file(
+            project, binary, snapshot, size, digest, manifest
+        )
+        if old:
+            self._release(old["manifest"])
+        return digest
+
+    def store_file(self, project, binary, snapshot, manifest, sizes=None):
+        """
+        Record the chunks written by write_chunks(), if their sizes are given,
+        then commit the manifest unless some of its chunks are missing. Return
+        the digests of the missing chunks, and the ones of the files that no
+        snapshot has anymore.
+        """
+        if sizes:
+            self.add_chunks(sizes)
+        missing = self.missing_chunks(manifest)
+        if missing:
+            return missing, []
+        old_digest = self.file_digest(project, binary, snapshot)
+        self.commit_file(project, binary, snapshot, manifest)
+        return [], self._unused([old_digest])
+
+    def write_file(self, project, binary, snapshot, blocks):
+        """
+        Store the file made of the given blocks of data as the database of
+        a snapshot, replacing the previous one. Return the file digest.
+        """
+        manifest, sizes = self.write_chunks(chunk_stream(blocks))
+        self.add_chunks(sizes)
+        return self.commit_file(project, binary, snapshot, manifest)
+
+    def import_file(self, project, binary, snapshot, file_path):
+        """Store a file from the disk, and delete it."""
+        with open(file_path, "rb") as input_file:
+            blocks = iter(lambda: input_file.read(CHUNK_MAX), b"")
+            self.write_file(project, binary, snapshot, blocks)
+        os.remove(file_path)
+
+    def read_manifest(self, project, binary, snapshot):
+        """Get the manifest of the database of a snapshot, if any."""
+        result = self._storage.select_file(project, binary, snapshot)
+        return result["manifest"] if result else None
+
+    def open_file(self, project, binary, snapshot):
+        """
+        Open the database of a snapshot. Return a reader, the size of the
+        file, and its digest, or None if there is no such file.
+        """
+        result = self._storage.select_file(project, binary, snapshot)
+        if not result:
+            return None
+        reader = ChunkReader(self, result["manifest"])
+        return reader, result["size"], result["hash"]
+
+    def file_digest(self, project, binary, snapshot):
+        """Get the digest of the database of a snapshot, if any."""
+        result = self._storage.select_file(project, binary, snapshot)
+        return result["hash"] if result else None
+
+    def delete_file(self, project, binary, snapshot):
+        """Delete the database of a snapshot."""
+        old = self._storage.select_file(project, binary, snapshot)
+        if old:
+            self._storage.delete_file(project, binary, snapshot)
+            self._release(old["manifest"])
+
+    def delete_files(self, project, binary=None, snapshot=None):
+        """
+        Delete the databases of the snapshots of a project, binary, or only
+        of a snapshot. Return the digests of the files no snapshot has now.
+        """
+        digests = []
+        for old in self._storage.select_files(project, binary, snapshot):
+            self._storage.delete_file(
+                old["project"], old["binary"], old["snapshot"]
+            )
+            self._release(old["manifest"])
+            digests.append(old["hash"])
+        return self._unused(digests)
+
+    def _unused(self, digests):
+        """Get the digests of files that no snapshot has anymore."""
+        return [
+            digest
+            for digest in set(digests)
+            if digest and not self._storage.count_files(digest)
+        ]
+
+    def collect_garbage(self):
+        """Delete the chunks left unreferenced, e.g. after a crash."""
+        self._delete_chunks(self._storage.collect_chunks())
@@ -0,0 +1,419 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import base64
+import json
+import re
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec(object):
+    """
+    A codec serializes the dictionaries built from the packets into bytes,
+    and back. The codec to use is chosen per connection during the handshake.
+
+    Compact codecs replace the packet type names by their index into a names
+    table. The table is the one of the client, which sends it during the
+    handshake, so both parties agree on the indexes.
+    """
+
+    __codec__ = None
+    NAME_KEYS = ("type", "event_type", "command_type")
+    # The identifiers of the distinct codec and names table pairs
+    _KEYS = {}
+
+    def __init__(self, names=None):
+        self._names = list(names or [])
+        self._ids = {name: i for i, name in enumerate(self._names)}
+        key = (self.__codec__, tuple(self._names))
+        self._key = Codec._KEYS.setdefault(key, len(Codec._KEYS))
+
+    @property
+    def key(self):
+        """
+        Identify the encoding produced by this codec: the codecs with the
+        same key encode the same dictionary into the same bytes.
+        """
+        return self._key
+
+    def encode(self, dct):
+        """Serialize a dictionary into bytes."""
+        raise NotImplementedError("encode() not implemented")
+
+    def decode(self, data):
+        """Deserialize a dictionary from bytes."""
+        raise NotImplementedError("decode() not implemented")
+
+    def decode_header(self, data, count):
+        """
+        Deserialize only the first entries of a dictionary, leaving the rest
+        of the data untouched. The server uses it to relay the events without
+        parsing them, as their type and tick come first.
+        """
+        raise NotImplementedError("decode_header() not implemented")
+
+    def portable(self, data):
+        """
+        Convert serialized data into a form that can be stored, and decoded
+        later using load_portable() without the names table: a string for
+        JSON, and bytes without the compacted names for MessagePack.
+        """
+        raise NotImplementedError("portable() not implemented")
+
+    def _compact_names(self, dct):
+        """Replace the type names by their index, when known."""
+        for key in Codec.NAME_KEYS:
+            if key in dct and dct[key] in self._ids:
+                dct[key] = self._ids[dct[key]]
+        return dct
+
+    def _expand_names(self, dct):
+        """Replace the type indexes by their name."""
+        for key in Codec.NAME_KEYS:
+            if isinstance(dct.get(key), int):
+                dct[key] = self._names[dct[key]]
+        return dct
+
+
+class JsonCodec(Codec):
+    """
+    The default codec, which is also the one of the legacy framing. As JSON
+    has no binary type, bytes are written as base64 in a tagged object.
+    """
+
+    __codec__ = "json"
+    BYTES_KEY = "__bytes__"
+
+    @staticmethod
+    def _default(obj):
+        """Serialize the objects that aren't natively supported by JSON."""
+        if isinstance(obj, (bytes, bytearray, memoryview)):
+            data = base64.b64encode(obj).decode("ascii")
+            return {JsonCodec.BYTES_KEY: data}
+        raise TypeError("Cannot serialize %r" % (obj,))
+
+    @staticmethod
+    def _object_hook(dct):
+        """Deserialize the tagged objects produced by _default()."""
+        if len(dct) == 1 and JsonCodec.BYTES_KEY in dct:
+            return base64.b64decode(dct[JsonCodec.BYTES_KEY])
+        return dct
+
+    @staticmethod
+    def dumps(obj):
+        """Serialize an object into a JSON string, supporting bytes."""
+        return json.dumps(obj, default=JsonCodec._default)
+
+    @staticmethod
+    def loads(s):
+        """Deserialize an object from a JSON string, supporting bytes."""
+        return json.loads(s, object_hook=JsonCodec._object_hook)
+
+    def encode(self, dct):
+        return JsonCodec.dumps(dct).encode("utf-8")
+
+    def decode(self, data):
+        return JsonCodec.loads(bytes(data).decode("utf-8"))
+
+    _DECODER = json.JSONDecoder(object_hook=_object_hook.__func__)
+    _SPACES = re.compile(r"[ \t\n\r]*")
+    # An entry whose value is a string without escapes, an integer, or a
+    # literal, such as the header of the events: decoded without raw_decode()
+    _ENTRY = re.compile(
+        r'"([^"\\]*)"[ \t\n\r]*:[ \t\n\r]*'
+        r'(?:"([^"\\]*)"|(-?[0-9]+)(?![0-9.eE])|(true|false|null))[ \t\n\r]*'
+    )
+    _LITERALS = {"true": True, "false": False, "null": None}
+
+    def decode_header(self, data, count):
+        text = bytes(data).decode("utf-8")
+        skip = JsonCodec._SPACES.match
+        pos = skip(text, 0).end()
+        if text[pos : pos + 1] != "{":  # noqa: E203
+            raise ValueError("Expected an object")
+        dct = {}
+        pos = skip(text, pos + 1).end()
+        while len(dct) < count and text[pos : pos + 1] != "}":  # noqa: E203
+            match = JsonCodec._ENTRY.match(text, pos)
+            if match:
+                key, string, integer, literal = match.groups()
+                if string is not None:
+                    dct[key] = string
+                elif integer is not None:
+                    dct[key] = int(integer)
+                else:
+                    dct[key] = JsonCodec._LITERALS[literal]
+                pos = match.end()
+            else:
+                key, pos = JsonCodec._DECODER.raw_decode(text, pos)
+                pos = skip(text, pos).end()
+                colon = text[pos : pos + 1]  # noqa: E203
+                if not isinstance(key, str) or colon != ":":
+                    raise ValueError("Expected a key")
+                pos = skip(text, pos + 1).end()
+                dct[key], pos = JsonCodec._DECODER.raw_decode(text, pos)
+                pos = skip(text, pos).end()
+            if text[pos : pos + 1] == ",":  # noqa: E203
+                pos = skip(text, pos + 1).end()
+        return dct
+
+    def portable(self, data):
+        return bytes(data).decode("utf-8")
+
+
+class MsgPackCodec(Codec):
+    """
+    A compact binary codec using MessagePack. The msgpack module is used if
+    installed, otherwise a (slower) pure-Python implementation is used.
+    """
+
+    __codec__ = "msgpack"
+
+    def encode(self, dct):
+        dct = self._compact_names(dict(dct))
+        if msgpack:
+            return msgpack.packb(dct, use_bin_type=True)
+        out = bytearray()
+        _pack(dct, out)
+        return bytes(out)
+
+    def decode(self, data):
+        if msgpack:
+            dct = msgpack.unpackb(data, raw=False, strict_map_key=False)
+        else:
+            dct, _ = _unpack(memoryview(data), 0)
+        return self._expand_names(dct)
+
+    def _unpack_header(self, data, count):
+        """Read the first entries of a map, and the position of the rest."""
+        data = memoryview(data)
+        length, pos = _unpack_map_length(data, 0)
+        dct = {}
+        for _ in range(min(count, length)):
+            key, pos = _unpack(data, pos)
+            dct[key], pos = _unpack(data, pos)
+        return dct, length, pos
+
+    def decode_header(self, data, count):
+        dct, _, _ = self._unpack_header(data, count)
+        return self._expand_names(dct)
+
+    def portable(self, data):
+        # The names are found at the start of the packets, as they are built
+        dct, length, pos = self._unpack_header(data, len(Codec.NAME_KEYS))
+        if not any(isinstance(dct.get(key), int) for key in Codec.NAME_KEYS):
+            return bytes(data)
+        out = bytearray()
+        _pack_length(out, length, 0x80, 15, (None, 0xDE, 0xDF))
+        for key, val in self._expand_names(dct).items():
+            _pack(key, out)
+            _pack(val, out)
+        out += memoryview(data)[pos:]
+        return bytes(out)
+
+
+CODECS = {codec.__codec__: codec for codec in (JsonCodec, MsgPackCodec)}
+
+
+def codec_names():
+    """
+    Return the names of the supported codecs, by order of preference. The
+    pure-Python MessagePack implementation is slower than the JSON module,
+    so it is only preferred if the msgpack module is installed.
+    """
+    if msgpack:
+        return [MsgPackCodec.__codec__, JsonCodec.__codec__]
+    return [JsonCodec.__codec__, MsgPackCodec.__codec__]
+
+
+def get_codec(name, names=None):
+    """Instantiate the codec with the given name."""
+    return CODECS[name](names)
+
+
+def load_portable(data):
+    """Deserialize a dictionary converted by Codec.portable()."""
+    if isinstance(data, str):
+        return JsonCodec.loads(data)
+    return MsgPackCodec().decode(data)
+
+
+# Pure-Python implementation of the subset of MessagePack that we use.
+# See https://github.com/msgpack/msgpack/blob/master/spec.md
+_UINTS = ((0xFF, 0xCC, "B"), (0xFFFF, 0xCD, "H"), (0xFFFFFFFF, 0xCE, "I"))
+_INTS = ((0x7F, 0xD0, "b"), (0x7FFF, 0xD1, "h"), (0x7FFFFFFF, 0xD2, "i"))
+
+
+def _pack_length(out, length, fix, fix_max, codes):
+    """Write the header of a str, bin, array or map object."""
+    if fix is not None and length <= fix_max:
+        out.append(fix | length)
+    elif length <= 0xFF and codes[0] is not None:
+        out.append(codes[0])
+        out.append(length)
+    elif length <= 0xFFFF:
+        out.append(codes[1])
+        out.extend(struct.pack(">H", length))
+    else:
+        out.append(codes[2])
+        out.extend(struct.pack(">I", length))
+
+
+def _pack(obj, out):
+    """Write an object into the output bytearray."""
+    if obj is None:
+        out.append(0xC0)
+    elif obj is False:
+        out.append(0xC2)
+    elif obj is True:
+        out.append(0xC3)
+    elif isinstance(obj, int):
+        if 0 <= obj <= 0x7F or -32 <= obj < 0:
+            out.append(obj & 0xFF)
+        elif obj >= 0:
+            for limit, code, fmt in _UINTS:
+                if obj <= limit:
+                    break
+            else:
+                code, fmt = 0xCF, "Q"
+            out.append(code)
+            out.extend(struct.pack(">" + fmt, obj))
+        else:
+            for limit, code, fmt in _INTS:
+                if -limit - 1 <= obj:
+                    break
+            else:
+                code, fmt = 0xD3, "q"
+            out.append(code)
+            out.extend(struct.pack(">" + fmt, obj))
+    elif isinstance(obj, float):
+        out.append(0xCB)
+        out.extend(struct.pack(">d", obj))
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        _pack_length(out, len(data), 0xA0, 31, (0xD9, 0xDA, 0xDB))
+        out.extend(data)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _pack_length(out, len(obj), None, 0, (0xC4, 0xC5, 0xC6))
+        out.extend(obj)
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(out, len(obj), 0x90, 15, (None, 0xDC, 0xDD))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        _pack_length(out, len(obj), 0x80, 15, (None, 0xDE, 0xDF))
+        for key, val in obj.items():
+            _pack(key, out)
+            _pack(val, out)
+    else:
+        raise TypeError("Cannot serialize %r" % (obj,))
+
+
+_FORMATS = {
+    0xCA: ">f",
+    0xCB: ">d",
+    0xCC: ">B",
+    0xCD: ">H",
+    0xCE: ">I",
+    0xCF: ">Q",
+    0xD0: ">b",
+    0xD1: ">h",
+    0xD2: ">i",
+    0xD3: ">q",
+}
+_LENGTHS = {
+    0xC4: ">B",
+    0xC5: ">H",
+    0xC6: ">I",
+    0xD9: ">B",
+    0xDA: ">H",
+    0xDB: ">I",
+    0xDC: ">H",
+    0xDD: ">I",
+    0xDE: ">H",
+    0xDF: ">I",
+}
+
+
+def _unpack_map_length(data, pos):
+    """Read the header of a map, returning its length and the next position."""
+    code = data[pos]
+    if 0x80 <= code <= 0x8F:
+        return code & 0x0F, pos + 1
+    if code in (0xDE, 0xDF):
+        fmt = _LENGTHS[code]
+        (length,) = struct.unpack_from(fmt, data, pos + 1)
+        return length, pos + 1 + struct.calcsize(fmt)
+    raise ValueError("Expected a MessagePack map: %#x" % code)
+
+
+def _unpack(data, pos):
+    """Read an object from the data, returning it and the next position."""
+    code = data[pos]
+    pos += 1
+
+    # Fixed-size objects
+    if code <= 0x7F:
+        return code, pos
+    if code >= 0xE0:
+        return code - 0x100, pos
+    if code == 0xC0:
+        return None, pos
+    if code in (0xC2, 0xC3):
+        return code == 0xC3, pos
+    if code in _FORMATS:
+        fmt = _FORMATS[code]
+        value = struct.unpack_from(fmt, data, pos)[0]
+        return value, pos + struct.calcsize(fmt)
+
+    # Variable-size objects
+    if 0xA0 <= code <= 0xBF:
+        kind, length = 0xA0, code & 0x1F
+    elif 0x90 <= code <= 0x9F:
+        kind, length = 0x90, code & 0x0F
+    elif 0x80 <= code <= 0x8F:
+        kind, length = 0x80, code & 0x0F
+    elif code in _LENGTHS:
+        fmt = _LENGTHS[code]
+        (length,) = struct.unpack_from(fmt, data, pos)
+        pos += struct.calcsize(fmt)
+        if code in (0xC4, 0xC5, 0xC6):
+            kind = 0xC4
+        elif code in (0xD9, 0xDA, 0xDB):
+            kind = 0xA0
+        elif code in (0xDC, 0xDD):
+            kind = 0x90
+        else:
+            kind = 0x80
+    else:
+        raise ValueError("Unsupported MessagePack type: %#x" % code)
+
+    if kind == 0xA0:
+        return str(data[pos : pos + length], "utf-8"), pos + length  # noqa
+    if kind == 0xC4:
+        return bytes(data[pos : pos + length]), pos + length  # noqa: E203
+    if kind == 0x90:
+        items = []
+        for _ in range(length):
+            item, pos = _unpack(data, pos)
+            items.append(item)
+        return items, pos
+    dct = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        dct[key], pos = _unpack(data, pos)
+    return dct, pos
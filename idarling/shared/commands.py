@@ -21,8 +21,45 @@ from .packets import (
 )
 
 
+class Handshake(ParentCommand):
+    """
+    Sent by the client as soon as it is connected, to agree with the server
+    on the protocol features to use for the rest of the connection. Older
+    servers don't know about it and will never reply.
+    """
+
+    __command__ = "handshake"
+    __ordered__ = False  # Answered before anything else is sent
+
+    class Query(IQuery, DefaultCommand):
+        def __init__(self, features):
+            super(Handshake.Query, self).__init__()
+            self.features = features
+
+    class Reply(IReply, DefaultCommand):
+        def __init__(self, query, features):
+            super(Handshake.Reply, self).__init__(query)
+            self.features = features
+
+
+class RefuseQuery(IReply, DefaultCommand):
+    """
+    Sent instead of the reply to a query that can never succeed, such as the
+    download of a database that doesn't exist. The query fails right away
+    with a QueryRefusedError, instead of timing out and being sent again.
+    """
+
+    __command__ = "refuse_query"
+    __ordered__ = False
+
+    def __init__(self, query, reason):
+        super(RefuseQuery, self).__init__(query)
+        self.reason = reason
+
+
 class ListProjects(ParentCommand):
     __command__ = "list_projects"
+    __ordered__ = False  # Read-only
 
     class Query(IQuery, DefaultCommand):
         pass
@@ -43,6 +80,7 @@ class ListProjects(ParentCommand):
 
 class ListBinaries(ParentCommand):
     __command__ = "list_binaries"
+    __ordered__ = False  # Read-only
 
     class Query(IQuery, DefaultCommand):
         def __init__(self, project):
@@ -65,6 +103,7 @@ class ListBinaries(ParentCommand):
 
 class ListSnapshots(ParentCommand):
     __command__ = "list_snapshots"
+    __ordered__ = False  # Read-only
 
     class Query(IQuery, DefaultCommand):
         def __init__(self, project, binary):
@@ -184,32 +223,171 @@ class DeleteSnapshot(ParentCommand):
             self.deleted = deleted
 
 class UpdateFile(ParentCommand):
+    """
+    Upload a chunk of a database. The reply contains the offset expected
+    by the server, which is the end of the chunk if it was accepted.
+    """
+
     __command__ = "update_file"
+    # The transfers are versioned by their tags and digests, not by ticks
+    __ordered__ = False
 
     class Query(IQuery, Container, DefaultCommand):
-        def __init__(self, project, binary, snapshot):
+        def __init__(
+            self,
+            project,
+            binary,
+            snapshot,
+            transfer,
+            offset,
+            checksum,
+            final,
+            codec,
+        ):
             super(UpdateFile.Query, self).__init__()
             self.project = project
             self.binary = binary
             self.snapshot = snapshot
+            self.transfer = transfer
+            self.offset = offset
+            self.checksum = checksum
+            self.final = final
+            self.codec = codec
 
-    class Reply(IReply, Command):
-        pass
+    class Reply(IReply, DefaultCommand):
+        def __init__(self, query, offset, done):
+            super(UpdateFile.Reply, self).__init__(query)
+            self.offset = offset
+            self.done = done
 
 
 class DownloadFile(ParentCommand):
+    """
+    Download the chunk of a database starting at the given offset. The tag
+    identifies the version of the database the chunk belongs to, and the
+    codec it is compressed with.
+
+    The server also sends it to the clients for them to upload a snapshot,
+    in which case the transfer is None and the reply is empty.
+    """
+
     __command__ = "download_file"
+    __ordered__ = False
 
     class Query(IQuery, DefaultCommand):
-        def __init__(self, project, binary, snapshot):
+        def __init__(self, project, binary, snapshot, transfer, offset):
             super(DownloadFile.Query, self).__init__()
             self.project = project
             self.binary = binary
             self.snapshot = snapshot
+            self.transfer = transfer
+            self.offset = offset
+
+    class Reply(IReply, Container, DefaultCommand):
+        def __init__(
+            self, query, offset, checksum, final, tag, position, total, codec
+        ):
+            super(DownloadFile.Reply, self).__init__(query)
+            self.offset = offset
+            self.checksum = checksum
+            self.final = final
+            self.tag = tag
+            self.position = position
+            self.total = total
+            self.codec = codec
+
+
+class UploadManifest(ParentCommand):
+    """
+    Make the database described by a manifest, the list of the digests and
+    sizes of its chunks, the one of a snapshot. If the server is missing
+    some of the chunks, the reply contains their digests instead, and the
+    client has to send them using UploadChunks before trying again.
+    """
+
+    __command__ = "upload_manifest"
+    __ordered__ = False
 
-    class Reply(IReply, Container, Command):
+    class Query(IQuery, Container, DefaultCommand):
+        def __init__(self, project, binary, snapshot):
+            super(UploadManifest.Query, self).__init__()
+            self.project = project
+            self.binary = binary
+            self.snapshot = snapshot
+
+    class Reply(IReply, Container, DefaultCommand):
+        def __init__(self, query, done):
+            super(UploadManifest.Reply, self).__init__(query)
+            self.done = done
+
+
+class UploadChunks(ParentCommand):
+    """Upload some chunks of a database, concatenated and compressed."""
+
+    __command__ = "upload_chunks"
+    __ordered__ = False
+
+    class Query(IQuery, Container, DefaultCommand):
+        def __init__(self, project, binary, snapshot, sizes, codec):
+            super(UploadChunks.Query, self).__init__()
+            self.project = project
+            self.binary = binary
+            self.snapshot = snapshot
+            self.sizes = sizes
+            self.codec = codec
+
+    class Reply(IReply, DefaultCommand):
         pass
 
+
+class DownloadManifest(ParentCommand):
+    """
+    Download the manifest of the database of a snapshot, so that only the
+    chunks missing from a local copy have to be downloaded. The digest is
+    None if there is no database.
+    """
+
+    __command__ = "download_manifest"
+    __ordered__ = False
+
+    class Query(IQuery, DefaultCommand):
+        def __init__(self, project, binary, snapshot):
+            super(DownloadManifest.Query, self).__init__()
+            self.project = project
+            self.binary = binary
+            self.snapshot = snapshot
+
+    class Reply(IReply, Container, DefaultCommand):
+        def __init__(self, query, digest):
+            super(DownloadManifest.Reply, self).__init__(query)
+            self.digest = digest
+
+
+class DownloadChunks(ParentCommand):
+    """
+    Download some chunks of the database of a snapshot, concatenated and
+    compressed. If the database isn't the one with the given digest anymore,
+    the reply contains the new digest and no chunks.
+    """
+
+    __command__ = "download_chunks"
+    __ordered__ = False
+
+    class Query(IQuery, DefaultCommand):
+        def __init__(self, project, binary, snapshot, digest, chunks):
+            super(DownloadChunks.Query, self).__init__()
+            self.project = project
+            self.binary = binary
+            self.snapshot = snapshot
+            self.digest = digest
+            self.chunks = chunks
+
+    class Reply(IReply, Container, DefaultCommand):
+        def __init__(self, query, digest, codec):
+            super(DownloadChunks.Reply, self).__init__(query)
+            self.digest = digest
+            self.codec = codec
+
 class RenameBinary(ParentCommand):
     __command__ = "rename_binary"
 
@@ -251,6 +429,20 @@ class JoinSession(DefaultCommand):
         self.silent = silent
 
 
+class CatchUpProgress(DefaultCommand):
+    """
+    Sent by the server while sending the events missed by a client, after
+    each page of them. The catch-up is done once tick reaches last_tick.
+    """
+
+    __command__ = "catch_up_progress"
+
+    def __init__(self, tick, last_tick):
+        super(CatchUpProgress, self).__init__()
+        self.tick = tick
+        self.last_tick = last_tick
+
+
 class LeaveSession(DefaultCommand):
     __command__ = "leave_session"
 
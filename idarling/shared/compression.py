@@ -0,0 +1,432 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import bz2
+import collections
+import lzma
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+
+    # The decompressors only tell where their frame ends since 0.15
+    if not hasattr(zstandard.ZstdDecompressor().decompressobj(), "eof"):
+        zstandard = None
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class StreamCompression(object):
+    """
+    A stream compression compresses the packets sent over a connection. It
+    keeps one context per direction for the whole lifetime of a connection,
+    so that the keys and values repeated between packets compress well, and
+    flushes it after each packet so that it can be decompressed right away.
+    """
+
+    __compression__ = None
+
+    def compress(self, data):
+        """Compress a packet, flushing the compression context."""
+        raise NotImplementedError("compress() not implemented")
+
+    def decompress(self, data):
+        """Decompress a packet compressed by the other party."""
+        raise NotImplementedError("decompress() not implemented")
+
+
+class ZlibCompression(StreamCompression):
+    """
+    Raw deflate, as used by the WebSocket permessage-deflate extension. The
+    empty block ending each flush is always the same, so it isn't sent.
+    """
+
+    __compression__ = "zlib"
+    FLUSH_MARKER = b"\x00\x00\xff\xff"
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS
+        )
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def compress(self, data):
+        data = self._compressor.compress(data)
+        data += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data[: -len(ZlibCompression.FLUSH_MARKER)]
+
+    def decompress(self, data):
+        data = bytes(data) + ZlibCompression.FLUSH_MARKER
+        return self._decompressor.decompress(data)
+
+
+class ZstdCompression(StreamCompression):
+    """Zstandard, only available if the zstandard module is installed."""
+
+    __compression__ = "zstd"
+
+    def __init__(self, level=3):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+        self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def compress(self, data):
+        data = self._compressor.compress(data)
+        return data + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(bytes(data))
+
+
+COMPRESSIONS = {
+    compression.__compression__: compression
+    for compression in (ZlibCompression, ZstdCompression)
+}
+
+
+def compression_names():
+    """
+    Return the names of the supported stream compressions, by order of
+    preference. The last one, "none", disables the compression.
+    """
+    names = [ZlibCompression.__compression__, "none"]
+    if zstandard:
+        names.insert(0, ZstdCompression.__compression__)
+    return names
+
+
+def get_compression(name):
+    """Instantiate the stream compression with the given name, if any."""
+    if name not in COMPRESSIONS:
+        return None
+    return COMPRESSIONS[name]()
+
+
+class FileCodec(object):
+    """
+    A file codec compresses the databases being transferred, as a single
+    stream. Its compressors have compress() and flush() methods, and its
+    decompressors have a decompress() method and an eof attribute, like the
+    ones of the standard library.
+
+    The databases are big, so they are compressed in independent blocks
+    using all the cores, like pigz and pbzip2 do. The compressed blocks are
+    concatenated into a stream that the standard tools can still decode.
+    """
+
+    __codec__ = None
+    DEFAULT_LEVEL = None
+
+    def __init__(self, level=None):
+        self._level = self.DEFAULT_LEVEL if level is None else level
+
+    @property
+    def name(self):
+        return self.__codec__
+
+    @property
+    def level(self):
+        return self._level
+
+    def compressor(self):
+        """Create a new compressor."""
+        raise NotImplementedError("compressor() not implemented")
+
+    def decompressor(self):
+        """Create a new decompressor."""
+        raise NotImplementedError("decompressor() not implemented")
+
+    def parallel_compressor(self):
+        """Create a new compressor compressing blocks in parallel."""
+        return ParallelCompressor(self)
+
+    def stream_decompressor(self):
+        """Create a new decompressor that handles concatenated streams."""
+        return MultiStreamDecompressor(self)
+
+    def compress_block(self, data):
+        """
+        Compress a block independently of the others. By default, it is
+        a complete stream: the format must support concatenated streams.
+        """
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def header(self):
+        """Get the data preceding the compressed blocks."""
+        return b""
+
+    def trailer(self, data):
+        """Get the data following the compressed blocks."""
+        return b""
+
+
+class NoneFileCodec(FileCodec):
+    """Doesn't compress at all, used for the loopback connections."""
+
+    __codec__ = "none"
+
+    class Passthrough(object):
+        eof = True
+
+        def compress(self, data):
+            return data
+
+        def decompress(self, data):
+            return data
+
+        def flush(self):
+            return b""
+
+    def compressor(self):
+        return NoneFileCodec.Passthrough()
+
+    def decompressor(self):
+        return NoneFileCodec.Passthrough()
+
+    def parallel_compressor(self):
+        return self.compressor()
+
+    def stream_decompressor(self):
+        return self.decompressor()
+
+
+class Bz2FileCodec(FileCodec):
+    __codec__ = "bz2"
+    DEFAULT_LEVEL = 9
+
+    def compressor(self):
+        return bz2.BZ2Compressor(self._level)
+
+    def decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class ZlibFileCodec(FileCodec):
+    """
+    The zlib format doesn't support concatenated streams. Instead, like
+    pigz, the blocks are raw deflate data ending with an empty stored block,
+    that are put between a single header and trailer.
+    """
+
+    __codec__ = "zlib"
+    DEFAULT_LEVEL = 6
+
+    def compressor(self):
+        return zlib.compressobj(self._level)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+    def compress_block(self, data):
+        compressor = zlib.compressobj(
+            self._level, zlib.DEFLATED, -zlib.MAX_WBITS
+        )
+        return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def header(self):
+        # The level is part of the header
+        return zlib.compress(b"", self._level)[:2]
+
+    def trailer(self, checksum):
+        # An empty final block, then the Adler-32 of the uncompressed data
+        final = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return final.flush() + checksum.to_bytes(4, "big")
+
+
+class LzmaFileCodec(FileCodec):
+    __codec__ = "lzma"
+    DEFAULT_LEVEL = 1
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=self._level)
+
+    def decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class ZstdFileCodec(FileCodec):
+    """
+    Zstandard, only available if the zstandard module is installed, in a
+    version whose decompressors have the eof and unused_data attributes.
+    """
+
+    __codec__ = "zstd"
+    DEFAULT_LEVEL = 3
+
+    def compressor(self):
+        compressor = zstandard.ZstdCompressor(level=self._level)
+        return compressor.compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class Lz4FileCodec(FileCodec):
+    """LZ4, only available if the lz4 module is installed."""
+
+    __codec__ = "lz4"
+    DEFAULT_LEVEL = 0
+
+    class Compressor(object):
+        def __init__(self, level):
+            self._compressor = lz4.frame.LZ4FrameCompressor(
+                compression_level=level
+            )
+            self._header = self._compressor.begin()
+
+        def compress(self, data):
+            data = self._header + self._compressor.compress(data)
+            self._header = b""
+            return data
+
+        def flush(self):
+            data = self._header + self._compressor.flush()
+            self._header = b""
+            return data
+
+    def compressor(self):
+        return Lz4FileCodec.Compressor(self._level)
+
+    def decompressor(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+FILE_CODECS = {
+    codec.__codec__: codec
+    for codec in (
+        NoneFileCodec,
+        Bz2FileCodec,
+        ZlibFileCodec,
+        LzmaFileCodec,
+        ZstdFileCodec,
+        Lz4FileCodec,
+    )
+}
+
+
+def file_codec_names():
+    """
+    Return the names of the supported file codecs, by order of preference.
+    The fastest ones come first, as the transfers are usually bound by the
+    compression speed rather than by the network.
+    """
+    names = [ZlibFileCodec.__codec__, LzmaFileCodec.__codec__]
+    names += [Bz2FileCodec.__codec__, NoneFileCodec.__codec__]
+    if lz4:
+        names.insert(0, Lz4FileCodec.__codec__)
+    if zstandard:
+        names.insert(0, ZstdFileCodec.__codec__)
+    return names
+
+
+def get_file_codec(name, level=None):
+    """Instantiate the file codec with the given name."""
+    return FILE_CODECS[name](level)
+
+
+# The compression threads are shared by all the transfers
+COMPRESSION_THREADS = os.cpu_count() or 1
+# The size of the blocks compressed independently
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def compression_executor():
+    """Get the thread pool used to compress the blocks."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                COMPRESSION_THREADS, thread_name_prefix="idarling-compression"
+            )
+        return _executor
+
+
+class ParallelCompressor(object):
+    """
+    Compresses blocks in a thread pool. The modules of all the codecs
+    release the GIL, so this scales with the number of cores. compress()
+    only returns the blocks that are done, in order, and waits when too
+    many are pending so that the memory usage stays bounded.
+    """
+
+    def __init__(self, codec):
+        self._codec = codec
+        self._executor = compression_executor()
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._header = codec.header()
+        self._checksum = zlib.adler32(b"")
+
+    def _submit(self, data):
+        self._checksum = zlib.adler32(data, self._checksum)
+        future = self._executor.submit(self._codec.compress_block, data)
+        self._pending.append(future)
+
+    def _collect(self, wait):
+        output = [self._header]
+        self._header = b""
+        while self._pending and (wait or self._pending[0].done()):
+            output.append(self._pending.popleft().result())
+        return b"".join(output)
+
+    def compress(self, data):
+        self._buffer += data
+        while len(self._buffer) >= COMPRESSION_BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:COMPRESSION_BLOCK_SIZE]))
+            del self._buffer[:COMPRESSION_BLOCK_SIZE]
+            # Keep every thread busy, but not more
+            if len(self._pending) > 2 * COMPRESSION_THREADS:
+                self._pending[0].result()
+        return self._collect(wait=False)
+
+    def flush(self):
+        if self._buffer or not self._pending:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        return self._collect(wait=True) + self._codec.trailer(self._checksum)
+
+
+class MultiStreamDecompressor(object):
+    """
+    Decompresses concatenated streams, starting a new decompressor each
+    time one reaches the end of its stream.
+    """
+
+    def __init__(self, codec):
+        self._codec = codec
+        self._decompressor = codec.decompressor()
+
+    @property
+    def eof(self):
+        return self._decompressor.eof
+
+    def decompress(self, data):
+        output = []
+        while data:
+            if self._decompressor.eof:
+                self._decompressor = self._codec.decompressor()
+            output.append(self._decompressor.decompress(data))
+            data = b""
+            if self._decompressor.eof:
+                data = getattr(self._decompressor, "unused_data", b"")
+        return b"".join(output)
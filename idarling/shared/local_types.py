@@ -269,7 +269,7 @@ class LocalType(object):
         return False
         
     def to_tuple(self):
-       return self.name, self.parsedList, self.TypeFields.decode()
+       return self.name, PackTypeList(self.parsedList), self.TypeFields
    
     def is_complex(self):
         return self.TypeString[0] & idaapi.TYPE_BASE_MASK == idaapi.BT_COMPLEX
@@ -416,6 +416,37 @@ def GetTypeString(parsedList, name=""):
     return packed
 
 
+def PackTypeList(parsedList):
+    """
+    Pack a list returned by ParseTypeString() for the network: the runs of
+    bytes are merged into bytes objects instead of being sent as integers.
+    """
+    packed = []
+    for thing in parsedList:
+        if type(thing) == int:
+            if packed and type(packed[-1]) == bytearray:
+                packed[-1].append(thing)
+            else:
+                packed.append(bytearray([thing]))
+        else:
+            packed.append(thing)
+    return [bytes(thing) if type(thing) == bytearray else thing for thing in packed]
+
+
+def UnpackTypeList(packedList):
+    """
+    Unpack a list packed by PackTypeList(). Lists of integers, as sent by
+    older clients, are returned as-is.
+    """
+    parsedList = []
+    for thing in packedList:
+        if isinstance(thing, bytes):
+            parsedList.extend(thing)
+        else:
+            parsedList.append(thing)
+    return parsedList
+
+
 def ImportLocalType(idx):
     name = ida_typeinf.get_numbered_type_name(ida_typeinf.get_idati(), idx)
     # todo: doing something with empty and error types
@@ -32,6 +32,10 @@ class Serializable(object):
     """
     This base class for an object than can be serialized. More specifically,
     such objects can be read from and written into a Python dictionary.
+
+    The values of the dictionary can be None, booleans, numbers, strings,
+    bytes, lists and dictionaries. Bytes are carried natively by the binary
+    codecs, and base64-encoded by the JSON one (see codecs.py).
     """
 
     @classmethod
@@ -80,6 +84,7 @@ class PacketFactory(type):
     """
 
     _PACKETS = {}
+    _NAMES = []
 
     @staticmethod
     def __new__(mcs, name, bases, attrs):
@@ -90,8 +95,23 @@ class PacketFactory(type):
             and cls.__type__ not in PacketFactory._PACKETS
         ):
             PacketFactory._PACKETS[cls.__type__] = cls
+            PacketFactory.register_name(cls.__type__)
         return cls
 
+    @staticmethod
+    def register_name(name):
+        """
+        Register the name of a packet type. Its index in the names table can
+        be sent instead of the name itself by the compact codecs.
+        """
+        if name not in PacketFactory._NAMES:
+            PacketFactory._NAMES.append(name)
+
+    @staticmethod
+    def names():
+        """Get the table of the packet type names registered so far."""
+        return list(PacketFactory._NAMES)
+
     @classmethod
     def get_class(mcs, dct, server=False):  # noqa: N804
         """
@@ -112,6 +132,12 @@ class Packet(with_metaclass(PacketFactory, Serializable)):
     """
 
     __type__ = None
+    __parent__ = None
+    # Must the packet reach the other party in the order it was sent in,
+    # relative to the events? It is the case of anything that changes, or
+    # depends on, the state of a session. Only the packets that don't can
+    # be sent ahead of the events, see ClientSocket._priority_class().
+    __ordered__ = True
 
     def __init__(self):
         super(Packet, self).__init__()
@@ -121,10 +147,7 @@ class Packet(with_metaclass(PacketFactory, Serializable)):
     def parse_packet(dct, server=False):
         """Parse the packet from a dictionary."""
         cls = PacketFactory.get_class(dct, server)
-        packet = cls.new(dct)
-        if isinstance(packet, Reply):
-            packet.trigger_initback()
-        return packet
+        return cls.new(dct)
 
     def build_packet(self):
         """Build the packet into a dictionary."""
@@ -138,7 +161,7 @@ class Packet(with_metaclass(PacketFactory, Serializable)):
         used to pretty-print the packet contents into the console.
         """
         name = self.__class__.__name__
-        if isinstance(self, Query) or isinstance(self, Reply):
+        if self.__parent__ is not None:
             name = self.__parent__.__name__ + "." + name
         attrs = [
             "{}={}".format(k, v)
@@ -156,6 +179,9 @@ class PacketDeferred(object):
     def __init__(self):
         super(PacketDeferred, self).__init__()
         self._errback = None
+        self._errresult = None
+        self._failed = False
+        self._canceller = None
 
         self._callback = None
         self._callresult = None
@@ -175,6 +201,13 @@ class PacketDeferred(object):
     def add_errback(self, errback):
         """Register an errback for this deferred."""
         self._errback = errback
+        if self._failed:
+            self._run_errback(self._errresult)
+        return self
+
+    def add_canceller(self, canceller):
+        """Register the function called when this deferred is cancelled."""
+        self._canceller = canceller
         return self
 
     def add_initback(self, initback):
@@ -186,12 +219,25 @@ class PacketDeferred(object):
 
     def callback(self, result):
         """Trigger the callback function."""
-        if self._called:
+        if self._called or self._failed:
             raise RuntimeError("Callback already triggered")
         self._called = True
         self._callresult = result
         self._run_callback()
 
+    def errback(self, error):
+        """Trigger the errback function, instead of the callback."""
+        if self._called or self._failed:
+            raise RuntimeError("Callback already triggered")
+        self._failed = True
+        self._errresult = error
+        self._run_errback(error)
+
+    def cancel(self):
+        """Cancel the operation, which will trigger the errback."""
+        if not self._called and not self._failed and self._canceller:
+            self._canceller()
+
     def initback(self, result):
         """Trigger the initback function."""
         if self._inited:
@@ -206,7 +252,7 @@ class PacketDeferred(object):
             try:
                 self._callback(self._callresult)
             except Exception as e:
-                self._errback(e)
+                self._run_errback(e)
 
     def _run_initback(self):
         """Internal method that call the initback/errback function."""
@@ -214,7 +260,32 @@ class PacketDeferred(object):
             try:
                 self._initback(self._initresult)
             except Exception as e:
-                self._errback(e)
+                self._run_errback(e)
+
+    def _run_errback(self, error):
+        """Internal method that calls the errback function."""
+        if self._errback:
+            self._errback(error)
+
+
+class QueryError(Exception):
+    """The base class of the errors passed to the errback of a query."""
+
+
+class QueryTimeoutError(QueryError):
+    """Raised when no reply to a query was received in time."""
+
+
+class QueryCancelledError(QueryError):
+    """Raised when a query was cancelled before its reply was received."""
+
+
+class ConnectionLostError(QueryError):
+    """Raised when the connection was lost before the reply was received."""
+
+
+class QueryRefusedError(QueryError):
+    """Raised when the other party refused a query, see RefuseQuery."""
 
 
 class EventFactory(PacketFactory):
@@ -230,6 +301,7 @@ class EventFactory(PacketFactory):
             and cls.__event__ not in EventFactory._EVENTS
         ):
             EventFactory._EVENTS[cls.__event__] = cls
+            PacketFactory.register_name(cls.__event__)
         return cls
 
     @classmethod
@@ -298,6 +370,95 @@ class DefaultEvent(Default, Event):
         self.parse_default(dct)
 
 
+class RawEvent(DefaultEvent):
+    """
+    An event relayed by the server without being parsed: only its header,
+    its type and its tick, was decoded. The rest is kept as the bytes sent
+    by the client, which are stored and forwarded as-is to the clients using
+    the same codec. It is only parsed when it must be encoded by another one.
+    """
+
+    # The entries that must be found first, for an event to be relayed
+    HEADER = ["type", "event_type", "tick"]
+
+    def __init__(self, event_type, tick, data, codec):
+        Packet.__init__(self)
+        self._event_type = event_type
+        self._tick = tick
+        self._sent_tick = tick
+        self._data = data
+        self._codec = codec
+        self._dct = None
+
+    @classmethod
+    def load(cls, data, codec):
+        """
+        Build an opaque event out of a serialized packet, decoding only its
+        header. Return None if it isn't an event that can be relayed as-is.
+        """
+        header = codec.decode_header(data, len(RawEvent.HEADER))
+        if (
+            list(header) != RawEvent.HEADER
+            or header["type"] != Event.__type__
+            or not isinstance(header["tick"], int)
+        ):
+            return None
+        return cls(header["event_type"], header["tick"], bytes(data), codec)
+
+    @property
+    def event_type(self):
+        """Get the type of the event."""
+        return self._event_type
+
+    @property
+    def data(self):
+        """Get the serialized event, as sent by the client."""
+        return self._data
+
+    @property
+    def codec(self):
+        """Get the codec the event was serialized with."""
+        return self._codec
+
+    @property
+    def verbatim(self):
+        """Can the event still be sent as it was received?"""
+        return self._tick == self._sent_tick
+
+    @property
+    def payload(self):
+        """Get the event in the form it is stored into the database."""
+        return self._codec.portable(self._data)
+
+    def sendable_by(self, codec):
+        """Can the event be sent as it was received, using this codec?"""
+        return self.verbatim and codec.key == self._codec.key
+
+    def build(self, dct):
+        if self._dct is None:
+            self._dct = self._codec.decode(self._data)
+        dct.update(self._dct)
+        dct["tick"] = self._tick
+        return dct
+
+    def __repr__(self):
+        return "{}(event_type={}, tick={}, size={})".format(
+            type(self).__name__, self._event_type, self._tick, len(self._data)
+        )
+
+
+class StoredEvent(RawEvent):
+    """
+    A relayed event read back from the database, in the form it was stored
+    (see Codec.portable()). As the type names aren't compacted, it can be
+    sent as-is to all the clients using the same codec, whatever their
+    names table.
+    """
+
+    def sendable_by(self, codec):
+        return self.verbatim and codec.__codec__ == self._codec.__codec__
+
+
 class CommandFactory(PacketFactory):
     """A packet factory specialized for commands packets."""
 
@@ -315,14 +476,19 @@ class CommandFactory(PacketFactory):
                 # Register the query
                 cls.Query.__parent__ = cls
                 cls.Query.__command__ = cls.__command__ + "_query"
+                cls.Query.__ordered__ = cls.__ordered__
                 CommandFactory._COMMANDS[cls.Query.__command__] = cls.Query
+                PacketFactory.register_name(cls.Query.__command__)
 
                 # Register the reply
                 cls.Reply.__parent__ = cls
                 cls.Reply.__command__ = cls.__command__ + "_reply"
+                cls.Reply.__ordered__ = cls.__ordered__
                 CommandFactory._COMMANDS[cls.Reply.__command__] = cls.Reply
+                PacketFactory.register_name(cls.Reply.__command__)
             else:
                 CommandFactory._COMMANDS[cls.__command__] = cls
+                PacketFactory.register_name(cls.__command__)
         return cls
 
     @classmethod
@@ -382,7 +548,6 @@ class ParentCommand(Command):
     Reply that should themselves subclass packets.Query and packets.Reply.
     """
 
-    __callbacks__ = {}
     Query, Reply = None, None
 
 
@@ -412,10 +577,6 @@ class Query(Packet):
         self._id = dct["__id__"]
         return self
 
-    def register_callback(self, d):
-        """Register a callback triggered when the answer is received."""
-        self.__parent__.__callbacks__[self._id] = d
-
 
 class Reply(Packet):
     """A reply is a packet sent when a query packet is received."""
@@ -441,17 +602,6 @@ class Reply(Packet):
         self._id = dct["__id__"]
         return self
 
-    def trigger_callback(self):
-        """Trigger the finalization callback of the query."""
-        d = self.__parent__.__callbacks__[self._id]
-        d.callback(self)
-        del self.__parent__.__callbacks__[self._id]
-
-    def trigger_initback(self):
-        """Trigger the initialization callback of the query."""
-        d = self.__parent__.__callbacks__[self._id]
-        d.initback(self)
-
 
 class Container(Command):
     """
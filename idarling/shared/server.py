@@ -10,29 +10,45 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import glob
 import logging
 import os
 import sys
 import socket
 import ssl
 import threading
-import bz2
+import collections
 import json
 from functools import partial
 
+from PyQt5.QtCore import QTimer
+
+from .chunks import (
+    chunk_stream,
+    ChunkReader,
+    ChunkStore,
+    ENTRY,
+    read_manifest,
+)
 from .commands import (
+    CatchUpProgress,
     CreateProject,
     CreateBinary,
     CreateSnapshot,
+    DownloadChunks,
     DownloadFile,
+    DownloadManifest,
     InviteToLocation,
     JoinSession,
     LeaveSession,
     ListProjects,
     ListBinaries,
     ListSnapshots,
+    RefuseQuery,
     RenameBinary,
     UpdateFile,
+    UploadChunks,
+    UploadManifest,
     UpdateLocation,
     UpdateUserColor,
     UpdateUserName,
@@ -41,9 +57,20 @@ from .commands import (
     DeleteSnapshot,
 )
 from .discovery import ClientsDiscovery
-from .packets import Command, Event
+from .packets import Command, Event, PacketDeferred
 from .sockets import ClientSocket, ServerSocket
-from .storage import Storage
+from .storage import Storage, StorageEngine
+from .workers import WorkerPool
+from .compression import FILE_CODECS, get_file_codec
+from .transfers import (
+    checksum,
+    is_transfer_id,
+    pack_chunks,
+    Source,
+    Spool,
+    TransferCache,
+    unpack_chunks,
+)
 
 
 class ServerClient(ClientSocket):
@@ -52,6 +79,8 @@ class ServerClient(ClientSocket):
     handlers for the packet the client is susceptible to send.
     """
 
+    CATCH_UP_RETRY = 1000  # ms
+
     def __init__(self, logger, parent=None):
         """
 
@@ -67,6 +96,27 @@ class ServerClient(ClientSocket):
         self._ea = None
         self._handlers = {}
 
+        # A client too slow to keep up is resynchronized from the database
+        # once it caught up, instead of buffering all the events for it
+        self._resync_tick = None
+        self._queued_events = 0
+        self._own_ticks = collections.deque()
+        # The events are read from the database asynchronously, a page at a
+        # time, the next page being read once the previous one was sent
+        self._catching_up = False
+        self._catch_up_id = 0
+        self._catch_up_target = None
+        self._page_waiting = False
+        self._progress_reported = False
+
+        # The packets received while waiting for the last tick of the snapshot
+        self._held_packets = collections.deque()
+
+        # The replies waiting for the jobs of the worker pool to complete
+        self._replies = collections.deque()
+        # The uploads being stored by the worker pool
+        self._storing = set()
+
     @property
     def project(self):
         return self._project
@@ -91,6 +141,17 @@ class ServerClient(ClientSocket):
     def ea(self):
         return self._ea
 
+    @property
+    def session(self):
+        """Get the (project, binary, snapshot) we are subscribed to."""
+        if not self._project or not self._binary or not self._snapshot:
+            return None
+        return self._project, self._binary, self._snapshot
+
+    def rename_binary(self, binary):
+        """Called when the binary we are subscribed to is renamed."""
+        self._binary = binary
+
     def wrap_socket(self, sock):
         ClientSocket.wrap_socket(self, sock)
 
@@ -104,6 +165,10 @@ class ServerClient(ClientSocket):
             CreateSnapshot.Query: self._handle_create_snapshot,
             UpdateFile.Query: self._handle_upload_file,
             DownloadFile.Query: self._handle_download_file,
+            UploadManifest.Query: self._handle_upload_manifest,
+            UploadChunks.Query: self._handle_upload_chunks,
+            DownloadManifest.Query: self._handle_download_manifest,
+            DownloadChunks.Query: self._handle_download_chunks,
             RenameBinary.Query: self._handle_rename_binary,
             JoinSession: self._handle_join_session,
             LeaveSession: self._handle_leave_session,
@@ -126,13 +191,181 @@ class ServerClient(ClientSocket):
         self._logger = CustomAdapter(self._logger, {})
 
     def disconnect(self, err=None, notify=True):
+        if not self._socket:
+            return  # Already disconnected
         # Notify other users that we disconnected
         self.parent().reject(self)
         if self._project and self._binary and self._snapshot and notify:
             self.parent().forward_users(self, LeaveSession(self.name, False))
         ClientSocket.disconnect(self, err)
 
+    def send_packet(self, packet, frames=None):
+        if isinstance(packet, Event):
+            # The events are already in the database, no need to queue them
+            if self._resync_tick is not None:
+                return None
+            if self.congested_for > self.parent().config["resync_timeout"]:
+                self._start_resync(packet)
+                return None
+            self._queued_events += 1
+        return ClientSocket.send_packet(self, packet, frames)
+
+    def _start_resync(self, packet):
+        """Drop the events waiting to be sent, and resync the client later."""
+        dropped = self._drop_outgoing(lambda p: isinstance(p, Event))
+        self._queued_events -= len(dropped)
+        ticks = [event.tick for event in dropped] + [packet.tick]
+        self._resync_tick = min(ticks) - 1
+        self._logger.warning(
+            "Client is too slow, will resync from tick %d" % self._resync_tick
+        )
+
+    def _queue_drained(self):
+        if self._resync_tick is None:
+            return
+        if self._catching_up:
+            # The client received the previous page, read the next one
+            if self._page_waiting:
+                self._page_waiting = False
+                self._read_page()
+            return
+        self._logger.info("Resyncing client from tick %d" % self._resync_tick)
+        self._catch_up(self._resync_tick)
+
+    def _catch_up(self, tick):
+        """
+        Send the events after the given tick, read from the database. The
+        events forwarded meanwhile are dropped, as they will be read too.
+        """
+        if self.session is None:
+            return
+        self._resync_tick = tick
+        self._catching_up = True
+        # The events are read up to the last tick when we started
+        d = self.parent().last_tick(*self.session)
+        d.add_callback(partial(self._catch_up_started, self._catch_up_id))
+        d.add_errback(partial(self._events_not_read, self._catch_up_id))
+
+    def _catch_up_started(self, catch_up_id, last_tick):
+        if catch_up_id != self._catch_up_id:
+            return
+        self._catch_up_target = last_tick
+        self._read_page()
+
+    def _read_page(self):
+        """Read the next page of events, starting after the resync tick."""
+        page = self.parent().config["catch_up_page"]
+        args = self.session + (self._resync_tick, page)
+        d = self.parent().engine.read("select_events", *args)
+        d.add_callback(partial(self._events_read, self._catch_up_id))
+        d.add_errback(partial(self._events_not_read, self._catch_up_id))
+
+    def _events_read(self, catch_up_id, events):
+        # Ignore the events of a session we left since then
+        if catch_up_id != self._catch_up_id:
+            return
+        # They are kept until sent, in case we need to resync again
+        own_ticks = set(self._own_ticks)
+
+        # Send the missed events, except the ones the client sent itself
+        self._logger.debug("Sending %d missed events" % len(events))
+        # Not going through send_packet, to not resync again while catching up
+        tick = self._resync_tick
+        for event in events:
+            tick = max(tick, event.tick)
+            if event.tick not in own_ticks:
+                self._queued_events += 1
+                ClientSocket.send_packet(self, event)
+        self._resync_tick = tick
+
+        # A full page is followed by another, until the last tick is reached
+        page = self.parent().config["catch_up_page"]
+        if len(events) >= page and tick < self._catch_up_target:
+            self._report_progress(tick, self._catch_up_target)
+            self._read_next_page()
+        # A short page ends the catch-up, unless events were saved while we
+        # were reading. An empty one ends it anyway, even if the last tick is
+        # ahead of the database.
+        elif events:
+            d = self.parent().last_tick(*self.session)
+            d.add_callback(partial(self._last_tick_known, catch_up_id, tick))
+            d.add_errback(partial(self._events_not_read, catch_up_id))
+        else:
+            self._finish_catch_up(tick)
+
+    def _last_tick_known(self, catch_up_id, tick, last_tick):
+        if catch_up_id != self._catch_up_id:
+            return
+        if last_tick > tick:
+            # The read waits for the writer to flush them
+            self._read_next_page()
+        else:
+            self._finish_catch_up(tick)
+
+    def _read_next_page(self):
+        # Unless the client is not receiving them fast enough
+        if self._congested_since is None:
+            self._read_page()
+        else:
+            self._page_waiting = True
+
+    def _finish_catch_up(self, tick):
+        if self._progress_reported:
+            self._report_progress(tick, tick)
+        self._resync_tick = None
+        self._catching_up = False
+        self._catch_up_target = None
+        self._progress_reported = False
+
+    def _events_not_read(self, catch_up_id, error):
+        if catch_up_id != self._catch_up_id:
+            return
+        self._logger.error("Couldn't read the missed events")
+        self._logger.exception(error)
+        # Start over later, the events are still dropped until then
+        self._catching_up = False
+        self._catch_up_id += 1
+        self._page_waiting = False
+        QTimer.singleShot(
+            self.CATCH_UP_RETRY,
+            partial(self._retry_catch_up, self._catch_up_id),
+        )
+
+    def _retry_catch_up(self, catch_up_id):
+        if catch_up_id != self._catch_up_id or self._catching_up:
+            return
+        if self._resync_tick is not None:
+            self._catch_up(self._resync_tick)
+
+    def _report_progress(self, tick, last_tick):
+        """Tell the client how far the catch-up went, if it understands it."""
+        if self.catch_up_progress:
+            ClientSocket.send_packet(self, CatchUpProgress(tick, last_tick))
+            self._progress_reported = True
+
+    def _packet_dequeued(self, packet):
+        if isinstance(packet, Event):
+            self._queued_events -= 1
+            # The events sent by the client before this one won't be resent
+            while self._own_ticks and self._own_ticks[0] <= packet.tick:
+                self._own_ticks.popleft()
+
+    def _reset_resync(self):
+        """Forget about the resync state, when leaving a session."""
+        self._resync_tick = None
+        self._own_ticks.clear()
+        self._catching_up = False
+        self._catch_up_id += 1
+        self._catch_up_target = None
+        self._page_waiting = False
+        self._progress_reported = False
+
     def recv_packet(self, packet):
+        # Wait for the last tick of the snapshot before handling the rest
+        if self._held_packets:
+            self._held_packets.append(packet)
+            return True
+
         if isinstance(packet, Command):
             # Call the corresponding handler
             self._handlers[packet.__class__](packet)
@@ -144,47 +377,83 @@ class ServerClient(ClientSocket):
                 )
                 return True
 
-            # Check for de-synchronization
-            tick = self.parent().storage.last_tick(
-                self._project, self._binary, self._snapshot
-            )
-            if tick >= packet.tick:
-                self._logger.warning("De-synchronization detected!")
-                packet.tick = tick + 1
-
-            # Save the event into the snapshot
-            self.parent().storage.insert_event(self, packet)
-            # Forward the event to the other users
-            self.parent().forward_users(self, packet)
-
-            # Ask for a snapshot of the snapshot if needed
-            interval = self.parent().SNAPSHOT_INTERVAL
-            if packet.tick and interval and packet.tick % interval == 0:
-
-                def file_downloaded(reply):
-                    file_name = "%s_%s_%s.idb" % (self._project, self._binary, self._snapshot)
-                    file_path = self.parent().server_file(file_name)
-
-                    # Write the file to disk
-                    with open(file_path, "wb") as output_file:
-                        output_file.write(reply.content)
-                    self._logger.info("Auto-saved file %s" % file_name)
-
-                d = self.send_packet(
-                    DownloadFile.Query(self._project, self._binary, self._snapshot)
-                )
-                d.add_callback(file_downloaded)
-                d.add_errback(self._logger.exception)
+            # Check for de-synchronization, once the last tick is known
+            self._held_packets.append(packet)
+            d = self.parent().last_tick(*self.session)
+            d.add_callback(self._last_tick_read)
+            d.add_errback(self._last_tick_not_read)
         else:
             return False
         return True
 
+    def _last_tick_read(self, tick):
+        # The errors handling the packets are only logged, failing to read
+        # the tick is the only one disconnecting the client
+        packet = self._held_packets.popleft()
+        try:
+            self._save_event(packet, tick)
+        except Exception as e:
+            self._logger.error("Couldn't handle the event")
+            self._logger.exception(e)
+        # We may have been disconnected while reading the tick
+        if not self._connected:
+            self._held_packets.clear()
+            return
+
+        # Handle the packets received in the meantime
+        held, self._held_packets = self._held_packets, collections.deque()
+        for packet in held:
+            try:
+                self.recv_packet(packet)
+            except Exception as e:
+                self._logger.error("Couldn't handle the packet")
+                self._logger.exception(e)
+
+    def _save_event(self, packet, tick):
+        """Save an event received once the last tick is known, and relay it."""
+        if tick >= packet.tick:
+            self._logger.warning("De-synchronization detected!")
+            packet.tick = tick + 1
+
+        # Save the event into the snapshot
+        self.parent().insert_event(self, packet)
+        # Remember it, in case we need to resync this client
+        if self._queued_events or self._resync_tick is not None:
+            self._own_ticks.append(packet.tick)
+        # Forward the event to the other users
+        self.parent().forward_users(self, packet)
+        if not self._connected:
+            return
+
+        # Ask for a snapshot of the snapshot if needed
+        interval = self.parent().SNAPSHOT_INTERVAL
+        if packet.tick and interval and packet.tick % interval == 0:
+
+            def file_downloaded(reply):
+                # The client will upload the file like any other
+                self._logger.info("Auto-save requested")
+
+            d = self.send_packet(
+                DownloadFile.Query(
+                    self._project, self._binary, self._snapshot, None, 0
+                )
+            )
+            d.add_callback(file_downloaded)
+            d.add_errback(self._logger.exception)
+
+    def _last_tick_not_read(self, error):
+        self._logger.error("Couldn't read the last tick")
+        self._held_packets.clear()
+        self.disconnect(error)
+
     def _handle_rename_binary(self, query):
         self._logger.info("Got rename binary request")
         binaries = self.parent().storage.select_binaries(query.project)
         for binary in binaries:
             if binary.name == query.new_name:
-                self._logger.error("Attempt to rename binary to existing name")
+                self._refuse(
+                    query, "Binary %s already exists" % query.new_name
+                )
                 return
 
         # Grab the snapshot lock. This basically means no other client can be
@@ -195,108 +464,497 @@ class ServerClient(ClientSocket):
                 self.parent().client_lock.acquire()
                 # Only do the rename if we could lock the db. Otherwise we will
                 # mess with other clients.
-                db_update_locked = self.parent().db_update_lock.acquire(blocking=False)
+                db_update_locked = self.parent().db_update_lock.acquire(
+                    blocking=False
+                )
                 self.parent().client_lock.release()
                 if db_update_locked:
-                    self.parent().storage.update_binary_name(query.project, query.old_name, query.new_name)
-                    self.parent().storage.update_snapshot_binary(query.project, query.old_name, query.new_name)
-                    self.parent().storage.update_events_binary(query.project, query.old_name, query.new_name)
-
-                    # We just changed the table entries so be sure to use new names 
-                    # for queries
-                    snapshots = self.parent().storage.select_snapshots(query.project, query.new_name)
-                    for snapshot in snapshots:
-                        old_file_name = "%s_%s_%s.idb" % (query.project, query.old_name, snapshot.name)
-                        new_file_name = "%s_%s_%s.idb" % (query.project, query.new_name, snapshot.name)
-                        old_file_path = self.parent().server_file(old_file_name)
-                        new_file_path = self.parent().server_file(new_file_name)
-                        # If a rename happens before a file is uploaded, the 
-                        # idb won't exist
-                        if os.path.exists(old_file_path):
-                            self._logger.info("Renaming: %s to %s" % (old_file_path, new_file_name))
-                            os.rename(old_file_path, new_file_path)
-                        else:
-                            self._logger.warning("Skipping file rename due to non existing file: %s" % old_file_path)
+                    engine = self.parent().engine
+                    engine.write(
+                        "update_binary_name",
+                        query.project,
+                        query.old_name,
+                        query.new_name,
+                    )
+                    engine.write(
+                        "update_snapshot_binary",
+                        query.project,
+                        query.old_name,
+                        query.new_name,
+                    )
+                    # The databases are stored by content, only their
+                    # manifests need to be renamed
+                    engine.write(
+                        "update_files_binary",
+                        query.project,
+                        query.old_name,
+                        query.new_name,
+                    )
+                    self.parent().rename_sessions(
+                        query.project, query.old_name, query.new_name
+                    )
+                    self.parent().forget_ticks(query.project, query.old_name)
 
                     self.parent().db_update_lock.release()
                 else:
                     self._logger.info("Skipping rename due to snapshot lock")
 
         # Resend an updated list of binary names since it just changed
-        binaries = self.parent().storage.select_binaries(query.project)
-        self.send_packet(RenameBinary.Reply(query, binaries, db_update_locked))
+        d = self.parent().engine.read("select_binaries", query.project)
+        self._reply_in_order(
+            query,
+            d,
+            lambda binaries: RenameBinary.Reply(
+                query, binaries, db_update_locked
+            ),
+        )
 
     def _handle_list_projects(self, query):
         self._logger.info("Got list projects request")
-        projects = self.parent().storage.select_projects()
-        self.send_packet(ListProjects.Reply(query, projects))
+        d = self.parent().engine.read("select_projects")
+        self._reply_in_order(query, d, partial(ListProjects.Reply, query))
 
     def _handle_list_binaries(self, query):
         self._logger.info("Got list binaries request")
-        binaries = self.parent().storage.select_binaries(query.project)
-        self.send_packet(ListBinaries.Reply(query, binaries))
+        d = self.parent().engine.read("select_binaries", query.project)
+        self._reply_in_order(query, d, partial(ListBinaries.Reply, query))
 
     def _handle_list_snapshots(self, query):
         self._logger.info("Got list snapshots request")
-        snapshots = self.parent().storage.select_snapshots(query.project, query.binary)
-        for snapshot in snapshots:
-            snapshot_info = snapshot.project, snapshot.binary, snapshot.name
-            file_name = "%s_%s_%s.idb" % (snapshot_info)
-            file_path = self.parent().server_file(file_name)
-            if os.path.isfile(file_path):
-                snapshot.tick = self.parent().storage.last_tick(*snapshot_info)
-            else:
-                snapshot.tick = -1
-        self.send_packet(ListSnapshots.Reply(query, snapshots))
+        d = PacketDeferred()
+
+        def read_snapshots(storage, project, binary):
+            files = storage.select_files(project, binary)
+            names = set(result["snapshot"] for result in files)
+            return storage.select_snapshots(project, binary), names
+
+        def snapshots_read(result):
+            ticks = self.parent().last_ticks(query.project, query.binary)
+            ticks.add_callback(partial(ticks_read, *result))
+            ticks.add_errback(d.errback)
+
+        def ticks_read(snapshots, names, ticks):
+            for snapshot in snapshots:
+                if snapshot.name in names:
+                    snapshot.tick = ticks.get(snapshot.name, 0)
+                else:
+                    snapshot.tick = -1
+            d.callback(ListSnapshots.Reply(query, snapshots))
+
+        read = self.parent().engine.read(
+            read_snapshots, query.project, query.binary
+        )
+        read.add_callback(snapshots_read)
+        read.add_errback(d.errback)
+        self._reply_in_order(query, d, lambda reply: reply)
 
     def _handle_create_project(self, query):
-        self.parent().storage.insert_project(query.project)
-        self.send_packet(CreateProject.Reply(query))
+        d = self.parent().engine.write("insert_project", query.project)
+        self._reply_in_order(query, d, lambda _: CreateProject.Reply(query))
 
     def _handle_create_binary(self, query):
-        self.parent().storage.insert_binary(query.binary)
-        self.send_packet(CreateBinary.Reply(query))
+        d = self.parent().engine.write("insert_binary", query.binary)
+        self._reply_in_order(query, d, lambda _: CreateBinary.Reply(query))
 
     def _handle_create_snapshot(self, query):
-        self.parent().storage.insert_snapshot(query.snapshot)
-        self.send_packet(CreateSnapshot.Reply(query))
+        d = self.parent().engine.write("insert_snapshot", query.snapshot)
+        self._reply_in_order(query, d, lambda _: CreateSnapshot.Reply(query))
+
+    def _refusal(self, query, reason):
+        """Get the reply telling that a query can never succeed."""
+        self._logger.warning(reason)
+        return RefuseQuery(query, reason)
+
+    def _refuse(self, query, reason):
+        """Tell the client that its query can never succeed."""
+        self._reply(self._refusal(query, reason))
+
+    def _read_snapshot(self, query):
+        """
+        Read the snapshot targeted by a query, and its database file if any,
+        on a reader thread. The deferred fires with both, the snapshot being
+        None if it doesn't exist.
+        """
+
+        def read(storage, project, binary, name):
+            snapshot = storage.select_snapshot(project, binary, name)
+            if not snapshot:
+                return None, None
+            return snapshot, storage.select_file(project, binary, name)
+
+        return self.parent().engine.read(
+            read, query.project, query.binary, query.snapshot
+        )
 
     def _handle_upload_file(self, query):
-        snapshot = self.parent().storage.select_snapshot(
-            query.project, query.binary, query.snapshot
+        # The older clients send the whole database in a single query
+        if not self.chunked_files:
+            self._refuse(query, "Chunked file transfers weren't negotiated")
+            return
+        file_name = "%s_%s_%s.idb" % (
+            query.project,
+            query.binary,
+            query.snapshot,
         )
-        file_name = "%s_%s_%s.idb" % (query.project, snapshot.binary, snapshot.name)
-        file_path = self.parent().server_file(file_name)
+        if not is_transfer_id(query.transfer):
+            self._refuse(query, "Invalid transfer: %s" % query.transfer)
+            return
+        if query.codec not in FILE_CODECS:
+            self._refuse(query, "Unsupported codec: %s" % query.codec)
+            return
 
-        # Write the file received to disk
-        decompressed_content = bz2.decompress(query.content)
-        with open(file_path, "wb") as output_file:
-            output_file.write(decompressed_content)
+        if query.transfer in self._storing:
+            return  # Already complete, the reply will follow
+
+        # Append the chunk to the spool, and store it once complete. The
+        # snapshot is only checked then, the chunks must be spooled in order
+        spool_name = "%s.%s.part" % (file_name, query.transfer)
+        spool = Spool(self.parent().server_file(spool_name))
+        if not spool.write(query.offset, query.content, query.checksum):
+            self._reply(UpdateFile.Reply(query, spool.offset, False))
+            return
+        if not query.final:
+            self._reply(UpdateFile.Reply(query, spool.offset, False))
+            return
+
+        self._storing.add(query.transfer)
+        d = PacketDeferred()
+        read = self._read_snapshot(query)
+        read.add_callback(partial(self._upload_snapshot_read, query, spool, d))
+        read.add_errback(d.errback)
+        self._reply_in_order(
+            query,
+            d,
+            lambda reply: reply,
+            partial(self._file_not_stored, query, spool),
+        )
+
+    def _upload_snapshot_read(self, query, spool, d, result):
+        snapshot = result[0]
+        if not snapshot:
+            self._storing.discard(query.transfer)
+            spool.discard()
+            d.callback(self._refusal(query, "No snapshot %s" % query.snapshot))
+            return
+        snapshot_info = query.project, snapshot.binary, snapshot.name
+
+        def chunks_written(result):
+            # Commit it on the writer thread, after the other writes
+            manifest, sizes = result
+            stored = self.parent().write_files(
+                "store_file", *(snapshot_info + (manifest, sizes))
+            )
+            stored.add_callback(
+                lambda result: d.callback(
+                    self._file_stored(query, spool, snapshot_info, result)
+                )
+            )
+            stored.add_errback(d.errback)
+
+        # Decompress and split it into chunks on a worker thread
+        blocks = spool.blocks(get_file_codec(query.codec))
+        written = self.parent().workers.submit(
+            self.parent().chunk_store.write_chunks, chunk_stream(blocks)
+        )
+        written.add_callback(chunks_written)
+        written.add_errback(d.errback)
+
+    def _file_stored(self, query, spool, snapshot_info, result):
+        self._storing.discard(query.transfer)
+        spool.discard()
+        missing, unused = result
+        self.parent().release_digests(unused)
+        file_name = "%s_%s_%s.idb" % snapshot_info
+        if missing:
+            # Some chunks were deleted in the meantime, start over
+            self._logger.warning("Couldn't save file %s" % file_name)
+            return UpdateFile.Reply(query, 0, False)
         self._logger.info("Saved file %s" % file_name)
-        self.send_packet(UpdateFile.Reply(query))
+        return UpdateFile.Reply(query, 0, True)
+
+    def _file_not_stored(self, query, spool, error):
+        self._storing.discard(query.transfer)
+        spool.discard()
+        self._logger.warning("Couldn't save file: %s" % error)
+        return UpdateFile.Reply(query, 0, False)
 
     def _handle_download_file(self, query):
-        snapshot = self.parent().storage.select_snapshot(
-            query.project, query.binary, query.snapshot
+        if not self.chunked_files:
+            self._refuse(query, "Chunked file transfers weren't negotiated")
+            return
+        if not is_transfer_id(query.transfer):
+            self._refuse(query, "Invalid transfer: %s" % query.transfer)
+            return
+        d = PacketDeferred()
+        read = self._read_snapshot(query)
+        read.add_callback(partial(self._download_snapshot_read, query, d))
+        read.add_errback(d.errback)
+        self._reply_in_order(query, d, lambda reply: reply)
+
+    def _download_snapshot_read(self, query, d, result):
+        snapshot, result = result
+        if not snapshot:
+            d.callback(self._refusal(query, "No snapshot %s" % query.snapshot))
+            return
+        snapshot_info = query.project, snapshot.binary, snapshot.name
+        file_name = "%s_%s_%s.idb" % snapshot_info
+        if not result:
+            d.callback(
+                self._refusal(query, "No file for snapshot %s" % file_name)
+            )
+            return
+
+        # Read the chunk at the requested offset on a worker thread
+        source = self.parent().transfer_cache.open(
+            result["hash"],
+            result["size"],
+            partial(
+                ChunkReader, self.parent().chunk_store, result["manifest"]
+            ),
+            self.transfer_codec,
+        )
+        job = self.parent().workers.submit(source.read, query.offset)
+        job.add_callback(
+            lambda result: d.callback(
+                self._file_chunk_read(query, source, file_name, result)
+            )
+        )
+        job.add_errback(
+            partial(self._file_chunk_not_read, query, source, snapshot_info, d)
+        )
+
+    def _file_chunk_read(self, query, source, file_name, result):
+        data, final = result
+        reply = DownloadFile.Reply(
+            query,
+            query.offset,
+            checksum(data),
+            final,
+            source.tag,
+            source.position,
+            source.size,
+            source.codec.name,
         )
-        file_name = "%s_%s_%s.idb" % (query.project, snapshot.binary, snapshot.name)
-        file_path = self.parent().server_file(file_name)
+        reply.content = data
+        if final and data:
+            self._logger.info("Loaded file %s" % file_name)
+        return reply
+
+    def _file_chunk_not_read(self, query, source, snapshot_info, d, error):
+        def file_read(result):
+            if not result:
+                d.callback(RefuseQuery(query, "File was deleted: %s" % error))
+                return
+            tag = Source.make_tag(result["hash"], source.codec)
+            if tag == source.tag:
+                d.callback(
+                    RefuseQuery(query, "Couldn't read file: %s" % error)
+                )
+                return
+            # Make the client start over with the new file
+            reply = DownloadFile.Reply(
+                query,
+                query.offset,
+                checksum(b""),
+                False,
+                tag,
+                0,
+                result["size"],
+                source.codec.name,
+            )
+            reply.content = b""
+            d.callback(reply)
 
-        # Read file from disk and sent it
-        reply = DownloadFile.Reply(query)
-        with open(file_path, "rb") as input_file:
-            uncompressed_content = input_file.read()
-        reply.content = bz2.compress(uncompressed_content)
-        self._logger.info("Loaded file %s" % file_name)
-        self.send_packet(reply)
+        # The file may have been replaced while we were reading it
+        read = self.parent().engine.read("select_file", *snapshot_info)
+        read.add_callback(file_read)
+        read.add_errback(d.errback)
+
+    def _handle_upload_manifest(self, query):
+        if not self.delta:
+            self._refuse(query, "Delta transfers weren't negotiated")
+            return
+        manifest = bytes(query.content)
+        if len(manifest) % ENTRY.size:
+            self._refuse(query, "Invalid manifest for %s" % query.snapshot)
+            return
+        d = PacketDeferred()
+
+        def snapshot_read(result):
+            snapshot = result[0]
+            if not snapshot:
+                d.callback(
+                    self._refusal(query, "No snapshot %s" % query.snapshot)
+                )
+                return
+            snapshot_info = query.project, snapshot.binary, snapshot.name
+            # Commit the manifest, unless we are missing some of its chunks
+            stored = self.parent().write_files(
+                "store_file", *(snapshot_info + (manifest,))
+            )
+            stored.add_callback(partial(file_stored, snapshot_info))
+            stored.add_errback(d.errback)
+
+        def file_stored(snapshot_info, result):
+            missing, unused = result
+            self.parent().release_digests(unused)
+            reply = UploadManifest.Reply(query, not missing)
+            reply.content = b"".join(missing)
+            if not missing:
+                self._logger.info("Saved file %s_%s_%s.idb" % snapshot_info)
+            d.callback(reply)
+
+        read = self._read_snapshot(query)
+        read.add_callback(snapshot_read)
+        read.add_errback(d.errback)
+        self._reply_in_order(query, d, lambda reply: reply)
+
+    def _handle_upload_chunks(self, query):
+        if not self.delta:
+            self._refuse(query, "Delta transfers weren't negotiated")
+            return
+        if query.codec not in FILE_CODECS:
+            self._refuse(query, "Unsupported codec: %s" % query.codec)
+            return
+
+        def write_chunks(content, sizes, codec):
+            chunks = unpack_chunks(content, sizes, codec)
+            return self.parent().chunk_store.write_chunks(chunks)
+
+        def chunks_written(result):
+            # Record them on the writer thread, the reply can be sent now:
+            # the manifest is committed after them
+            d = self.parent().write_files("add_chunks", result[1])
+            d.add_errback(self._logger.exception)
+            return UploadChunks.Reply(query)
+
+        def chunks_not_written(error):
+            # The chunks will be reported missing again
+            self._logger.warning("Invalid chunks: %s" % error)
+            return UploadChunks.Reply(query)
+
+        # Decompress and write the chunks on a worker thread
+        codec = get_file_codec(query.codec)
+        d = self.parent().workers.submit(
+            write_chunks, query.content, query.sizes, codec
+        )
+        self._reply_in_order(query, d, chunks_written, chunks_not_written)
+
+    def _handle_download_manifest(self, query):
+        if not self.delta:
+            self._refuse(query, "Delta transfers weren't negotiated")
+            return
+        def snapshot_read(result):
+            snapshot, result = result
+            if not snapshot:
+                return self._refusal(query, "No snapshot %s" % query.snapshot)
+            reply = DownloadManifest.Reply(
+                query, result["hash"] if result else None
+            )
+            reply.content = result["manifest"] if result else b""
+            return reply
+
+        d = self._read_snapshot(query)
+        self._reply_in_order(query, d, snapshot_read)
+
+    def _handle_download_chunks(self, query):
+        if not self.delta:
+            self._refuse(query, "Delta transfers weren't negotiated")
+            return
+        d = PacketDeferred()
+
+        def snapshot_read(result):
+            snapshot, result = result
+            if not snapshot:
+                d.callback(
+                    self._refusal(query, "No snapshot %s" % query.snapshot)
+                )
+                return
+            digest = result["hash"] if result else None
+            reply = DownloadChunks.Reply(
+                query, digest, self.transfer_codec.name
+            )
+            reply.content = b""
+            # Only send the chunks if the database didn't change meanwhile
+            available = set()
+            if digest and digest == query.digest:
+                available = set(
+                    chunk.hex()
+                    for chunk, _ in read_manifest(result["manifest"])
+                )
+            if not available or not all(
+                chunk in available for chunk in query.chunks
+            ):
+                d.callback(reply)
+                return
+
+            # Read and compress the chunks on a worker thread
+            job = self.parent().workers.submit(
+                read_chunks, query.chunks, self.transfer_codec
+            )
+            job.add_callback(partial(chunks_read, reply))
+            job.add_errback(d.errback)
+
+        def read_chunks(chunks, codec):
+            chunk_store = self.parent().chunk_store
+            chunks = [chunk_store.read_chunk(chunk) for chunk in chunks]
+            return pack_chunks(chunks, codec)
+
+        def chunks_read(reply, content):
+            reply.content = content
+            d.callback(reply)
+
+        read = self._read_snapshot(query)
+        read.add_callback(snapshot_read)
+        read.add_errback(d.errback)
+        self._reply_in_order(query, d, lambda reply: reply)
+
+    def _reply_in_order(self, query, d, callback, errback=None):
+        """
+        Send the reply returned by the callback, or the errback, of a job
+        of the worker pool once it completes. The replies are sent in the
+        order of the queries, whatever the order the jobs complete in, so
+        all the replies must be sent through this method or _reply().
+        Without an errback, the query of a job that failed is refused.
+        """
+        slot = [False, None]
+        self._replies.append(slot)
+
+        def done(reply):
+            slot[:] = [True, reply]
+            self._send_replies()
+
+        def failed(error):
+            if errback:
+                done(errback(error))
+            else:
+                self._logger.warning("Job failed: %s" % error)
+                done(RefuseQuery(query, "Job failed: %s" % error))
+
+        d.add_callback(lambda result: done(callback(result)))
+        d.add_errback(failed)
+
+    def _reply(self, reply):
+        """Send a reply after the replies to the previous queries."""
+        self._replies.append([True, reply])
+        self._send_replies()
+
+    def _send_replies(self):
+        while self._replies and self._replies[0][0]:
+            reply = self._replies.popleft()[1]
+            if reply is not None:
+                self.send_packet(reply)
 
     def _handle_join_session(self, packet):
+        self._reset_resync()
+        self.parent().unsubscribe(self)
         self._project = packet.project
         self._binary = packet.binary
         self._snapshot = packet.snapshot
         self._name = packet.name
         self._color = packet.color
         self._ea = packet.ea
+        self.parent().subscribe(self)
 
         # Inform the other users that we joined
         packet.silent = False
@@ -317,19 +975,15 @@ class ServerClient(ClientSocket):
             )
 
         # Send all missed events
-        events = self.parent().storage.select_events(
-            self._project, self._binary, self._snapshot, packet.tick
-        )
-        self._logger.debug("Sending %d missed events..." % len(events))
-        for event in events:
-            self.send_packet(event)
-        self._logger.debug("Done sending %d missed events" % len(events))
+        self._catch_up(packet.tick)
 
     def _handle_leave_session(self, packet):
         # Inform others users that we are leaving
         packet.silent = False
         self.parent().forward_users(self, packet)
 
+        self._reset_resync()
+        self.parent().unsubscribe(self)
         self._project = None
         self._binary = None
         self._snapshot = None
@@ -354,71 +1008,106 @@ class ServerClient(ClientSocket):
     def _handle_update_user_color(self, packet):
         self.parent().forward_users(self, packet)
 
-    def _delete_project_files(self, project):
-        binaries = self.parent().storage.select_binaries(project)
-        for binary in binaries:
-            self._delete_binary_files(project, binary.name)
-
-    def _delete_binary_files(self, project, binary):
-        snapshots = self.parent().storage.select_snapshots(project, binary)
-        for db in snapshots:
-            self._delete_snapshot_files(project, binary, db.name)
-
-    def _delete_snapshot_files(self, project, binary, snapshot):
-        file_name = "%s_%s_%s.idb" % (project, binary, snapshot)
-        file_path = self.parent().server_file(file_name)
-        try:
-            os.remove(file_path)
-        except FileNotFoundError:
-            pass
-
     def _handle_delete_project(self, packet):
         def match_project(user, project):
             return user.project == project
 
-        if  len(self.parent().get_users(self,partial(match_project, project=packet.project))):
-            self.send_packet(DeleteProject.Reply(packet, False))
+        if len(
+            self.parent().get_users(
+                self, partial(match_project, project=packet.project)
+            )
+        ):
+            self._reply(DeleteProject.Reply(packet, False))
         else:
-            self._delete_project_files(packet.project)
-            self.parent().storage.delete_project(packet.project)
+            self.parent().delete_files(packet.project)
+            d = self.parent().engine.write("delete_project", packet.project)
+            self.parent().forget_ticks(packet.project)
             # self.parent().forward_users(self,packet,partial(match_project,project=packet.project))
-            self.send_packet(DeleteProject.Reply(packet, True))
+            self._reply_in_order(
+                packet, d, lambda _: DeleteProject.Reply(packet, True)
+            )
 
-    def _handle_delete_binary(self,packet):
+    def _handle_delete_binary(self, packet):
         def match_user(user, project, binary):
             return user.project == project and user.binary == binary
 
-        if  len(self.parent().get_users(self, partial(match_user, project=packet.project, binary=packet.binary))):
-            self.send_packet(DeleteBinary.Reply(packet, False))
+        if len(
+            self.parent().get_users(
+                self,
+                partial(
+                    match_user, project=packet.project, binary=packet.binary
+                ),
+            )
+        ):
+            self._reply(DeleteBinary.Reply(packet, False))
         else:
-            self._delete_binary_files(packet.project, packet.binary)
-            self.parent().storage.delete_binary(packet.project, packet.binary)
+            self.parent().delete_files(packet.project, packet.binary)
+            d = self.parent().engine.write(
+                "delete_binary", packet.project, packet.binary
+            )
+            self.parent().forget_ticks(packet.project, packet.binary)
             # self.parent().forward_users(self,packet,partial(match_user, project=packet.project,binary=packet.binary))
-            self.send_packet(DeleteBinary.Reply(packet, True))
+            self._reply_in_order(
+                packet, d, lambda _: DeleteBinary.Reply(packet, True)
+            )
 
     def _handle_delete_snapshot(self, packet):
         def match_user(user, project, binary, snapshot):
-            return user.project == project and user.binary == binary and user.snapshot == snapshot
+            return (
+                user.project == project
+                and user.binary == binary
+                and user.snapshot == snapshot
+            )
 
-        if len(self.parent().get_users(self,partial(match_user, project=packet.project, binary=packet.binary,snapshot=packet.snapshot))):
-            self.send_packet(DeleteSnapshot.Reply(packet, False))
+        if len(
+            self.parent().get_users(
+                self,
+                partial(
+                    match_user,
+                    project=packet.project,
+                    binary=packet.binary,
+                    snapshot=packet.snapshot,
+                ),
+            )
+        ):
+            self._reply(DeleteSnapshot.Reply(packet, False))
         else:
-            self._delete_snapshot_files(packet.project, packet.binary, packet.snapshot)
-            self.parent().storage.delete_snapshot(packet.project, packet.binary, packet.snapshot)
+            self.parent().delete_files(
+                packet.project, packet.binary, packet.snapshot
+            )
+            d = self.parent().engine.write(
+                "delete_snapshot",
+                packet.project,
+                packet.binary,
+                packet.snapshot,
+            )
+            self.parent().forget_ticks(
+                packet.project, packet.binary, packet.snapshot
+            )
             # self.parent().forward_users(self, packet)
-            self.send_packet(DeleteSnapshot.Reply(packet, True))
+            self._reply_in_order(
+                packet, d, lambda _: DeleteSnapshot.Reply(packet, True)
+            )
+
 
 class Migrate(object):
 
     # This migration typically took ~2h with a database with 140k+ events
     def do1(server):
-        server._logger.warning("Migration do1(), please don't interrupt that process...")
+        server._logger.warning(
+            "Migration do1(), please don't interrupt that process..."
+        )
 
         server._logger.warning("Migration do1(): saving old db...")
         if os.path.exists(server.server_file("database_1.db")):
-            server._logger.error("Migration do1(): database_1.db already exist!")
+            server._logger.error(
+                "Migration do1(): database_1.db already exist!"
+            )
             sys.exit(1)
-        os.rename(server.server_file("database.db"), server.server_file("database_1.db"))
+        os.rename(
+            server.server_file("database.db"),
+            server.server_file("database_1.db"),
+        )
 
         server._logger.warning("Migration do1(): loading old db...")
         old_storage = Storage(server.server_file("database_1.db"))
@@ -452,15 +1141,43 @@ class Migrate(object):
         i = 1
         for row in old_events_rows:
             if i % 1000 == 0:
-                server._logger.warning("Migration do1(): %d events done..." % i)
-            row["snapshot"] = row.pop("database")
-            row["binary"] = row.pop("project")
-            row["project"] = row.pop("group_name")
-            new_storage._insert("events", row)
+                server._logger.warning(
+                    "Migration do1(): %d events done..." % i
+                )
+            new_storage.insert_events(
+                [
+                    (
+                        row["group_name"],
+                        row["project"],
+                        row["database"],
+                        row["tick"],
+                        row["dict"],
+                    )
+                ]
+            )
             i += 1
 
         server._logger.warning("Migration do1(): done")
 
+    # The events are stored once keyed by the id of their snapshot, instead of
+    # repeating the names of its project, binary and snapshot in every row and
+    # in the index of the primary key. This roughly halves the database size.
+    def do2(server):
+        if not os.path.exists(server.server_file("database.db")):
+            return
+        server._logger.warning(
+            "Migration do2(), please don't interrupt that process..."
+        )
+        storage = Storage(server.server_file("database.db"))
+        count = storage.normalize()
+        if count is None:
+            server._logger.warning("Migration do2(): nothing to do")
+        else:
+            server._logger.warning(
+                "Migration do2(): %d events converted" % count
+            )
+
+
 class Server(ServerSocket):
     """
     This class represents a server socket for the server. It is used by both
@@ -468,11 +1185,14 @@ class Server(ServerSocket):
     """
 
     SNAPSHOT_INTERVAL = 0  # ticks
+    TRANSFER_TIMEOUT = 600  # s
 
     def __init__(self, logger, parent=None, level=None):
         ServerSocket.__init__(self, logger, parent)
         self._ssl = None
         self._clients = []
+        # The clients subscribed to each (project, binary, snapshot)
+        self._sessions = {}
 
         # Load the configuration
         self._config_path = self.server_file("config_server.json")
@@ -487,11 +1207,35 @@ class Server(ServerSocket):
         # Check if any migration
         self.migrate()
 
-        # Initialize the storage
-        self._storage = Storage(self.server_file("database.db"))
-        self._storage.initialize()
+        # Initialize the storage, whose queries run on their own threads
+        self._engine = StorageEngine(
+            self.server_file("database.db"),
+            logger,
+            self._config["storage"],
+            self,
+            self._events_dropped,
+        )
+        self._storage = self._engine.storage
+
+        # Initialize the store of the databases
+        self._chunk_store = ChunkStore(
+            self.server_file("chunks"), self._storage
+        )
+        self._chunk_store.collect_garbage()
+        self.import_files()
 
         self._discovery = ClientsDiscovery(logger)
+        # The threads running the blocking jobs
+        self._workers = WorkerPool(logger, self._config["workers"], self)
+        # The compressed files being downloaded
+        self._transfer_cache = TransferCache(
+            self.server_file("cache"), self.TRANSFER_TIMEOUT
+        )
+        self._transfer_cache.collect_garbage(
+            lambda digest: self._storage.count_files(digest) > 0
+        )
+        # The last tick of each snapshot, loaded from the database once
+        self._ticks = {}
         # A temporory lock to stop clients while updating other locks
         self.client_lock = threading.Lock()
         # A long term lock that stops breaking database updates when multiple
@@ -510,6 +1254,118 @@ class Server(ServerSocket):
     def storage(self):
         return self._storage
 
+    @property
+    def engine(self):
+        return self._engine
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def chunk_store(self):
+        return self._chunk_store
+
+    @property
+    def transfer_cache(self):
+        return self._transfer_cache
+
+    def import_files(self):
+        """Move the databases stored as plain files into the chunk store."""
+        for snapshot in self._storage.select_snapshots():
+            snapshot_info = snapshot.project, snapshot.binary, snapshot.name
+            file_path = self.server_file("%s_%s_%s.idb" % snapshot_info)
+            if not os.path.isfile(file_path):
+                continue
+            self._logger.info("Importing file %s" % file_path)
+            self._chunk_store.import_file(*(snapshot_info + (file_path,)))
+            # The compressed copies cached by the previous versions
+            for path in glob.glob(glob.escape(file_path) + ".*.cache*"):
+                os.remove(path)
+
+    def write_files(self, method, *args):
+        """
+        Call a method of the chunk store on the writer thread of the storage
+        engine, after the writes submitted before. The event loop mustn't
+        write itself, it would compete with that thread for the database.
+        """
+
+        def write(storage):
+            return getattr(self._chunk_store.using(storage), method)(*args)
+
+        return self._engine.write(write)
+
+    def delete_files(self, project, binary=None, snapshot=None):
+        """Delete the databases of a project, binary or snapshot."""
+        d = self.write_files("delete_files", project, binary, snapshot)
+        d.add_callback(self.release_digests)
+        d.add_errback(self._logger.exception)
+
+    def release_digests(self, digests):
+        """Forget about the databases that no snapshot has anymore."""
+        for digest in digests:
+            self._transfer_cache.invalidate(digest)
+
+    def last_tick(self, project, binary, snapshot):
+        """
+        Get a deferred firing with the last tick of a snapshot. It is only
+        read from the database the first time, then it is advanced as the
+        events are inserted.
+        """
+        key = (project, binary, snapshot)
+        d = PacketDeferred()
+        if key in self._ticks:
+            d.callback(self._ticks[key])
+            return d
+
+        def tick_read(tick):
+            # Another read may have completed first
+            d.callback(self._ticks.setdefault(key, tick))
+
+        read = self._engine.read("last_tick", *key)
+        read.add_callback(tick_read)
+        read.add_errback(d.errback)
+        return d
+
+    def last_ticks(self, project, binary):
+        """Get a deferred firing with the last ticks of the snapshots."""
+        d = PacketDeferred()
+
+        def ticks_read(ticks):
+            for name in ticks:
+                key = (project, binary, name)
+                ticks[name] = self._ticks.setdefault(key, ticks[name])
+            d.callback(ticks)
+
+        read = self._engine.read("last_ticks", project, binary)
+        read.add_callback(ticks_read)
+        read.add_errback(d.errback)
+        return d
+
+    def insert_event(self, client, event):
+        """Save an event into the snapshot the client is subscribed to."""
+        self._engine.insert_event(client, event)
+        self._ticks[client.session] = event.tick
+
+    def _events_dropped(self, snapshots):
+        """
+        Called when the events of snapshots that don't exist were dropped by
+        the database. Their last ticks will be read from it again.
+        """
+        for key in snapshots:
+            self._logger.warning("Dropped the events of %s/%s/%s" % key)
+            self._ticks.pop(key, None)
+
+    def forget_ticks(self, project, binary=None, snapshot=None):
+        """Forget the last ticks of the snapshots deleted or renamed."""
+        for key in list(self._ticks):
+            if (
+                key[0] == project
+                and binary in (None, key[1])
+                and snapshot in (None, key[2])
+            ):
+                del self._ticks[key]
+
     @property
     def host(self):
         return self._socket.getsockname()[0]
@@ -527,10 +1383,29 @@ class Server(ServerSocket):
         return {
             "level": logging.INFO,
             "migration": -1,
+            "socket": ClientSocket.default_config(),
+            "resync_timeout": 30,  # s
+            # The events read at once when a client catches up
+            "catch_up_page": 1024,  # events
+            # Relay the events without parsing them, only decoding their tick
+            "passthrough": True,
+            # The threads running the file I/O and (de)compression jobs
+            "workers": WorkerPool.default_config(),
+            # The durability and the group commits of the events
+            "storage": StorageEngine.default_config(),
+            # The codecs and levels used to compress the transferred files
+            "transfer": {
+                "codecs": ["zstd", "lz4", "zlib", "lzma", "bz2"],
+                "levels": {},
+            },
         }
 
     def migrate(self):
         migrationId = self.config["migration"]
+        # The databases created since do1() have its schema, but the servers
+        # that never had to migrate don't record it
+        if migrationId < 0 and os.path.exists(self.server_file("database.db")):
+            migrationId = 1
         while migrationId >= 0:
             migrationId += 1
             method_name = "do%d" % migrationId
@@ -557,6 +1432,21 @@ class Server(ServerSocket):
                 return
             self._logger.debug("Loaded config: %s" % self._config)
 
+        # Gracefully handle older configs with missing socket, transfer,
+        # workers or storage options
+        socket_config = ClientSocket.default_config()
+        socket_config.update(self._config["socket"])
+        self._config["socket"] = socket_config
+        transfer_config = self.default_config()["transfer"]
+        transfer_config.update(self._config["transfer"])
+        self._config["transfer"] = transfer_config
+        workers_config = WorkerPool.default_config()
+        workers_config.update(self._config["workers"])
+        self._config["workers"] = workers_config
+        storage_config = StorageEngine.default_config()
+        storage_config.update(self._config["storage"])
+        self._config["storage"] = storage_config
+
     def save_config(self):
         """Save the configuration file."""
         self._config["level"] = self._logger.level
@@ -578,6 +1468,15 @@ class Server(ServerSocket):
         # Create, bind and set the socket options
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # The buffer sizes must be set before listening to be inherited by
+        # the accepted sockets, and taken into account for the TCP window
+        socket_config = self._config["socket"]
+        if socket_config["rcvbuf"]:
+            rcvbuf = socket_config["rcvbuf"]
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if socket_config["sndbuf"]:
+            sndbuf = socket_config["sndbuf"]
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
         try:
             sock.bind((host, port))
         except socket.error as e:
@@ -602,6 +1501,8 @@ class Server(ServerSocket):
         for client in list(self._clients):
             client.disconnect(notify=False)
         self.disconnect()
+        self._engine.close()
+        self._transfer_cache.prune(everything=True)
         try:
             self.db_update_lock.release()
         except RuntimeError:
@@ -630,11 +1531,32 @@ class Server(ServerSocket):
         if len(self._clients) == 1:
             self.db_update_lock.acquire()
         client.wrap_socket(sock)
+        socket_config = self._config["socket"]
+        client.set_socket_options(
+            socket_config["rcvbuf"],
+            socket_config["sndbuf"],
+            socket_config["nodelay"],
+        )
+        client.set_read_budget(
+            socket_config["read_time"], socket_config["read_size"]
+        )
+        client.set_watermarks(
+            socket_config["high_watermark"], socket_config["low_watermark"]
+        )
+        client.set_query_limits(
+            socket_config["query_timeout"], socket_config["max_in_flight"]
+        )
+        client.set_passthrough(self._config["passthrough"])
+        transfer_config = self._config["transfer"]
+        client.set_transfer_codecs(
+            transfer_config["codecs"], transfer_config["levels"]
+        )
         self._clients.append(client)
         self.client_lock.release()
 
     def reject(self, client):
         """Called when a user disconnects."""
+        self.unsubscribe(client)
 
         # Allow clients to update database again
         self.client_lock.acquire()
@@ -647,24 +1569,48 @@ class Server(ServerSocket):
 
         self.client_lock.release()
 
-    def get_users(self, client, matches=None):
-        """Get the other users on the same snapshot."""
-        users = []
-        for user in self._clients:
-            if (matches is None and
-                (user.binary != client.binary
-                or user.snapshot != client.snapshot)
-            ):
-                continue
-            if user == client or (matches and not matches(user)):
+    def subscribe(self, client):
+        """Add a client to the index of the session it joined."""
+        if client.session:
+            self._sessions.setdefault(client.session, {})[client] = None
+
+    def unsubscribe(self, client):
+        """Remove a client from the index of the session it left."""
+        session = self._sessions.get(client.session)
+        if session is not None:
+            session.pop(client, None)
+            if not session:
+                del self._sessions[client.session]
+
+    def rename_sessions(self, project, old_name, new_name):
+        """Move the clients subscribed to a binary that was renamed."""
+        for key in list(self._sessions):
+            if key[0] != project or key[1] != old_name:
                 continue
-            users.append(user)
-        return users
+            for client in self._sessions.pop(key):
+                client.rename_binary(new_name)
+                self.subscribe(client)
+
+    def get_users(self, client, matches=None):
+        """
+        Get the other users on the same snapshot, or the other users that
+        match the given predicate, whatever their snapshot.
+        """
+        if matches is None:
+            session = self._sessions.get(client.session, ())
+            return [user for user in session if user is not client]
+        return [
+            user
+            for user in self._clients
+            if user is not client and matches(user)
+        ]
 
     def forward_users(self, client, packet, matches=None):
         """Sends the packet to the other users on the same snapshot."""
+        # The packet is only encoded once for all the users
+        frames = {}
         for user in self.get_users(client, matches):
-            user.send_packet(packet)
+            user.send_packet(packet, frames)
 
     def server_file(self, filename):
         """Get the absolute path of a local resource."""
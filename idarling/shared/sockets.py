@@ -12,18 +12,45 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import collections
 import errno
-import json
+import ipaddress
+import itertools
 import os
 import socket
 import ssl
+import struct
 import sys
+import time
+from functools import partial
 
-from PyQt5.QtCore import QCoreApplication, QEvent, QObject, QSocketNotifier
+from PyQt5.QtCore import (
+    QCoreApplication,
+    QEvent,
+    QObject,
+    QSocketNotifier,
+    QTimer,
+)
 
-from .packets import Container, Packet, PacketDeferred, Query, Reply
-from ..shared.commands import (
-    UpdateLocation,
+from .codecs import codec_names, get_codec, JsonCodec
+from .compression import (
+    compression_names,
+    file_codec_names,
+    get_compression,
+    get_file_codec,
+)
+from .packets import (
+    ConnectionLostError,
+    Container,
+    Packet,
+    PacketDeferred,
+    PacketFactory,
+    Query,
+    QueryCancelledError,
+    QueryRefusedError,
+    QueryTimeoutError,
+    RawEvent,
+    Reply,
 )
+from ..shared.commands import Handshake, RefuseQuery, UpdateLocation
 
 class PacketEvent(QEvent):
     """
@@ -42,9 +69,64 @@ class ClientSocket(QObject):
     This class is acts a bridge between a client socket and the Qt event loop.
     By using a QSocketNotifier, we can be notified when some data is ready to
     be read or written on the socket, not requiring an extra thread.
+
+    Two framings are supported on the wire. The legacy one sends each packet
+    as a line of JSON, directly followed by the raw content of containers.
+    The binary one sends frames made of a fixed header (the payload length
+    and the frame type) followed by the payload, serialized using a codec.
+    They are only used once both parties agreed on them during the handshake.
+
+    With the binary framing, the packets can also be compressed using a
+    stream compression, with one context per direction. The content of the
+    containers isn't compressed, as the files are compressed beforehand.
+
+    The binary framing also allows the outgoing packets to be scheduled by
+    priority class (control, events and bulk). The content of the containers
+    is sent in chunks, interleaved with the other packets, so that large
+    transfers don't stall the rest of the traffic.
     """
 
-    MAX_DATA_SIZE = 65535
+    MAX_DATA_SIZE = 256 * 1024
+
+    # Incoming data is read until none is left, or until a budget is spent
+    READ_TIME = 50  # ms
+    READ_SIZE = 4 * 1024 * 1024
+    DOWNBACK_INTERVAL = 0.1  # s
+
+    # Watermarks of the outgoing queue, not counting the content of
+    # containers as it is sent from the packet without being copied
+    HIGH_WATERMARK = 8 * 1024 * 1024
+    LOW_WATERMARK = 1024 * 1024
+
+    # Outgoing packets are coalesced into writes of at most this size
+    MAX_WRITE_SIZE = 256 * 1024
+    MAX_WRITE_BUFFERS = 512
+    TLS_RECORD_SIZE = 16 * 1024
+
+    # Binary framing: each frame starts with its payload length and its type
+    FRAME_HEADER = struct.Struct("!IB")
+    FRAME_PACKET = 1  # The payload is a serialized packet
+    FRAME_CONTENT = 2  # The payload is a stream id, then container content
+    FRAME_COMPRESSED = 3  # The payload is a compressed serialized packet
+    STREAM_HEADER = struct.Struct("!I")
+    MAX_FRAME_SIZE = 64 * 1024 * 1024
+    CONTENT_CHUNK_SIZE = 256 * 1024
+
+    # Priority classes of the outgoing packets, scheduled using a deficit
+    # round robin: each class can send its weight times the quantum per round
+    PRIORITY_CONTROL = 0  # Packets that aren't ordered, except containers
+    PRIORITY_EVENTS = 1  # Events, and the packets ordered with them
+    PRIORITY_BULK = 2  # Containers that aren't ordered
+    PRIORITY_WEIGHTS = (8, 4, 1)
+    SCHEDULER_QUANTUM = 64 * 1024
+
+    HANDSHAKE_TIMEOUT = 5000  # ms
+    # The file codec used if none was negotiated
+    TRANSFER_CODEC = "zlib"
+
+    # Queries fail if nothing was sent or received for them for too long
+    QUERY_TIMEOUT = 60  # s
+    MAX_IN_FLIGHT = 4  # per command type
 
     def __init__(self, logger, parent=None):
         QObject.__init__(self, parent)
@@ -53,23 +135,118 @@ class ClientSocket(QObject):
         self._server = parent and isinstance(parent, ServerSocket)
 
         self._read_buffer = bytearray()
+        self._read_chunk = bytearray(ClientSocket.MAX_DATA_SIZE)
+        self._read_cursor = 0
+        self._read_time = ClientSocket.READ_TIME / 1000.0
+        self._read_size = ClientSocket.READ_SIZE
+        self._downback_time = 0
         self._read_notifier = None
         self._read_packet = None
+        self._read_streams = {}
 
-        self._write_buffer = bytearray()
-        self._write_cursor = 0
+        self._write_views = collections.deque()
+        self._write_size = 0
+        self._write_progress = {}
         self._write_notifier = None
-        self._write_packet = None
+        self._write_stream = 0
+        self._sendmsg = False
 
         self._connected = False
+        self._framed = False
+        self._codec = JsonCodec()
+        self._compression = None
+        self._transfer = (ClientSocket.TRANSFER_CODEC, None)
+        self._transfer_codecs = file_codec_names()
+        self._transfer_levels = {}
+        self._chunked_files = False
+        self._delta = False
+        self._catch_up_progress = False
+        self._passthrough = False
+        self._handshaking = False
+        self._handshake_time = ClientSocket.HANDSHAKE_TIMEOUT
+        self._held = collections.deque()
+        self._handshake_query = None
         self._outgoing = collections.deque()
         self._incoming = collections.deque()
 
+        # The outgoing queue is only used until the binary framing is used
+        weights = ClientSocket.PRIORITY_WEIGHTS
+        self._queues = [collections.deque() for _ in weights]
+        self._deficits = [0 for _ in weights]
+        self._deficits[0] = (
+            ClientSocket.PRIORITY_WEIGHTS[0] * ClientSocket.SCHEDULER_QUANTUM
+        )
+        self._priority = 0
+
+        self._queue_size = 0
+        self._queue_length = 0
+        self._high_watermark = ClientSocket.HIGH_WATERMARK
+        self._low_watermark = ClientSocket.LOW_WATERMARK
+        self._congested_since = None
+        self._locations = {}
+
+        # The queries waiting for a reply, by identifier
+        self._queries = {}
+        self._in_flight = collections.Counter()
+        self._waiting = collections.defaultdict(collections.deque)
+        self._query_timeout = ClientSocket.QUERY_TIMEOUT
+        self._max_in_flight = ClientSocket.MAX_IN_FLIGHT
+        self._query_timer = QTimer(self)
+        self._query_timer.setInterval(1000)
+        self._query_timer.timeout.connect(self._check_queries)
+
     @property
     def connected(self):
         """Is the underlying socket connected?"""
         return self._connected
 
+    @property
+    def framed(self):
+        """Is the binary framing being used?"""
+        return self._framed
+
+    @property
+    def transfer_codec(self):
+        """Get the file codec to use for the databases transfers."""
+        return get_file_codec(*self._transfer)
+
+    @property
+    def handshaking(self):
+        """Are the protocol features still being agreed upon?"""
+        return self._handshaking
+
+    @property
+    def chunked_files(self):
+        """Can the databases be transferred in chunks that can be resumed?"""
+        return self._chunked_files
+
+    @property
+    def delta(self):
+        """Can the databases be transferred as chunk deltas?"""
+        return self._delta
+
+    @property
+    def catch_up_progress(self):
+        """Can the progress of a catch-up be reported to the other party?"""
+        return self._catch_up_progress
+
+    @property
+    def queue_size(self):
+        """How many bytes are waiting to be sent?"""
+        return self._queue_size
+
+    @property
+    def queue_length(self):
+        """How many packets are waiting to be sent?"""
+        return self._queue_length
+
+    @property
+    def congested_for(self):
+        """For how long (in s) has the queue been above the high watermark?"""
+        if self._congested_since is None:
+            return 0
+        return time.time() - self._congested_since
+
     def wrap_socket(self, sock):
         """Sets the underlying socket to use."""
         self._read_notifier = QSocketNotifier(
@@ -84,6 +261,10 @@ class ClientSocket(QObject):
         self._write_notifier.activated.connect(self._notify_write)
         self._write_notifier.setEnabled(True)
 
+        # SSL sockets and Windows don't support scatter/gather writes
+        self._sendmsg = hasattr(sock, "sendmsg") and not isinstance(
+            sock, ssl.SSLSocket
+        )
         self._socket = sock
 
     def disconnect(self, err=None):
@@ -107,6 +288,15 @@ class ClientSocket(QObject):
         self._socket = None
         self._connected = False
 
+        # The pending queries won't ever get a reply, and the waiting ones
+        # must not be sent when the in-flight ones are released
+        self._held.clear()
+        self._waiting.clear()
+        self._in_flight.clear()
+        for query_id in list(self._queries):
+            error = ConnectionLostError("Connection lost")
+            self._fail_query(query_id, error)
+
     def set_keep_alive(self, cnt, intvl, idle):
         """
         Set the TCP keep-alive of the underlying socket.
@@ -141,6 +331,88 @@ class ClientSocket(QObject):
                 sio_keeplive_vals, (1, idle * 1000, intvl * 1000)
             )
 
+    @staticmethod
+    def default_config():
+        """
+        Return the default socket options, as found in the configuration
+        files. The buffer sizes of 0 keep the system defaults, and the read
+        budget is the time (in ms) and the size that can be read at once
+        before giving the control back to the Qt event loop. The handshake
+        timeout (in ms) should be raised for the slowest networks.
+        """
+        return {
+            "rcvbuf": 0,
+            "sndbuf": 0,
+            "nodelay": True,
+            "read_time": ClientSocket.READ_TIME,
+            "read_size": ClientSocket.READ_SIZE,
+            "high_watermark": ClientSocket.HIGH_WATERMARK,
+            "low_watermark": ClientSocket.LOW_WATERMARK,
+            "query_timeout": ClientSocket.QUERY_TIMEOUT,
+            "max_in_flight": ClientSocket.MAX_IN_FLIGHT,
+            "handshake_timeout": ClientSocket.HANDSHAKE_TIMEOUT,
+        }
+
+    def set_socket_options(self, rcvbuf=0, sndbuf=0, nodelay=True):
+        """
+        Set the buffer sizes and the Nagle's algorithm of the underlying
+        socket. Buffer sizes of 0 leave the system defaults untouched.
+        """
+        sock = self._socket
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        nodelay = 1 if nodelay else 0
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, nodelay)
+
+    def set_read_budget(self, read_time, read_size):
+        """
+        Set how long (in ms) and how many bytes can be read from the socket
+        before giving the control back to the Qt event loop.
+        """
+        self._read_time = read_time / 1000.0
+        self._read_size = read_size
+
+    def set_watermarks(self, high_watermark, low_watermark):
+        """
+        Set the watermarks of the outgoing queue. Above the high one, the
+        queue is congested until it goes back below the low one.
+        """
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+
+    def set_transfer_codecs(self, codecs, levels):
+        """
+        Set the file codecs that can be used for the database transfers, by
+        order of preference, and the compression level to use for each.
+        """
+        supported = file_codec_names()
+        self._transfer_codecs = [name for name in codecs if name in supported]
+        self._transfer_levels = levels
+
+    def set_query_limits(self, query_timeout, max_in_flight):
+        """
+        Set after how long (in s) without any progress a query times out,
+        and how many queries of the same type can wait for a reply at once.
+        """
+        self._query_timeout = query_timeout
+        self._max_in_flight = max_in_flight
+
+    def set_handshake_timeout(self, handshake_timeout):
+        """
+        Set how long (in ms) to wait for the handshake reply, before falling
+        back to the default protocol features.
+        """
+        self._handshake_time = handshake_timeout
+
+    def set_passthrough(self, passthrough):
+        """
+        Set whether the events received by the server are relayed without
+        being parsed, only their header being decoded (see RawEvent).
+        """
+        self._passthrough = passthrough and self._server
+
     def _check_socket(self):
         """Check if the connection has been established yet."""
         # Ignore if you're already connected
@@ -156,111 +428,714 @@ class ClientSocket(QObject):
         else:
             self._connected = True
             self._logger.info("Connected")
+            # The client is the one initiating the handshake
+            if not self._server:
+                self._start_handshake()
             return True
 
+    def _handshake_features(self):
+        """
+        Return the protocol features supported by this side, each of them
+        being a list of options ordered by preference.
+        """
+        return {
+            "framing": ["binary", "json"],
+            "codec": codec_names(),
+            "compression": compression_names(),
+            "transfer": self._transfer_codecs,
+            "files": ["chunked"],
+            "delta": ["cdc"],
+            "catch_up": ["progress"],
+        }
+
+    def _is_loopback(self):
+        """Is the other party connected through the loopback interface?"""
+        try:
+            address = self._socket.getpeername()[0]
+            return ipaddress.ip_address(address.split("%")[0]).is_loopback
+        except (socket.error, ValueError, TypeError, IndexError):
+            return False
+
+    def _negotiate(self, offered):
+        """
+        Choose the protocol features to use from the offered ones. The
+        options are picked by our order of preference.
+        """
+        supported = self._handshake_features()
+
+        def choose(name, default):
+            for option in supported[name]:
+                if option in offered.get(name, []):
+                    return option
+            return default
+
+        features = {
+            "framing": choose("framing", "json"),
+            "codec": "json",
+            "compression": "none",
+            "transfer": "none",
+            "files": choose("files", "none"),
+            "delta": choose("delta", "none"),
+            "catch_up": choose("catch_up", "none"),
+        }
+        # The codecs other than JSON require the binary framing
+        if features["framing"] == "binary":
+            features["codec"] = choose("codec", "json")
+            # Compressing is only worth it over an actual network
+            if not self._is_loopback():
+                features["compression"] = choose("compression", "none")
+
+        # The databases don't need to be compressed over the loopback either
+        if not self._is_loopback():
+            transfer = choose("transfer", ClientSocket.TRANSFER_CODEC)
+            features["transfer"] = transfer
+            features["transfer_level"] = self._transfer_levels.get(transfer)
+        return features
+
+    def _apply_features(self, features, names):
+        """
+        Switch to the protocol features that were agreed upon. The names
+        table is the one sent by the client during the handshake.
+        """
+        self._logger.debug("Using protocol features: %s" % features)
+        self._framed = features.get("framing") == "binary"
+        self._codec = get_codec(features.get("codec", "json"), names)
+        if self._framed:
+            self._compression = get_compression(features.get("compression"))
+        transfer = features.get("transfer", ClientSocket.TRANSFER_CODEC)
+        self._transfer = (transfer, features.get("transfer_level"))
+        self._chunked_files = features.get("files") == "chunked"
+        self._delta = features.get("delta") == "cdc"
+        self._catch_up_progress = features.get("catch_up") == "progress"
+
+    def _start_handshake(self):
+        """Send the handshake and hold back other packets until answered."""
+        features = self._handshake_features()
+        features["names"] = PacketFactory.names()
+        self._handshake_query = Handshake.Query(features)
+        self.send_packet(self._handshake_query)
+        self._handshaking = True
+        QTimer.singleShot(self._handshake_time, self._handshake_timeout)
+
+    def _handshake_timeout(self):
+        """
+        Called when the server didn't answer to the handshake in time. A
+        reply received after that is ignored, see _handshake_late().
+        """
+        if not self._handshaking or not self._socket:
+            return
+        self._logger.info("No handshake reply, falling back to defaults")
+        error = QueryTimeoutError("No handshake reply")
+        self._fail_query(self._handshake_query.id, error)
+        self._finish_handshake()
+
+    def _finish_handshake(self):
+        """Send the packets held back during the handshake."""
+        self._handshaking = False
+        while self._held:
+            self._enqueue(self._held.popleft())
+
+    def _handshake_late(self):
+        """
+        Called when the handshake reply is received after we fell back to
+        the defaults. We stay on them, and ask the server to do the same by
+        offering it no features. It also goes back to the legacy framing as
+        soon as it reads it, see _read_frame().
+        """
+        if self._handshake_query is None:
+            return  # The reply to our second handshake
+        self._logger.info("Handshake reply received too late, ignored")
+        self._handshake_query = None
+        self.send_packet(Handshake.Query({}))
+
     def _notify_read(self):
         """Callback called when some data is ready to be read on the socket."""
         if not self._check_socket():
             return
 
-        # Read as many bytes as possible
-        try:
-            data = self._socket.recv(ClientSocket.MAX_DATA_SIZE)
-            if not data:
-                self.disconnect()
+        # Keep reading until the socket is drained or the budget is spent
+        deadline = time.time() + self._read_time
+        budget = self._read_size
+        while self._socket:
+            try:
+                count = self._socket.recv_into(self._read_chunk)
+                if not count:
+                    self.disconnect()
+                    return
+            except socket.error as e:
+                if (
+                    e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)
+                    and not isinstance(e, ssl.SSLWantReadError)
+                    and not isinstance(e, ssl.SSLWantWriteError)
+                ):
+                    self.disconnect(e)
+                break  # No more data available
+            self._read_buffer.extend(memoryview(self._read_chunk)[:count])
+            self._read_packets()
+
+            budget -= count
+            if budget <= 0 or time.time() >= deadline:
+                # The notifier won't fire for data already decrypted by SSL
+                if (
+                    isinstance(self._socket, ssl.SSLSocket)
+                    and self._socket.pending()
+                ):
+                    QTimer.singleShot(0, self._notify_read)
+                break
+
+        if self._incoming:
+            QCoreApplication.instance().postEvent(self, PacketEvent())
+
+    def _read_packets(self):
+        """Extract as many packets as possible from the read buffer."""
+        # The framing might change in-between packets because of the handshake
+        while self._socket:
+            if self._framed:
+                if not self._read_frame():
+                    break
+            elif not self._read_line():
+                break
+
+        # Only discard the consumed bytes once, instead of once per packet
+        if self._read_cursor:
+            del self._read_buffer[: self._read_cursor]
+            self._read_cursor = 0
+
+    def _trigger_downback(self, packet, count, total):
+        """Trigger the downback, at most once per DOWNBACK_INTERVAL."""
+        if not packet.downback:
+            return
+        now = time.time()
+        interval = ClientSocket.DOWNBACK_INTERVAL
+        if count < total and now - self._downback_time < interval:
+            return
+        self._downback_time = now
+        packet.downback(count, total)
+
+    def _read_line(self):
+        """
+        Read a packet from the buffer using the legacy framing. Return True
+        if some data was consumed, and False if more data is needed.
+        """
+        buf = self._read_buffer
+        cursor = self._read_cursor
+
+        if self._read_packet is None:
+            # A frame sent before the other party went back to the legacy
+            # framing, see _handshake_late(): we can't decode it
+            if cursor < len(buf) and buf[cursor] != ord("{"):
+                return self._skip_frame()
+
+            pos = buf.find(b"\n", cursor)
+            if pos < 0:
+                return False  # Not enough data for a packet
+            line = bytes(buf[cursor:pos])
+            self._read_cursor = pos + 1
+
+            # Try to parse the line (= packet)
+            try:
+                packet = self._parse_raw_event(line)
+                if packet is None:
+                    dct = JsonCodec.loads(line.decode("utf-8"))
+                    packet = Packet.parse_packet(dct, self._server)
+            except Exception as e:
+                msg = "Invalid packet received: %s" % line
+                self._logger.warning(msg)
+                self._logger.exception(e)
+                return True
+            if isinstance(packet, Reply):
+                self._reply_parsed(packet)
+
+            if isinstance(packet, Container):
+                self._read_packet = packet
+            else:
+                self._packet_received(packet)
+            return True
+
+        avail = len(buf) - cursor
+        total = self._read_packet.size
+
+        self._trigger_downback(self._read_packet, min(avail, total), total)
+
+        # Read the container's content
+        if avail < total:
+            return False  # Not enough data for a packet
+        self._read_packet.content = buf[cursor : cursor + total]  # noqa: E203
+        self._read_cursor += total
+        packet, self._read_packet = self._read_packet, None
+        self._packet_received(packet)
+        return True
+
+    def _skip_frame(self):
+        """
+        Skip a frame found while using the legacy framing. Return True if
+        some data was consumed, and False if more data is needed.
+        """
+        buf = self._read_buffer
+        cursor = self._read_cursor
+        header_size = ClientSocket.FRAME_HEADER.size
+
+        if len(buf) - cursor < header_size:
+            return False  # Not enough data for a header
+        length, _ = ClientSocket.FRAME_HEADER.unpack_from(buf, cursor)
+        if length > ClientSocket.MAX_FRAME_SIZE:
+            self.disconnect(ValueError("Frame too large: %d" % length))
+            return False
+        if len(buf) - cursor - header_size < length:
+            return False  # Not enough data for the payload
+        self._read_cursor = cursor + header_size + length
+        self._logger.warning("Frame received after the handshake, skipped")
+        return True
+
+    def _read_frame(self):
+        """
+        Read a frame from the buffer using the binary framing. Return True
+        if some data was consumed, and False if more data is needed.
+        """
+        buf = self._read_buffer
+        cursor = self._read_cursor
+        header_size = ClientSocket.FRAME_HEADER.size
+
+        # The client fell back to the defaults before receiving our reply
+        # to its handshake: a frame length can't start with this byte
+        if cursor < len(buf) and buf[cursor] == ord("{"):
+            self._logger.info("Legacy framing received, using the defaults")
+            self._apply_features({}, None)
+            return True
+
+        if len(buf) - cursor < header_size:
+            return False  # Not enough data for a header
+        length, kind = ClientSocket.FRAME_HEADER.unpack_from(buf, cursor)
+        if length > ClientSocket.MAX_FRAME_SIZE:
+            self.disconnect(ValueError("Frame too large: %d" % length))
+            return False
+        start = cursor + header_size
+        if len(buf) - start < length:
+            return False  # Not enough data for the payload
+        self._read_cursor = start + length
+
+        if kind in (ClientSocket.FRAME_PACKET, ClientSocket.FRAME_COMPRESSED):
+            payload = buf[start : start + length]  # noqa: E203
+            if kind == ClientSocket.FRAME_COMPRESSED:
+                # A corrupted compression stream cannot be recovered from
+                try:
+                    payload = self._compression.decompress(payload)
+                except Exception as e:
+                    self.disconnect(e)
+                    return False
+            try:
+                packet = self._parse_raw_event(payload)
+                if packet is None:
+                    dct = self._codec.decode(payload)
+                    packet = Packet.parse_packet(dct, self._server)
+            except Exception as e:
+                msg = "Invalid packet received: %s" % payload
+                self._logger.warning(msg)
+                self._logger.exception(e)
+                return True
+            if isinstance(packet, Reply):
+                self._reply_parsed(packet)
+
+            # The content of containers will follow in separate frames
+            if isinstance(packet, Container) and packet.size:
+                stream = dct["__stream__"]
+                self._read_streams[stream] = (packet, bytearray())
+            else:
+                if isinstance(packet, Container):
+                    packet.content = b""
+                self._packet_received(packet)
+
+        elif kind == ClientSocket.FRAME_CONTENT:
+            (stream,) = ClientSocket.STREAM_HEADER.unpack_from(buf, start)
+            if stream not in self._read_streams:
+                self._logger.warning("Content received for unknown stream")
+                return True
+            packet, content = self._read_streams[stream]
+            offset = start + ClientSocket.STREAM_HEADER.size
+            content.extend(buf[offset : start + length])  # noqa: E203
+
+            total = packet.size
+            self._trigger_downback(packet, min(len(content), total), total)
+
+            if len(content) >= total:
+                del self._read_streams[stream]
+                packet.content = content
+                self._packet_received(packet)
+
+        else:
+            self._logger.warning("Unknown frame type received: %d" % kind)
+        return True
+
+    def _parse_raw_event(self, data):
+        """
+        Decode only the header of a packet, in passthrough mode. Return an
+        opaque event if it is one, or None if the packet must be parsed.
+        """
+        if not self._passthrough:
+            return None
+        return RawEvent.load(data, self._codec)
+
+    def _packet_received(self, packet):
+        """Called when a packet has been read from the socket."""
+        # The framing must be switched before reading any further
+        if isinstance(packet, Handshake.Query) and self._server:
+            features = self._negotiate(packet.features)
+            self._enqueue(Handshake.Reply(packet, features))
+            self._apply_features(features, packet.features.get("names"))
+            return
+        if isinstance(packet, Handshake.Reply):
+            # The server switched to the features it replied with, but we
+            # fell back to the defaults: it must switch back to them
+            if not self._handshaking:
+                self._handshake_late()
                 return
-        except socket.error as e:
+            self._apply_features(packet.features, PacketFactory.names())
+            self._finish_handshake()
+        self._incoming.append(packet)
+
+    @property
+    def encoding(self):
+        """
+        Identify the way packets are encoded on this connection, so that a
+        packet sent to several parties can be encoded once per encoding.
+        """
+        return self._framed, self._codec.key
+
+    def _encode_packet(self, packet):
+        """
+        Serialize a packet into a list of buffers to be sent. The content of
+        containers isn't copied: the buffers are views over it.
+        """
+        # The events relayed by the server are sent as they were received
+        if isinstance(packet, RawEvent) and packet.sendable_by(self._codec):
+            data = packet.data
+            if not self._framed:
+                return [data, b"\n"]
+            header = ClientSocket.FRAME_HEADER.pack(
+                len(data), ClientSocket.FRAME_PACKET
+            )
+            return [header, data]
+
+        dct = packet.build_packet()
+        container = isinstance(packet, Container)
+        if self._framed and container:
+            self._write_stream += 1
+            dct["__stream__"] = self._write_stream
+
+        # Dump the packet as a line, followed by the container's content
+        if not self._framed:
+            data = JsonCodec.dumps(dct).encode("utf-8")
+            buffers = [data, b"\n"]
+            if container and packet.size:
+                buffers.append(memoryview(packet.content))
+            return buffers
+
+        # Or as a frame, followed by the frames of the container's content
+        data = self._codec.encode(dct)
+        header = ClientSocket.FRAME_HEADER.pack(
+            len(data), ClientSocket.FRAME_PACKET
+        )
+        buffers = [header, data]
+        if container:
+            content = memoryview(packet.content)
+            stream = ClientSocket.STREAM_HEADER.pack(self._write_stream)
+            chunk_size = ClientSocket.CONTENT_CHUNK_SIZE
+            for pos in range(0, len(content), chunk_size):
+                chunk = content[pos : pos + chunk_size]  # noqa: E203
+                length = len(stream) + len(chunk)
+                header = ClientSocket.FRAME_HEADER.pack(
+                    length, ClientSocket.FRAME_CONTENT
+                )
+                buffers.extend((header + stream, chunk))
+        return buffers
+
+    def _enqueue(self, packet, frames=None):
+        """
+        Serialize a packet and add it to the outgoing queue. The frames are
+        shared by the recipients of a broadcast: the buffers are immutable,
+        and are only built once for all the connections with the same
+        encoding. The containers are always encoded, as they carry a stream
+        identifier specific to the connection.
+        """
+        try:
+            if frames is None or isinstance(packet, Container):
+                buffers = self._encode_packet(packet)
+            else:
+                buffers = frames.get(self.encoding)
+                if buffers is None:
+                    buffers = self._encode_packet(packet)
+                    frames[self.encoding] = buffers
+        except Exception as e:
+            msg = "Invalid packet being sent: %s" % packet
+            self._logger.warning(msg + "\n")
+            self._logger.exception(str(e) + "\n")
+            return
+
+        # Packets are compressed when being written, not when being enqueued
+        compress = self._framed and self._compression is not None
+        units = [buffers]
+        if self._framed and isinstance(packet, Container):
+            # Each chunk of content can be interleaved with other packets
+            units = [buffers[:2]]
+            for i in range(2, len(buffers), 2):
+                units.append(buffers[i : i + 2])  # noqa: E203
+        size = self._queued_bytes(units[0])
+        entry = [packet, units[0], compress, size, True]
+
+        # When congested, only the last location of each user is kept
+        if isinstance(packet, UpdateLocation):
+            previous = self._locations.get(packet.name)
+            if previous and self._queue_size > self._high_watermark:
+                self._drop_entry(previous)
+            self._locations[packet.name] = entry
+
+        if self._framed:
+            queue = self._queues[self._priority_class(packet)]
+        else:
+            queue = self._outgoing
+        queue.append(entry)
+        for unit in units[1:]:
+            size = self._queued_bytes(unit)
+            queue.append([packet, unit, False, size, False])
+        self._queue_size += sum(self._queued_bytes(unit) for unit in units)
+        self._queue_length += 1
+        if (
+            self._congested_since is None
+            and self._queue_size > self._high_watermark
+        ):
+            self._congested_since = time.time()
+            self._logger.warning(
+                "Outgoing queue congested: %d packets, %d bytes"
+                % (self._queue_length, self._queue_size)
+            )
+        if not self._write_notifier.isEnabled():
+            self._write_notifier.setEnabled(True)
+
+    @staticmethod
+    def _priority_class(packet):
+        """
+        Return the priority class of a packet. A packet can only overtake
+        the packets of the other classes, so all the ones that must keep
+        their order relative to the events (see Packet.__ordered__) are in
+        the events class, whatever their kind. Only the others can be sent
+        ahead of the events, or behind them for the containers.
+        """
+        if packet.__ordered__:
+            return ClientSocket.PRIORITY_EVENTS
+        if isinstance(packet, Container):
+            return ClientSocket.PRIORITY_BULK
+        return ClientSocket.PRIORITY_CONTROL
+
+    @staticmethod
+    def _queued_bytes(buffers):
+        """Count the bytes of the buffers, except the containers' content."""
+        return sum(
+            len(buf) for buf in buffers if not isinstance(buf, memoryview)
+        )
+
+    def _drop_entry(self, entry):
+        """Drop an entry of the outgoing queue, before it is written."""
+        packet, _, _, size, head = entry
+        entry[0], entry[1] = None, []
+        self._queue_size -= size
+        if not head:
+            return  # A chunk of content, the packet was counted once
+        self._queue_length -= 1
+        if (
+            isinstance(packet, UpdateLocation)
+            and self._locations.get(packet.name) is entry
+        ):
+            del self._locations[packet.name]
+
+    def _drop_outgoing(self, predicate):
+        """
+        Drop the packets of the outgoing queue matching the predicate, that
+        haven't started being written yet, and return them. The chunks of
+        content of a packet are dropped along with it.
+        """
+        dropped = []
+        dropped_ids = set()
+        for entry in itertools.chain(self._outgoing, *self._queues):
+            packet, head = entry[0], entry[4]
+            if packet is None:
+                continue
+            # Only whole packets can be dropped, not some of their chunks.
+            # The chunks follow the head of their packet in the same queue.
+            if head and predicate(packet):
+                dropped.append(packet)
+                dropped_ids.add(id(packet))
+                self._drop_entry(entry)
+            elif not head and id(packet) in dropped_ids:
+                self._drop_entry(entry)
+        return dropped
+
+    def _check_drained(self):
+        """Check if a congested queue went back below the low watermark."""
+        if (
+            self._congested_since is not None
+            and self._queue_size < self._low_watermark
+        ):
+            self._congested_since = None
+            self._logger.info("Outgoing queue drained")
+            self._queue_drained()
+
+    def _queue_drained(self):
+        """Called when a congested queue has been drained."""
+        pass
+
+    def _packet_dequeued(self, packet):
+        """Called when a packet is about to be written to the socket."""
+        pass
+
+    def _pending(self):
+        """Are there packets waiting in the outgoing queues?"""
+        return bool(self._outgoing) or any(self._queues)
+
+    def _next_entry(self):
+        """
+        Pop the next entry to send from the outgoing queues. The packets
+        encoded before switching to the binary framing must be sent first.
+        """
+        if self._outgoing:
+            return self._outgoing.popleft()
+
+        weights = ClientSocket.PRIORITY_WEIGHTS
+        while any(self._queues):
+            queue = self._queues[self._priority]
+            if queue:
+                cost = sum(len(buf) for buf in queue[0][1])
+                if cost <= self._deficits[self._priority]:
+                    self._deficits[self._priority] -= cost
+                    return queue.popleft()
+            else:
+                # Idle classes don't accumulate credit
+                self._deficits[self._priority] = 0
+
+            # Move on to the next class, giving it its share for this round
+            self._priority = (self._priority + 1) % len(weights)
+            quantum = weights[self._priority] * ClientSocket.SCHEDULER_QUANTUM
+            self._deficits[self._priority] += quantum
+        return None
+
+    def _fill_views(self):
+        """
+        Move packets from the outgoing queues to the views waiting to be
+        written, until there is enough data for a single write.
+        """
+        while self._write_size < ClientSocket.MAX_WRITE_SIZE:
+            entry = self._next_entry()
+            if entry is None:
+                break
+            packet, buffers, compress, size, head = entry
+            if packet is None:
+                continue  # The packet was dropped
+            if head:
+                self._queue_length -= 1
+                if (
+                    isinstance(packet, UpdateLocation)
+                    and self._locations.get(packet.name) is entry
+                ):
+                    del self._locations[packet.name]
+                self._packet_dequeued(packet)
+
+            if compress:
+                buffers = self._compress_packet(buffers)
+                self._queue_size += self._queued_bytes(buffers) - size
+            container = isinstance(packet, Container)
+            for buf in buffers:
+                view = memoryview(buf)
+                # Only the content views count for the upback
+                is_content = container and view.obj is packet.content
+                self._write_views.append([view, packet, is_content])
+                self._write_size += len(view)
+
+    def _compress_packet(self, buffers):
+        """
+        Compress the packet frame of the buffers built by _encode_packet().
+        The frames holding the content of containers are left untouched.
+        """
+        data = self._compression.compress(buffers[1])
+        header = ClientSocket.FRAME_HEADER.pack(
+            len(data), ClientSocket.FRAME_COMPRESSED
+        )
+        return [header, data] + buffers[2:]
+
+    def _send_views(self):
+        """
+        Write as many pending views as possible with a single system call,
+        and return the number of bytes that were written.
+        """
+        views = []
+        size = 0
+        for view, _, _ in self._write_views:
+            views.append(view)
+            size += len(view)
             if (
-                e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)
-                and not isinstance(e, ssl.SSLWantReadError)
-                and not isinstance(e, ssl.SSLWantWriteError)
+                size >= ClientSocket.MAX_WRITE_SIZE
+                or len(views) >= ClientSocket.MAX_WRITE_BUFFERS
             ):
-                self.disconnect(e)
-            return  # No more data available
-        self._read_buffer.extend(data)
+                break
 
-        # Split the received data on new lines (= packets)
-        while True:
-            if self._read_packet is None:
-                if b"\n" in self._read_buffer:
-                    pos = self._read_buffer.index(b"\n")
-                    line = self._read_buffer[:pos]
-                    self._read_buffer = self._read_buffer[
-                        pos + 1 :  # noqa: E203
-                    ]
-
-                    # Try to parse the line (= packet)
-                    try:
-                        dct = json.loads(line.decode("utf-8"))
-                        self._read_packet = Packet.parse_packet(
-                            dct, self._server
-                        )
-                    except Exception as e:
-                        msg = "Invalid packet received: %s" % line
-                        self._logger.warning(msg)
-                        self._logger.exception(e)
-                        continue
-                else:
-                    break  # Not enough data for a packet
+        # Scatter/gather write, directly from the views
+        if self._sendmsg:
+            return self._socket.sendmsg(views)
 
-            else:
-                if isinstance(self._read_packet, Container):
-                    avail = len(self._read_buffer)
-                    total = self._read_packet.size
+        # Big buffers are written as is, without being copied
+        if len(views[0]) >= ClientSocket.TLS_RECORD_SIZE:
+            return self._socket.send(views[0][: ClientSocket.MAX_WRITE_SIZE])
 
-                    # Trigger the downback
-                    if self._read_packet.downback:
-                        self._read_packet.downback(min(avail, total), total)
+        # Small buffers are coalesced into a single TLS record
+        data = bytearray()
+        for view in views:
+            take = ClientSocket.TLS_RECORD_SIZE - len(data)
+            data.extend(view[:take])
+            if len(data) >= ClientSocket.TLS_RECORD_SIZE:
+                break
+        return self._socket.send(data)
 
-                    # Read the container's content
-                    if avail >= total:
-                        self._read_packet.content = self._read_buffer[:total]
-                        self._read_buffer = self._read_buffer[total:]
-                    else:
-                        break  # Not enough data for a packet
+    def _consume_views(self, count):
+        """Discard the views that were written and trigger the upbacks."""
+        while count:
+            entry = self._write_views[0]
+            view, packet, is_content = entry
+            written = min(count, len(view))
+            count -= written
+            self._write_size -= written
+            if not is_content:
+                self._queue_size -= written
+            if written == len(view):
+                self._write_views.popleft()
+            else:
+                entry[0] = view[written:]
 
-                self._incoming.append(self._read_packet)
-                self._read_packet = None
+            # Sending a query is progress, it shouldn't time out meanwhile
+            if isinstance(packet, Query):
+                self._touch_query(packet.id)
 
-        if self._incoming:
-            QCoreApplication.instance().postEvent(self, PacketEvent())
+            # Trigger the upback
+            if is_content and packet.upback:
+                total = len(packet.content)
+                sent = self._write_progress.get(packet, 0) + written
+                if sent < total:
+                    self._write_progress[packet] = sent
+                else:
+                    self._write_progress.pop(packet, None)
+                packet.upback(sent, total)
 
     def _notify_write(self):
         """Callback called when some data is ready to be written on the socket."""
         if not self._check_socket():
             return
 
-        if self._write_cursor >= len(self._write_buffer):
-            if not self._outgoing:
-                self._write_notifier.setEnabled(False)
-                return  # No more packets to send
-            self._write_packet = self._outgoing.popleft()
-
-            # Dump the packet as a line
-            try:
-                line = json.dumps(self._write_packet.build_packet())
-                line = line.encode("utf-8") + b"\n"
-            except Exception as e:
-                msg = "Invalid packet being sent: %s" % self._write_packet
-                self._logger.warning(msg + "\n")
-                self._logger.exception(str(e) + "\n")
-                return
-
-            # Write the container's content
-            self._write_buffer = bytearray(line)
-            self._write_cursor = 0
-            if isinstance(self._write_packet, Container):
-                data = self._write_packet.content
-                self._write_buffer.extend(bytearray(data))
-                self._write_packet.size += len(line)
+        self._fill_views()
+        if not self._write_views:
+            self._write_notifier.setEnabled(False)
+            self._check_drained()
+            return  # No more packets to send
 
         # Send as many bytes as possible
         try:
-            pos = self._write_cursor
-            avail = len(self._write_buffer) - pos
-            count = min(avail, ClientSocket.MAX_DATA_SIZE)
-            data = self._write_buffer[pos : pos + count]  # noqa: E203
-            self._write_cursor += self._socket.send(data)
+            count = self._send_views()
         except socket.error as e:
             if (
                 e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK)
@@ -269,22 +1144,11 @@ class ClientSocket(QObject):
             ):
                 self.disconnect(e)
             return  # Can't write anything
+        self._consume_views(count)
 
-        # Trigger the upback
-        if (
-            isinstance(self._write_packet, Container)
-            and self._write_packet.upback
-        ):
-            self._write_packet.size -= count
-            total = len(self._write_packet.content)
-            sent = max(total - self._write_packet.size, 0)
-            self._write_packet.upback(sent, total)
-
-        if (
-            self._write_cursor >= len(self._write_buffer)
-            and not self._outgoing
-        ):
+        if not self._write_views and not self._pending():
             self._write_notifier.setEnabled(False)
+        self._check_drained()
 
     def event(self, event):
         """Callback called when a Qt event is fired."""
@@ -301,38 +1165,129 @@ class ClientSocket(QObject):
         while self._incoming:
             packet = self._incoming.popleft()
             if not isinstance(packet, UpdateLocation):
-                self._logger.debug("Received packet: %s" % packet)
+                self._logger.debug("Received packet: %s", packet)
 
             # Notify for replies
             if isinstance(packet, Reply):
-                packet.trigger_callback()
+                self._reply_received(packet)
 
             # Otherwise forward to the subclass
             elif not self.recv_packet(packet):
                 self._logger.warning("Unhandled packet received: %s" % packet)
 
-    def send_packet(self, packet):
-        """Sends a packet the other party."""
+    def send_packet(self, packet, frames=None):
+        """
+        Sends a packet the other party. When broadcasting a packet, the same
+        frames dictionary should be given for all the recipients, so that it
+        is only encoded once.
+        """
         if not self._connected:
             self._logger.warning("Sending packet while disconnected")
             return None
 
         # UpdateLocation are sent very often so not logging
         if not isinstance(packet, UpdateLocation):
-            self._logger.debug("Sending packet: %s" % packet)
-
-        # Enqueue the packet
-        self._outgoing.append(packet)
-        if not self._write_notifier.isEnabled():
-            self._write_notifier.setEnabled(True)
+            self._logger.debug("Sending packet: %s", packet)
 
         # Queries return a packet deferred
         if isinstance(packet, Query):
             d = PacketDeferred()
-            packet.register_callback(d)
+            d.add_canceller(partial(self._cancel_query, packet.id))
+            self._queries[packet.id] = [packet, d, None]
+            if not self._query_timer.isActive():
+                self._query_timer.start()
+
+            # Wait if too many queries of this type are in-flight
+            if self._in_flight[packet.__command__] >= self._max_in_flight:
+                self._waiting[packet.__command__].append(packet)
+            else:
+                self._send_query(packet)
             return d
+
+        self._send(packet, frames)
         return None
 
+    def _send(self, packet, frames=None):
+        """Enqueue a packet, unless we're still waiting for the handshake."""
+        if self._handshaking:
+            self._held.append(packet)
+        else:
+            self._enqueue(packet, frames)
+
+    def _send_query(self, query):
+        """Send a query that is allowed to be in-flight."""
+        self._in_flight[query.__command__] += 1
+        self._queries[query.id][2] = time.time() + self._query_timeout
+        self._send(query)
+
+    def _release_query(self, query):
+        """Free the in-flight slot of a query, letting a waiting one go."""
+        if not self._socket:
+            return  # Disconnected, the slots were all freed
+        self._in_flight[query.__command__] -= 1
+        waiting = self._waiting[query.__command__]
+        if waiting:
+            self._send_query(waiting.popleft())
+
+    def _touch_query(self, query_id):
+        """Postpone the timeout of a query, as some progress was made."""
+        entry = self._queries.get(query_id)
+        if entry and entry[2] is not None:
+            entry[2] = time.time() + self._query_timeout
+
+    def _reply_parsed(self, reply):
+        """Called as soon as a reply is parsed, before its content is read."""
+        entry = self._queries.get(reply.id)
+        if entry:
+            entry[2] = None  # The reply is coming, the query can't time out
+            entry[1].initback(reply)
+
+    def _reply_received(self, reply):
+        """Called when a reply has been completely received."""
+        entry = self._queries.pop(reply.id, None)
+        if not entry:
+            self._logger.debug("Reply to an unknown query: %s" % reply)
+            return
+        self._release_query(entry[0])
+        if isinstance(reply, RefuseQuery):
+            entry[1].errback(QueryRefusedError(reply.reason))
+        else:
+            entry[1].callback(reply)
+
+    def _fail_query(self, query_id, error):
+        """Forget about a query, and trigger its errback."""
+        entry = self._queries.pop(query_id, None)
+        if not entry:
+            return
+        query, d, _ = entry
+
+        # Don't send the query if it is still waiting in a queue
+        waiting = self._waiting[query.__command__]
+        if query in waiting:
+            waiting.remove(query)
+        else:
+            if query in self._held:
+                self._held.remove(query)
+            else:
+                self._drop_outgoing(lambda packet: packet is query)
+            self._release_query(query)
+        d.errback(error)
+
+    def _cancel_query(self, query_id):
+        """Called when the deferred of a query is cancelled."""
+        self._fail_query(query_id, QueryCancelledError("Query cancelled"))
+
+    def _check_queries(self):
+        """Called periodically to time out the queries."""
+        now = time.time()
+        for query_id, (query, _, deadline) in list(self._queries.items()):
+            if deadline is not None and deadline < now:
+                self._logger.warning("Query timed out: %s" % query)
+                error = QueryTimeoutError("No reply received in time")
+                self._fail_query(query_id, error)
+        if not self._queries:
+            self._query_timer.stop()
+
     def recv_packet(self, packet):
         """Receives a packet from the other party."""
         raise NotImplementedError("recv_packet() not implemented")
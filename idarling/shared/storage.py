@@ -10,11 +10,46 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
-import json
 import sqlite3
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
+from PyQt5.QtCore import QCoreApplication, QObject, QTimer
+
+from .codecs import JsonCodec, load_portable, MsgPackCodec
 from .models import Project, Binary, Snapshot
-from .packets import Default, DefaultEvent
+from .packets import (
+    Default,
+    DefaultEvent,
+    PacketDeferred,
+    RawEvent,
+    StoredEvent,
+)
+from .workers import JobEvent
+
+# The codecs of the payloads stored, see Codec.portable()
+PORTABLE_CODECS = {str: JsonCodec(), bytes: MsgPackCodec()}
+
+
+def load_event(tick, payload):
+    """
+    Rebuild an event out of its stored payload. The events that were relayed
+    without being parsed are only decoded if they must be encoded with another
+    codec: they are sent to the clients as they were stored.
+    """
+    codec = PORTABLE_CODECS[type(payload)]
+    data = payload.encode("utf-8") if isinstance(payload, str) else payload
+    event = StoredEvent.load(data, codec)
+    if event is None:
+        dct = load_portable(payload)
+        dct["tick"] = tick
+        return DefaultEvent.new(dct)
+    # The server may have changed it, if it detected a de-synchronization
+    event.tick = tick
+    return event
 
 
 class Storage(object):
@@ -23,10 +58,73 @@ class Storage(object):
     also defines some utility methods. Currently, only SQLite3 is implemented.
     """
 
-    def __init__(self, dbpath):
+    # The synchronous modes matching the durability levels: "full" syncs
+    # every commit, "normal" only syncs the WAL when checkpointing (a power
+    # loss can lose the last commits, but not corrupt the database), and
+    # "off" leaves it to the operating system
+    DURABILITY = {"full": "full", "normal": "normal", "off": "off"}
+
+    BUSY_TIMEOUT = 30000  # ms
+
+    # The snapshots are identified by an integer, so that the events only
+    # store that id instead of repeating the names of the project, binary
+    # and snapshot, and renaming a binary doesn't need to rewrite them
+    SNAPSHOTS_COLUMNS = [
+        "id integer primary key",
+        "project text not null",
+        "binary text not null",
+        "name text not null",
+        "date text not null",
+        "foreign key(project) references projects(name)",
+        "foreign key(project, binary) references binaries(project, name)",
+        "unique(project, binary, name)",
+    ]
+    # The events are clustered by snapshot and tick, which is the order in
+    # which they are read, without a separate rowid index
+    EVENTS_COLUMNS = [
+        "snapshot_id integer not null",
+        "tick integer not null",
+        "dict text not null",
+        "foreign key(snapshot_id) references snapshots(id)",
+        "primary key(snapshot_id, tick)",
+    ]
+    EVENTS_OPTIONS = "without rowid"
+
+    # Selects the id of the snapshot given its project, binary and name
+    SNAPSHOT_ID = (
+        "(select id from snapshots"
+        " where project = ? and binary = ? and name = ?)"
+    )
+
+    # The payloads of the events can be stored compressed with zlib, using a
+    # preset dictionary trained on the events of the database. They are then
+    # prefixed by this byte, which is never used by MessagePack nor JSON, and
+    # by the id of the dictionary (0 if none).
+    PACKED = 0xC1
+    PACKED_HEADER = struct.Struct("!BH")
+    COMPRESSION_LEVEL = 6
+    DICTIONARY_SIZE = 32768  # bytes, zlib can't use more than that
+    DICTIONARY_SAMPLES = 4096  # events
+
+    def __init__(self, dbpath, durability=None, compress=False):
         self._conn = sqlite3.connect(dbpath, check_same_thread=False)
         self._conn.isolation_level = None  # No need to commit
         self._conn.row_factory = sqlite3.Row  # Use Row objects
+        if durability:
+            c = self._conn.cursor()
+            c.execute("pragma journal_mode = wal;")
+            c.execute(
+                "pragma synchronous = %s;" % Storage.DURABILITY[durability]
+            )
+        # The writes of the other connections can take a while
+        self._conn.execute("pragma busy_timeout = %d;" % Storage.BUSY_TIMEOUT)
+
+        self._compress = compress
+        self._dictionaries = {0: None}
+        # The id of the latest dictionary and a compressor primed with it
+        self._compressor = None
+        # The payloads written until there are enough to train a dictionary
+        self._samples = []
 
     def initialize(self):
         """Create all the default tables."""
@@ -51,34 +149,86 @@ class Storage(object):
                 "primary key (project, name)",
             ],
         )
+        self._create("snapshots", Storage.SNAPSHOTS_COLUMNS)
+        self._create("events", Storage.EVENTS_COLUMNS, Storage.EVENTS_OPTIONS)
         self._create(
-            "snapshots",
+            "dictionaries",
             [
-                "project text not null",
-                "binary text not null",
-                "name text not null",
-                "date text not null",
-                "foreign key(project) references projects(name)",
-                "foreign key(project, binary) references binaries(project, name)",
-                "primary key(project, binary, name)",
+                "id integer primary key",
+                "data blob not null",
+            ],
+        )
+        self._create(
+            "chunks",
+            [
+                "hash text not null",
+                "size integer not null",
+                "refs integer not null",
+                "primary key(hash)",
             ],
         )
         self._create(
-            "events",
+            "files",
             [
                 "project text not null",
                 "binary text not null",
                 "snapshot text not null",
-                "tick integer not null",
-                "dict text not null",
-                "foreign key(project) references projects(name)",
-                "foreign key(project, binary) references binaries(project, name)",
+                "size integer not null",
+                "hash text not null",
+                "manifest blob not null",
                 "foreign key(project, binary, snapshot)"
                 "     references snapshots(project, binary, name)",
-                "primary key(project, binary, snapshot, tick)",
+                "primary key(project, binary, snapshot)",
             ],
         )
 
+    def normalize(self):
+        """
+        Convert the snapshots and events tables created when the events were
+        keyed by the names of their project, binary and snapshot. Returns the
+        number of events converted, or None if there was nothing to convert.
+        """
+        c = self._conn.cursor()
+        c.execute("pragma table_info(events);")
+        if "snapshot" not in [row["name"] for row in c.fetchall()]:
+            return None
+
+        c.execute("begin;")
+        try:
+            self._create("snapshots_2", Storage.SNAPSHOTS_COLUMNS)
+            sql = "insert into snapshots_2 (project, binary, name, date) "
+            sql += "select project, binary, name, date from snapshots "
+            sql += "order by project, binary, name;"
+            c.execute(sql)
+            self._create(
+                "events_2", Storage.EVENTS_COLUMNS, Storage.EVENTS_OPTIONS
+            )
+            # The events of the snapshots that were deleted are dropped
+            sql = "insert into events_2 (snapshot_id, tick, dict) "
+            sql += (
+                "select s.id, e.tick, e.dict from events e join snapshots_2 s "
+            )
+            sql += "on s.project = e.project and s.binary = e.binary "
+            sql += "and s.name = e.snapshot order by s.id, e.tick;"
+            c.execute(sql)
+            count = c.rowcount
+            c.execute("drop table events;")
+            c.execute("drop table snapshots;")
+            c.execute("alter table snapshots_2 rename to snapshots;")
+            c.execute("alter table events_2 rename to events;")
+        except Exception:
+            c.execute("rollback;")
+            raise
+        c.execute("commit;")
+        self.vacuum()
+        return count
+
+    def vacuum(self):
+        """Give the space freed back to the file system."""
+        self._conn.execute("vacuum;")
+        # In WAL mode, the database is only rewritten when checkpointing
+        self._conn.execute("pragma wal_checkpoint(truncate);")
+
     def insert_project(self, project):
         """Insert a new project into the database."""
         self._insert("projects", Default.attrs(project.__dict__))
@@ -109,17 +259,41 @@ class Storage(object):
         )
         return [Binary(**result) for result in results]
 
-    def update_binary_name(self, project=None, old_name=None, new_name=None, limit=None):
+    def update_binary_name(
+        self, project=None, old_name=None, new_name=None, limit=None
+    ):
         """Update a binary with the given new name."""
-        self._update("binaries", "name", new_name, {"project": project, "name": old_name}, limit)
+        self._update(
+            "binaries",
+            "name",
+            new_name,
+            {"project": project, "name": old_name},
+            limit,
+        )
 
-    def update_snapshot_binary(self, project=None, old_name=None, new_name=None, limit=None):
+    def update_snapshot_binary(
+        self, project=None, old_name=None, new_name=None, limit=None
+    ):
         """Update a binary with the given new name."""
-        self._update("snapshots", "binary", new_name, {"project": project, "binary": old_name}, limit)
+        self._update(
+            "snapshots",
+            "binary",
+            new_name,
+            {"project": project, "binary": old_name},
+            limit,
+        )
 
-    def update_events_binary(self, project=None, old_name=None, new_name=None, limit=None):
-        """Update a binary with the given new name."""
-        self._update("events", "binary", new_name, {"project": project, "binary": old_name}, limit)
+    def update_files_binary(
+        self, project=None, old_name=None, new_name=None, limit=None
+    ):
+        """Update the binary of the database files with the given new name."""
+        self._update(
+            "files",
+            "binary",
+            new_name,
+            {"project": project, "binary": old_name},
+            limit,
+        )
 
     def insert_snapshot(self, snapshot):
         """Insert a new snapshot into the database."""
@@ -132,72 +306,370 @@ class Storage(object):
         objects = self.select_snapshots(project, binary, name, 1)
         return objects[0] if objects else None
 
-    def select_snapshots(self, project=None, binary=None, name=None, limit=None):
+    def select_snapshots(
+        self, project=None, binary=None, name=None, limit=None
+    ):
         """Select the snapshots with the given binary and name."""
         results = self._select(
-            "snapshots", {"project": project, "binary": binary, "name": name}, limit
+            "snapshots",
+            {"project": project, "binary": binary, "name": name},
+            limit,
         )
-        return [Snapshot(**result) for result in results]
+        snapshots = []
+        for result in results:
+            result = dict(result)
+            result.pop("id")
+            snapshots.append(Snapshot(**result))
+        return snapshots
+
+    @staticmethod
+    def event_row(client, event):
+        """
+        Get the row of an event sent by a client. The events relayed without
+        being parsed are stored as they were received, see Codec.portable().
+        """
+        if isinstance(event, RawEvent):
+            data = event.payload
+        else:
+            data = JsonCodec.dumps(DefaultEvent.attrs(event.__dict__))
+        return client.project, client.binary, client.snapshot, event.tick, data
 
     def insert_event(self, client, event):
         """Insert a new event into the database."""
-        dct = DefaultEvent.attrs(event.__dict__)
-        self._insert(
-            "events",
-            {
-                "project": client.project,
-                "binary": client.binary,
-                "snapshot": client.snapshot,
-                "tick": event.tick,
-                "dict": json.dumps(dct),
-            },
-        )
+        return self.insert_events([Storage.event_row(client, event)])
+
+    def insert_events(self, rows):
+        """
+        Insert the rows of many events at once, in a single transaction. The
+        events of a snapshot that doesn't exist (anymore) are dropped, and the
+        set of the (project, binary, snapshot) of these events is returned.
+        """
+        if self._compress:
+            if self._latest_dictionary()[0] == 0:
+                self._samples.extend(row[4] for row in rows)
+            rows = [row[:4] + (self.pack_payload(row[4]),) for row in rows]
 
-    def select_events(self, project, binary, snapshot, tick):
-        """Get all events sent after the given tick count."""
         c = self._conn.cursor()
-        sql = "select * from events where project = ? and binary = ? and snapshot = ?"
-        sql += "and tick > ? order by tick asc;"
+        c.execute("begin;")
+        try:
+            sql = "insert into events (snapshot_id, tick, dict) "
+            sql += "select id, ?, ? from snapshots "
+            sql += "where project = ? and binary = ? and name = ?;"
+            c.executemany(
+                sql,
+                (
+                    (tick, data, project, binary, snapshot)
+                    for project, binary, snapshot, tick, data in rows
+                ),
+            )
+            dropped = set()
+            if c.rowcount < len(rows):
+                sql = "select id from snapshots "
+                sql += "where project = ? and binary = ? and name = ?;"
+                for key in set(row[:3] for row in rows):
+                    if not c.execute(sql, key).fetchone():
+                        dropped.add(key)
+        except Exception:
+            c.execute("rollback;")
+            raise
+        c.execute("commit;")
+
+        # Train the dictionary once enough events were written without one
+        if len(self._samples) >= Storage.DICTIONARY_SAMPLES:
+            samples, self._samples = self._samples, []
+            self.insert_dictionary(train_dictionary(samples))
+        return dropped
+
+    def select_events(self, project, binary, snapshot, tick, limit=None):
+        """
+        Get the events sent after the given tick count, or only the first
+        ones of them if a limit is given. See load_event().
+        """
+        c = self._conn.cursor()
+        sql = (
+            "select tick, dict from events where snapshot_id = %s "
+            % Storage.SNAPSHOT_ID
+        )
+        sql += "and tick > ? order by tick asc"
+        sql += " limit {};".format(limit) if limit else ";"
         c.execute(sql, [project, binary, snapshot, tick])
-        events = []
-        for result in c.fetchall():
-            dct = json.loads(result["dict"])
-            dct["tick"] = result["tick"]
-            events.append(DefaultEvent.new(dct))
-        return events
+        return [
+            load_event(result["tick"], self.unpack_payload(result["dict"]))
+            for result in c.fetchall()
+        ]
 
     def last_tick(self, project, binary, snapshot):
         """Get the last tick of the specified binary and snapshot."""
         c = self._conn.cursor()
-        sql = "select tick from events where project = ? and binary = ? and snapshot = ? "
+        sql = (
+            "select tick from events where snapshot_id = %s "
+            % Storage.SNAPSHOT_ID
+        )
         sql += "order by tick desc limit 1;"
         c.execute(sql, [project, binary, snapshot])
         result = c.fetchone()
         return result["tick"] if result else 0
 
-    def delete_events(self, project, binary, snapshot):
-        self._delete("events", {"project": project, "binary": binary, "snapshot": snapshot})
+    def last_ticks(self, project, binary):
+        """Get the last ticks of the snapshots of a binary, by name."""
+        c = self._conn.cursor()
+        sql = (
+            "select name, (select max(tick) from events "
+            "where snapshot_id = snapshots.id) as tick from snapshots "
+            "where project = ? and binary = ?;"
+        )
+        c.execute(sql, [project, binary])
+        return {result["name"]: result["tick"] or 0 for result in c.fetchall()}
+
+    def pack_payload(self, payload):
+        """
+        Compress the payload of an event, using the latest dictionary. It is
+        kept as-is if it doesn't get any smaller.
+        """
+        data = payload.encode("utf-8") if isinstance(payload, str) else payload
+        dictionary_id, base = self._latest_dictionary()
+        if base is not None:
+            compressor = base.copy()
+        else:
+            compressor = zlib.compressobj(
+                Storage.COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS
+            )
+        packed = Storage.PACKED_HEADER.pack(Storage.PACKED, dictionary_id)
+        packed += compressor.compress(data) + compressor.flush()
+        return packed if len(packed) < len(data) else payload
+
+    def unpack_payload(self, data):
+        """
+        Get back the payload of an event as it was given to pack_payload(),
+        in the form expected by load_portable().
+        """
+        dictionary_id = Storage._dictionary_id(data)
+        if dictionary_id is None:
+            return data
+        dictionary = self._select_dictionary(dictionary_id)
+        if dictionary is not None:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, dictionary)
+        else:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        header_size = Storage.PACKED_HEADER.size
+        payload = decompressor.decompress(data[header_size:])
+        # The payloads of the JSON codec are text
+        return payload.decode("utf-8") if payload[:1] == b"{" else payload
+
+    def insert_dictionary(self, dictionary):
+        """Insert a new dictionary, used to compress the next payloads."""
+        c = self._conn.cursor()
+        c.execute("insert into dictionaries (data) values (?);", [dictionary])
+        self._dictionaries[c.lastrowid] = dictionary
+        self._compressor = None
+        return c.lastrowid
+
+    def sample_payloads(self, count):
+        """Select the payloads of events picked at random."""
+        c = self._conn.cursor()
+        c.execute(
+            "select dict from events order by random() limit ?;", [count]
+        )
+        return [self.unpack_payload(result["dict"]) for result in c.fetchall()]
+
+    def compress_events(self, decompress=False):
+        """
+        Compress (or decompress) the payloads of all the events already
+        stored, a snapshot at a time. Returns the count of events changed.
+        """
+        dictionary_id = self._latest_dictionary()[0]
+        c = self._conn.cursor()
+        c.execute("select id from snapshots;")
+        count = 0
+        for snapshot_id in [result["id"] for result in c.fetchall()]:
+            c.execute(
+                "select tick, dict from events where snapshot_id = ?;",
+                [snapshot_id],
+            )
+            rows = []
+            for result in c.fetchall():
+                data = result["dict"]
+                packed_id = Storage._dictionary_id(data)
+                if packed_id == (None if decompress else dictionary_id):
+                    continue
+                payload = self.unpack_payload(data)
+                if not decompress:
+                    payload = self.pack_payload(payload)
+                rows.append((payload, snapshot_id, result["tick"]))
+            c.execute("begin;")
+            try:
+                sql = "update events set dict = ?"
+                sql += " where snapshot_id = ? and tick = ?;"
+                c.executemany(sql, rows)
+            except Exception:
+                c.execute("rollback;")
+                raise
+            c.execute("commit;")
+            count += len(rows)
+        return count
+
+    @staticmethod
+    def _dictionary_id(data):
+        """Get the id of the dictionary a payload was packed with, or None."""
+        if isinstance(data, str) or not data or data[0] != Storage.PACKED:
+            return None
+        return Storage.PACKED_HEADER.unpack_from(data)[1]
+
+    def _select_dictionary(self, dictionary_id):
+        """Get a dictionary, loading it if it was added since."""
+        if dictionary_id not in self._dictionaries:
+            c = self._conn.cursor()
+            c.execute(
+                "select data from dictionaries where id = ?;", [dictionary_id]
+            )
+            result = c.fetchone()
+            if result is None:
+                raise ValueError("Unknown dictionary %d" % dictionary_id)
+            self._dictionaries[dictionary_id] = bytes(result["data"])
+        return self._dictionaries[dictionary_id]
+
+    def _latest_dictionary(self):
+        """Get the id of the latest dictionary, and a compressor using it."""
+        if self._compressor is None:
+            c = self._conn.cursor()
+            c.execute("select max(id) from dictionaries;")
+            dictionary_id = c.fetchone()[0] or 0
+            dictionary = self._select_dictionary(dictionary_id)
+            base = None
+            if dictionary is not None:
+                base = zlib.compressobj(
+                    Storage.COMPRESSION_LEVEL,
+                    zlib.DEFLATED,
+                    -zlib.MAX_WBITS,
+                    zdict=dictionary,
+                )
+            self._compressor = dictionary_id, base
+        return self._compressor
+
+    def select_chunk(self, digest):
+        """Select the chunk with the given digest."""
+        results = self._select("chunks", {"hash": digest}, 1)
+        return results[0] if results else None
+
+    def insert_chunks(self, sizes):
+        """Insert new chunks, given their sizes, not referenced yet."""
+        c = self._conn.cursor()
+        c.execute("begin;")
+        sql = "insert or ignore into chunks values (?, ?, 0);"
+        c.executemany(sql, list(sizes.items()))
+        c.execute("commit;")
+
+    def acquire_chunks(self, counts):
+        """Increment the reference counts of the given chunks."""
+        c = self._conn.cursor()
+        c.execute("begin;")
+        sql = "update chunks set refs = refs + ? where hash = ?;"
+        c.executemany(
+            sql, [(count, digest) for digest, count in counts.items()]
+        )
+        c.execute("commit;")
+
+    def release_chunks(self, counts):
+        """
+        Decrement the reference counts of the given chunks, and delete the
+        chunks no longer referenced. Return the digests of those chunks.
+        """
+        c = self._conn.cursor()
+        c.execute("begin;")
+        sql = "update chunks set refs = refs - ? where hash = ?;"
+        c.executemany(
+            sql, [(count, digest) for digest, count in counts.items()]
+        )
+        digests = []
+        for digest in counts:
+            c.execute("select refs from chunks where hash = ?;", [digest])
+            result = c.fetchone()
+            if result and result["refs"] <= 0:
+                digests.append(digest)
+        sql = "delete from chunks where hash = ?;"
+        c.executemany(sql, [(digest,) for digest in digests])
+        c.execute("commit;")
+        return digests
+
+    def collect_chunks(self):
+        """Delete all the chunks not referenced. Return their digests."""
+        c = self._conn.cursor()
+        c.execute("begin;")
+        c.execute("select hash from chunks where refs <= 0;")
+        digests = [result["hash"] for result in c.fetchall()]
+        c.execute("delete from chunks where refs <= 0;")
+        c.execute("commit;")
+        return digests
+
+    def select_file(self, project, binary, snapshot):
+        """Select the database file of a snapshot."""
+        results = self._select(
+            "files",
+            {"project": project, "binary": binary, "snapshot": snapshot},
+            1,
+        )
+        return results[0] if results else None
+
+    def select_files(self, project, binary=None, snapshot=None):
+        """Select the database files of the matching snapshots."""
+        return self._select(
+            "files",
+            {"project": project, "binary": binary, "snapshot": snapshot},
+        )
+
+    def replace_file(self, project, binary, snapshot, size, digest, manifest):
+        """Insert or replace the database file of a snapshot."""
+        c = self._conn.cursor()
+        sql = "insert or replace into files values (?, ?, ?, ?, ?, ?);"
+        c.execute(sql, [project, binary, snapshot, size, digest, manifest])
+
+    def count_files(self, digest):
+        """Count the snapshots whose database has the given digest."""
+        c = self._conn.cursor()
+        c.execute("select count(*) from files where hash = ?;", [digest])
+        return c.fetchone()[0]
+
+    def delete_file(self, project, binary, snapshot):
+        self._delete(
+            "files",
+            {"project": project, "binary": binary, "snapshot": snapshot},
+        )
+
+    def delete_events(self, project, binary=None, snapshot=None):
+        """Delete the events of the snapshots matching the given values."""
+        c = self._conn.cursor()
+        fields = {"project": project, "binary": binary, "name": snapshot}
+        fields = {key: val for key, val in fields.items() if val}
+        cols = ["{} = ?".format(col) for col in fields.keys()]
+        sql = "delete from events where snapshot_id in "
+        sql += "(select id from snapshots where {});".format(
+            " and ".join(cols)
+        )
+        c.execute(sql, list(fields.values()))
 
     def delete_snapshot(self, project, binary, snapshot):
         self.delete_events(project, binary, snapshot)
-        self._delete("snapshots", {"project": project, "binary": binary, "name": snapshot})
+        self._delete(
+            "snapshots",
+            {"project": project, "binary": binary, "name": snapshot},
+        )
 
     def delete_binary(self, project, binary):
-        self._delete("events", {"project": project, "binary": binary})
+        self.delete_events(project, binary)
         self._delete("snapshots", {"project": project, "binary": binary})
         self._delete("binaries", {"project": project, "name": binary})
 
     def delete_project(self, project):
-        self._delete("events", {"project": project})
+        self.delete_events(project)
         self._delete("snapshots", {"project": project})
         self._delete("binaries", {"project": project})
         self._delete("projects", {"name": project})
 
-    def _create(self, table, cols):
-        """Create a table with the given name and columns."""
+    def _create(self, table, cols, options=""):
+        """Create a table with the given name, columns and table options."""
         c = self._conn.cursor()
-        sql = "create table if not exists {} ({});"
-        c.execute(sql.format(table, ", ".join(cols)))
+        sql = "create table if not exists {} ({}) {};"
+        c.execute(sql.format(table, ", ".join(cols), options))
 
     def _select_all(self, table):
         """Select all the rows of a table."""
@@ -226,10 +698,9 @@ class Storage(object):
         if len(fields):
             cols = ["{} = ?".format(col) for col in fields.keys()]
             sql = (sql + " where {}").format(" and ".join(cols))
-        sql +=  ";"
+        sql += ";"
         c.execute(sql, list(fields.values()))
 
-
     def _update(self, table, field, new_value, search_fields, limit=None):
         """Update the field in a table matching the given search fields."""
         c = self._conn.cursor()
@@ -240,8 +711,8 @@ class Storage(object):
             sql = (sql + " where {}").format(" and ".join(cols))
         sql += " limit {};".format(limit) if limit else ";"
         conditions = [new_value] + list(search_fields.values())
-        #print(sql)
-        #print(conditions)
+        # print(sql)
+        # print(conditions)
         c.execute(sql, conditions)
         return c.fetchall()
 
@@ -256,3 +727,247 @@ class Storage(object):
         keys = ", ".join(fields.keys())
         vals = ", ".join(["?"] * len(fields))
         c.execute(sql.format(table, keys, vals), list(fields.values()))
+
+
+def train_dictionary(payloads, size=Storage.DICTIONARY_SIZE):
+    """
+    Build a zlib dictionary out of sample payloads. The samples of each type
+    of event get a share of the dictionary matching how common they are, and
+    the most common come last, as they are the cheapest to refer to.
+    """
+    groups = {}
+    for payload in payloads:
+        data = payload.encode("utf-8") if isinstance(payload, str) else payload
+        event_type = load_portable(payload).get("event_type")
+        groups.setdefault(event_type, []).append(data)
+
+    parts = []
+    for group in sorted(groups.values(), key=len):
+        budget = size * len(group) // len(payloads)
+        part, used = [], 0
+        # Prefer the latest samples, skipping the duplicates
+        for data in reversed(list(dict.fromkeys(group))):
+            if part and used + len(data) > budget:
+                break
+            part.append(data)
+            used += len(data)
+        parts.extend(reversed(part))
+    return b"".join(parts)[-size:]
+
+
+class StorageEngine(QObject):
+    """
+    This object runs the queries of the storage off the event loop, so that
+    a slow disk or a long deletion doesn't stall the other users. The writes
+    are executed in order by a single writer thread, and the reads by a small
+    pool of reader threads, each with its own connection. They return a
+    deferred, fired from the event loop.
+
+    A read only starts once the writes submitted before it are committed, so
+    that it sees them. The events are written in group commits, by size or
+    after a delay, and the latency of the commits is logged periodically.
+
+    The storage property is the connection of the event loop. It is used
+    while starting, and for the lookups that must be synchronous, but never
+    to write while the writer thread may be writing: the event loop would
+    wait for the lock of the database.
+    """
+
+    @staticmethod
+    def default_config():
+        return {
+            "durability": "normal",
+            "compress": True,  # the payloads of the events
+            "batch_size": 1024,  # events
+            "batch_interval": 50,  # ms
+            "readers": 2,  # threads
+            "report_interval": 60,  # s, 0 to disable
+        }
+
+    def __init__(
+        self, dbpath, logger, config=None, parent=None, events_dropped=None
+    ):
+        QObject.__init__(self, parent)
+        self._dbpath = dbpath
+        self._logger = logger
+        # Called with the snapshots whose events were dropped
+        self._events_dropped = events_dropped
+        self._config = config or StorageEngine.default_config()
+        self._durability = self._config["durability"]
+        self._storage = Storage(dbpath, self._durability)
+        self._storage.initialize()
+
+        self._writer = ThreadPoolExecutor(
+            1, thread_name_prefix="idarling-writer"
+        )
+        self._writer_storage = Storage(
+            dbpath, self._durability, self._config["compress"]
+        )
+        self._readers = ThreadPoolExecutor(
+            self._config["readers"], thread_name_prefix="idarling-reader"
+        )
+        self._local = threading.local()
+
+        # The writes are numbered, so that the reads can wait for them
+        self._written = threading.Condition()
+        self._write_count = 0
+        self._done_count = 0
+
+        # The events waiting to be written in the next group commit
+        self._pending = []
+        self._flush_timer = QTimer(self)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.timeout.connect(self.flush_events)
+
+        self._commits = 0
+        self._committed = 0
+        self._commit_time = 0.0
+        self._max_commit_time = 0.0
+        self._report_timer = None
+        if self._config["report_interval"]:
+            self._report_timer = QTimer(self)
+            self._report_timer.timeout.connect(self._report)
+            self._report_timer.start(self._config["report_interval"] * 1000)
+
+    @property
+    def storage(self):
+        """Get the connection of the event loop."""
+        return self._storage
+
+    def write(self, method, *args):
+        """
+        Call a method of the storage on the writer thread, in order. It can
+        also be a function, called with the storage as its first argument.
+        """
+        self.flush_events()
+        if not callable(method):
+            method = getattr(Storage, method)
+        return self._submit_write(method, *args)
+
+    def read(self, method, *args):
+        """
+        Call a method of the storage on a reader thread, once the writes
+        submitted so far are committed. Like for write(), it can also be a
+        function called with the storage.
+        """
+        self.flush_events()
+        count = self._write_count
+        d = PacketDeferred()
+        future = self._readers.submit(self._run_read, count, method, *args)
+        self._post_when_done(future, d)
+        return d
+
+    def insert_event(self, client, event):
+        """
+        Queue an event to be written in the next group commit. It is written
+        once enough events are waiting, or after a delay.
+        """
+        self._pending.append(Storage.event_row(client, event))
+        if len(self._pending) >= self._config["batch_size"]:
+            self.flush_events()
+        elif not self._flush_timer.isActive():
+            self._flush_timer.start(self._config["batch_interval"])
+
+    def flush_events(self):
+        """Write the events waiting to be written, in a group commit."""
+        self._flush_timer.stop()
+        if not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        d = self._submit_write(self._write_events, rows)
+        d.add_callback(self._events_written)
+        d.add_errback(self._events_not_written)
+
+    def wait(self):
+        """Block until the writes submitted so far are committed."""
+        self.flush_events()
+        count = self._write_count
+        with self._written:
+            self._written.wait_for(lambda: self._done_count >= count)
+
+    def close(self):
+        """Write what is left to write, and stop the threads."""
+        self.flush_events()
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+    def _submit_write(self, func, *args):
+        self._write_count += 1
+        d = PacketDeferred()
+        future = self._writer.submit(self._run_write, func, *args)
+        self._post_when_done(future, d)
+        return d
+
+    def _post_when_done(self, future, d):
+        future.add_done_callback(
+            lambda future: QCoreApplication.instance().postEvent(
+                self, JobEvent(future, d)
+            )
+        )
+
+    def _run_write(self, func, *args):
+        try:
+            return func(self._writer_storage, *args)
+        finally:
+            with self._written:
+                self._done_count += 1
+                self._written.notify_all()
+
+    def _run_read(self, count, method, *args):
+        with self._written:
+            self._written.wait_for(lambda: self._done_count >= count)
+        storage = getattr(self._local, "storage", None)
+        if storage is None:
+            storage = Storage(self._dbpath)
+            self._local.storage = storage
+        if callable(method):
+            return method(storage, *args)
+        return getattr(storage, method)(*args)
+
+    def _write_events(self, storage, rows):
+        start = time.perf_counter()
+        dropped = storage.insert_events(rows)
+        return len(rows), time.perf_counter() - start, dropped
+
+    def _events_written(self, result):
+        count, elapsed, dropped = result
+        if dropped and self._events_dropped:
+            self._events_dropped(dropped)
+        self._commits += 1
+        self._committed += count
+        self._commit_time += elapsed
+        self._max_commit_time = max(self._max_commit_time, elapsed)
+
+    def _events_not_written(self, error):
+        self._logger.error("Couldn't write the events into the database")
+        self._logger.exception(error)
+
+    def event(self, event):
+        """Callback called when a Qt event is fired."""
+        if isinstance(event, JobEvent):
+            try:
+                result = event.future.result()
+            except Exception as e:
+                event.deferred.errback(e)
+            else:
+                event.deferred.callback(result)
+            event.accept()
+            return True
+        return super(StorageEngine, self).event(event)
+
+    def _report(self):
+        """Log the statistics of the group commits since the last report."""
+        if not self._commits:
+            return
+        self._logger.info(
+            "Storage: %d events written in %d commits, latency %.1fms "
+            "on average (max %.1fms)"
+            % (
+                self._committed,
+                self._commits,
+                self._commit_time * 1000 / self._commits,
+                self._max_commit_time * 1000,
+            )
+        )
+        self._commits = self._committed = 0
+        self._commit_time = self._max_commit_time = 0.0
@@ -0,0 +1,897 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import glob
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+import zlib
+from functools import partial
+
+from .chunks import DIGEST_SIZE, index_file, read_manifest
+from .commands import (
+    DownloadChunks,
+    DownloadFile,
+    DownloadManifest,
+    UpdateFile,
+    UploadChunks,
+    UploadManifest,
+)
+from .compression import get_file_codec
+from .packets import (
+    PacketDeferred,
+    QueryCancelledError,
+    QueryError,
+    QueryRefusedError,
+    QueryTimeoutError,
+)
+
+# The databases are sent compressed, in chunks of this size
+CHUNK_SIZE = 1024 * 1024
+# The number of chunks that can be in-flight at once
+WINDOW = 4
+# The size of the blocks read from the files being (de)compressed
+BLOCK_SIZE = 1024 * 1024
+
+TRANSFER_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+def new_transfer_id():
+    """Generate a new transfer identifier."""
+    return uuid.uuid4().hex
+
+
+def is_transfer_id(transfer):
+    """Check that a transfer identifier is valid, and safe in a file name."""
+    return isinstance(transfer, str) and bool(TRANSFER_ID.match(transfer))
+
+
+def checksum(data):
+    """Compute the checksum of a chunk."""
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def pack_chunks(chunks, codec):
+    """Concatenate and compress chunks, to send them at once."""
+    compressor = codec.compressor()
+    return compressor.compress(b"".join(chunks)) + compressor.flush()
+
+
+def unpack_chunks(data, sizes, codec):
+    """Decompress and split chunks, given their sizes."""
+    decompressor = codec.stream_decompressor()
+    data = decompressor.decompress(data)
+    if not decompressor.eof or len(data) != sum(sizes):
+        raise IOError("Corrupted chunks")
+    chunks = []
+    offset = 0
+    for size in sizes:
+        chunks.append(data[offset : offset + size])  # noqa: E203
+        offset += size
+    return chunks
+
+
+class Spool(object):
+    """
+    The receiving end of a transfer. The chunks are appended to a file as
+    they arrive, so nothing is kept in memory and the transfer can resume
+    from the size of that file, even if the receiver was restarted.
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def offset(self):
+        """Get the offset of the next chunk expected."""
+        if not os.path.exists(self._path):
+            return 0
+        return os.path.getsize(self._path)
+
+    def write(self, offset, data, crc):
+        """Append a chunk if it is the next one and it isn't corrupted."""
+        if offset != self.offset or checksum(data) != crc:
+            return False
+        with open(self._path, "ab") as output_file:
+            output_file.write(data)
+        return True
+
+    def blocks(self, codec):
+        """Decompress the spooled data, block by block."""
+        decompressor = codec.stream_decompressor()
+        with open(self._path, "rb") as input_file:
+            while True:
+                data = input_file.read(BLOCK_SIZE)
+                if not data:
+                    break
+                yield decompressor.decompress(data)
+        if not decompressor.eof:
+            raise IOError("Truncated compressed data")
+
+    def extract(self, file_path, codec):
+        """Decompress the spooled data into the given file."""
+        tmp_path = file_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as output_file:
+                for data in self.blocks(codec):
+                    output_file.write(data)
+        except IOError:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, file_path)
+        self.discard()
+
+    def discard(self):
+        """Delete the spooled data."""
+        if os.path.exists(self._path):
+            os.remove(self._path)
+
+
+class Source(object):
+    """
+    The sending end of a transfer. The file is compressed lazily, as the
+    chunks are requested, and the compressed data is spooled to a file so
+    that any chunk can be sent again if the transfer is resumed. It can be
+    read from several threads.
+    """
+
+    def __init__(self, input_file, size, tag, spool_path, codec):
+        self.tag = tag
+        self.size = size
+        self.codec = codec
+        self.last_used = time.time()
+
+        self._input = input_file
+        self._position = 0
+        self._compressor = codec.parallel_compressor()
+        self._eof = False
+        self._spool_path = spool_path
+        self._spool = open(spool_path, "w+b")
+        self._length = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_tag(digest, codec):
+        """Identify the version of the file being sent, and its encoding."""
+        return "%s:%s:%s" % (digest, codec.name, codec.level)
+
+    @property
+    def complete(self):
+        """Has the whole file been compressed?"""
+        return self._eof
+
+    @property
+    def position(self):
+        """Get how many bytes of the file have been compressed so far."""
+        return self.size if self._eof else self._position
+
+    def read(self, offset):
+        """Read the chunk at the given offset, and whether it's the last."""
+        with self._lock:
+            return self._read(offset)
+
+    def _read(self, offset):
+        self.last_used = time.time()
+        end = offset + CHUNK_SIZE
+        while self._length < end and not self._eof:
+            data = self._input.read(BLOCK_SIZE)
+            if data:
+                self._position += len(data)
+                data = self._compressor.compress(data)
+            else:
+                data = self._compressor.flush()
+                self._eof = True
+                self._input.close()
+            self._spool.seek(self._length)
+            self._spool.write(data)
+            self._length += len(data)
+
+        self._spool.seek(offset)
+        data = self._spool.read(CHUNK_SIZE)
+        return data, self._eof and offset + len(data) >= self._length
+
+    def close(self, keep_as=None):
+        """
+        Close the files and delete the spooled data, unless it should be
+        kept under the given path.
+        """
+        with self._lock:
+            self._input.close()
+            self._spool.close()
+            if keep_as and self._eof:
+                os.replace(self._spool_path, keep_as)
+            elif os.path.exists(self._spool_path):
+                os.remove(self._spool_path)
+
+
+class CachedSource(object):
+    """The sending end of a transfer, reading an already compressed file."""
+
+    def __init__(self, cache_path, size, tag, codec):
+        self.tag = tag
+        self.size = size
+        self.codec = codec
+        self.last_used = time.time()
+        self.complete = True
+
+        self._cache = open(cache_path, "rb")
+        self._length = os.fstat(self._cache.fileno()).st_size
+        self._position = 0
+        self._lock = threading.Lock()
+
+    @property
+    def position(self):
+        """Estimate how many bytes of the file have been sent so far."""
+        return self.size * self._position // max(self._length, 1)
+
+    def read(self, offset):
+        """Read the chunk at the given offset, and whether it's the last."""
+        with self._lock:
+            self.last_used = time.time()
+            self._cache.seek(offset)
+            data = self._cache.read(CHUNK_SIZE)
+            self._position = offset + len(data)
+            return data, offset + len(data) >= self._length
+
+    def close(self, keep_as=None):
+        with self._lock:
+            self._cache.close()
+
+
+class TransferCache(object):
+    """
+    The compressed files sent to the clients are cached, one per codec and
+    level, so that a database is only compressed once no matter how many
+    clients download it. The downloads of the same file also share their
+    source while it is being compressed.
+
+    The cached files are named after the SHA-256 of the database, so that
+    the snapshots with the same database share them, and they can't become
+    stale: they are deleted once no snapshot has that database anymore.
+    """
+
+    def __init__(self, directory, timeout):
+        self._directory = directory
+        self._timeout = timeout
+        self._sources = {}
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Files that were being compressed when we were stopped
+        for path in glob.glob(os.path.join(directory, "*.part")):
+            os.remove(path)
+
+    def _cache_path(self, digest, codec):
+        name = "%s.%s-%s" % (digest, codec.name, codec.level)
+        return os.path.join(self._directory, name)
+
+    def _store(self, digest, source):
+        """Close a source, keeping its compressed data if complete."""
+        if isinstance(source, Source) and source.complete:
+            source.close(keep_as=self._cache_path(digest, source.codec))
+        else:
+            source.close()
+
+    def open(self, digest, size, opener, codec):
+        """
+        Get the source to send the file with the given digest and size,
+        compressed with the given codec. The file is opened by calling the
+        opener, if it isn't already cached.
+        """
+        self.prune()
+        key = (digest, codec.name, codec.level)
+        source = self._sources.get(key)
+        if isinstance(source, Source) and source.complete:
+            # Read it from the cache from now on
+            self._store(digest, source)
+            source = None
+        if not source:
+            tag = Source.make_tag(digest, codec)
+            cache_path = self._cache_path(digest, codec)
+            if os.path.exists(cache_path):
+                source = CachedSource(cache_path, size, tag, codec)
+            else:
+                spool_path = cache_path + ".part"
+                source = Source(opener(), size, tag, spool_path, codec)
+        self._sources[key] = source
+        return source
+
+    def invalidate(self, digest):
+        """Forget about a file that no snapshot has anymore."""
+        for key, source in list(self._sources.items()):
+            if key[0] == digest:
+                source.close()
+                del self._sources[key]
+        for path in glob.glob(os.path.join(self._directory, digest + ".*")):
+            os.remove(path)
+
+    def collect_garbage(self, is_used):
+        """Delete the cached files of the digests that are no longer used."""
+        for path in glob.glob(os.path.join(self._directory, "*.*")):
+            digest = os.path.basename(path).split(".")[0]
+            if not is_used(digest):
+                self.invalidate(digest)
+
+    def prune(self, everything=False):
+        """Close the sources that haven't been used for a while."""
+        expiry = time.time() - self._timeout
+        for key, source in list(self._sources.items()):
+            if everything or source.last_used < expiry:
+                self._store(key[0], source)
+                del self._sources[key]
+
+
+class Transfer(object):
+    """
+    A transfer of a database, driven by the client. At most WINDOW chunks
+    are in-flight at once, and each of them is acknowledged. If a chunk is
+    rejected, or the connection is lost, the transfer restarts from the last
+    offset acknowledged by the receiver. Each restart begins a new epoch, so
+    that the replies to the chunks sent before can be ignored.
+
+    The transfer fails if the server refuses it, or if its queries keep
+    timing out without any reply in-between.
+    """
+
+    # How many times in a row the transfer resumes after a query timed out
+    MAX_TIMEOUTS = 5
+
+    # The protocol feature required by the transfer, see ClientSocket
+    FEATURE = None
+
+    def __init__(self, network, project, binary, snapshot, spool_dir):
+        self._network = network
+        self._project = project
+        self._binary = binary
+        self._snapshot = snapshot
+        self._id = new_transfer_id()
+        self._spool_path = os.path.join(spool_dir, "%s.part" % self._id)
+        self._epoch = 0
+        self._done = False
+        self._timeouts = 0
+
+        self.deferred = PacketDeferred()
+        self.progress = None
+        self.interrupted = None
+
+    @property
+    def done(self):
+        return self._done
+
+    def check(self):
+        """
+        Fail the transfer if the server doesn't support it, as agreed upon
+        during the handshake. Return whether the transfer can go on.
+        """
+        if getattr(self._network.client, self.FEATURE, False):
+            return True
+        reason = "Transfer not supported by the server: %s" % self.FEATURE
+        self._finish(QueryRefusedError(reason))
+        return False
+
+    def start(self):
+        """Start sending the chunks."""
+        raise NotImplementedError("start() not implemented")
+
+    def resume(self):
+        """Resume the transfer, e.g. after a reconnection."""
+        raise NotImplementedError("resume() not implemented")
+
+    def _send(self, packet, offset):
+        """Send a chunk query and watch for its completion."""
+        d = self._network.send_packet(packet)
+        if d is None:
+            return False  # Disconnected, we'll resume later
+        d.add_callback(partial(self._query_replied, self._epoch, offset))
+        d.add_errback(partial(self._chunk_failed, self._epoch))
+        return True
+
+    def _query_replied(self, epoch, offset, reply):
+        if epoch == self._epoch:
+            self._timeouts = 0
+        self._chunk_replied(epoch, offset, reply)
+
+    def _chunk_replied(self, epoch, offset, reply):
+        """Called when a reply to a chunk query is received."""
+        raise NotImplementedError("_chunk_replied() not implemented")
+
+    def _chunk_failed(self, epoch, error):
+        """Called when a chunk query failed."""
+        if epoch != self._epoch or self._done:
+            return
+        if isinstance(error, QueryCancelledError):
+            return
+        if isinstance(error, QueryRefusedError):
+            self._finish(error)  # Trying again wouldn't help
+            return
+        if isinstance(error, QueryTimeoutError):
+            self._timeouts += 1
+            if self._timeouts > Transfer.MAX_TIMEOUTS:
+                self._finish(error)
+                return
+        if isinstance(error, QueryError):
+            # Timed out or disconnected: try again if we can
+            if self._network.connected:
+                self.resume()
+            else:
+                self._epoch += 1  # Ignore the other chunks failing
+                if self.interrupted:
+                    self.interrupted()
+            return
+        self._finish(error)
+
+    def _report(self, count, total):
+        """Report the progress of the transfer."""
+        if self.progress:
+            self.progress(count, total)
+
+    def _finish(self, error=None):
+        """Called when the transfer is done."""
+        self._done = True
+        self._epoch += 1
+        self._network.transfer_finished(self)
+        if error:
+            self.deferred.errback(error)
+        else:
+            self.deferred.callback(self)
+
+
+class Upload(Transfer):
+    """Upload a database to the server, using UpdateFile queries."""
+
+    FEATURE = "chunked_files"
+
+    def __init__(
+        self, network, project, binary, snapshot, file_path, spool_dir
+    ):
+        super(Upload, self).__init__(
+            network, project, binary, snapshot, spool_dir
+        )
+        codec = network.client.transfer_codec
+        size = os.path.getsize(file_path)
+        input_file = open(file_path, "rb")
+        self._source = Source(input_file, size, None, self._spool_path, codec)
+        self._next = 0
+        self._acked = 0
+        self._final = False
+
+    def start(self):
+        self._fill()
+
+    def resume(self):
+        # Ask the server where it is at using an empty chunk
+        self._epoch += 1
+        self._send(self._chunk(0, b"", False), -1)
+
+    def _chunk(self, offset, data, final):
+        packet = UpdateFile.Query(
+            self._project,
+            self._binary,
+            self._snapshot,
+            self._id,
+            offset,
+            checksum(data),
+            final,
+            self._source.codec.name,
+        )
+        packet.content = data
+        return packet
+
+    def _fill(self):
+        """Send chunks until the window is full."""
+        while (
+            not self._final and self._next < self._acked + WINDOW * CHUNK_SIZE
+        ):
+            data, final = self._source.read(self._next)
+            end = self._next + len(data)
+            if not self._send(self._chunk(self._next, data, final), end):
+                return
+            self._next, self._final = end, final
+
+    def _restart(self, offset):
+        self._epoch += 1
+        self._next = self._acked = offset
+        self._final = False
+        self._fill()
+
+    def _chunk_replied(self, epoch, offset, reply):
+        if epoch != self._epoch or self._done:
+            return
+        if reply.done:
+            self._report(self._source.size, self._source.size)
+            self._source.close()
+            self._finish()
+        elif reply.offset != offset:
+            # The server has rejected the chunk, or we asked for its offset
+            self._restart(reply.offset)
+        else:
+            self._acked = offset
+            self._report(self._source.position, self._source.size)
+            self._fill()
+
+    def _finish(self, error=None):
+        if error:
+            self._source.close()
+        super(Upload, self)._finish(error)
+
+
+class Download(Transfer):
+    """Download a database from the server, using DownloadFile queries."""
+
+    FEATURE = "chunked_files"
+
+    def __init__(
+        self, network, project, binary, snapshot, file_path, spool_dir
+    ):
+        super(Download, self).__init__(
+            network, project, binary, snapshot, spool_dir
+        )
+        self._file_path = file_path
+        self._spool = Spool(self._spool_path)
+        self._tag = None
+        self._next = 0
+        self._final = False
+
+    def start(self):
+        self._fill()
+
+    def resume(self):
+        self._restart()
+
+    def _fill(self):
+        """Request chunks until the window is full."""
+        offset = self._spool.offset
+        while not self._final and self._next < offset + WINDOW * CHUNK_SIZE:
+            packet = DownloadFile.Query(
+                self._project,
+                self._binary,
+                self._snapshot,
+                self._id,
+                self._next,
+            )
+            if not self._send(packet, self._next):
+                return
+            self._next += CHUNK_SIZE
+
+    def _restart(self):
+        self._epoch += 1
+        self._next = self._spool.offset
+        self._final = False
+        self._fill()
+
+    def _chunk_replied(self, epoch, offset, reply):
+        if epoch != self._epoch or self._done:
+            return
+
+        # The database has changed on the server, start over
+        if reply.tag != self._tag:
+            if self._tag is not None or reply.offset:
+                self._spool.discard()
+                self._tag = reply.tag
+                self._restart()
+                return
+            self._tag = reply.tag
+
+        # The server couldn't read the chunk, ask for it again
+        if not reply.content and not reply.final:
+            self._restart()
+            return
+        if not self._spool.write(reply.offset, reply.content, reply.checksum):
+            self._restart()
+            return
+        self._report(reply.position, reply.total)
+        if not reply.final:
+            self._fill()
+            return
+
+        try:
+            codec = get_file_codec(reply.codec)
+            self._spool.extract(self._file_path, codec)
+        except Exception as e:
+            self._spool.discard()
+            self._finish(e)
+        else:
+            self._finish()
+
+    def _finish(self, error=None):
+        if error:
+            self._spool.discard()
+        super(Download, self)._finish(error)
+
+
+def _batch_end(chunks, sizes, start):
+    """Get the end of the batch of chunks starting at the given index."""
+    end = start + 1
+    total = sizes[chunks[start]]
+    while end < len(chunks) and total + sizes[chunks[end]] <= CHUNK_SIZE:
+        total += sizes[chunks[end]]
+        end += 1
+    return end
+
+
+class DeltaUpload(Transfer):
+    """
+    Upload a database to the server, sending only the chunks it doesn't
+    have. The manifest of the database is sent using an UploadManifest query
+    and the server replies with the chunks it is missing. They are sent using
+    UploadChunks queries, then the manifest again to commit it. If the
+    transfer is interrupted, it resumes by sending the manifest again.
+    """
+
+    FEATURE = "delta"
+
+    # How many times the missing chunks are sent before giving up
+    MAX_ROUNDS = 3
+
+    def __init__(
+        self, network, project, binary, snapshot, file_path, spool_dir
+    ):
+        super(DeltaUpload, self).__init__(
+            network, project, binary, snapshot, spool_dir
+        )
+        self._file_path = file_path
+        self._manifest, self._offsets = index_file(file_path)
+        self._sizes = dict(read_manifest(self._manifest))
+        self._size = sum(size for _, size in read_manifest(self._manifest))
+        self._missing = []
+        self._next = 0
+        self._pending = 0
+        self._sent = 0
+        self._total = 0
+        self._rounds = 0
+
+    def start(self):
+        self._send_manifest()
+
+    def resume(self):
+        self._epoch += 1
+        self._send_manifest()
+
+    def _send_manifest(self):
+        packet = UploadManifest.Query(
+            self._project, self._binary, self._snapshot
+        )
+        packet.content = self._manifest
+        self._send(packet, None)
+
+    def _fill(self):
+        """Send batches of missing chunks until the window is full."""
+        codec = self._network.client.transfer_codec
+        while self._next < len(self._missing) and self._pending < WINDOW:
+            end = _batch_end(self._missing, self._sizes, self._next)
+            batch = self._missing[self._next : end]  # noqa: E203
+            sizes = [self._sizes[digest] for digest in batch]
+            chunks = []
+            with open(self._file_path, "rb") as input_file:
+                for digest, size in zip(batch, sizes):
+                    input_file.seek(self._offsets[digest])
+                    chunks.append(input_file.read(size))
+            packet = UploadChunks.Query(
+                self._project, self._binary, self._snapshot, sizes, codec.name
+            )
+            packet.content = pack_chunks(chunks, codec)
+            if not self._send(packet, sum(sizes)):
+                return  # Disconnected, we'll resume later
+            self._next = end
+            self._pending += 1
+
+        # Commit the manifest once all the chunks have been received
+        if self._next == len(self._missing) and not self._pending:
+            self._send_manifest()
+
+    def _chunk_replied(self, epoch, size, reply):
+        if epoch != self._epoch or self._done:
+            return
+        if size is not None:
+            self._pending -= 1
+            self._sent += size
+            self._report(self._sent, self._total)
+            self._fill()
+        elif reply.done:
+            self._report(self._size, self._size)
+            self._finish()
+        elif self._rounds >= DeltaUpload.MAX_ROUNDS:
+            self._finish(IOError("The server keeps missing chunks"))
+        else:
+            # Send the chunks that the server is missing
+            self._rounds += 1
+            missing = (
+                bytes(reply.content[i : i + DIGEST_SIZE])  # noqa: E203
+                for i in range(0, len(reply.content), DIGEST_SIZE)
+            )
+            self._missing = [
+                digest for digest in missing if digest in self._sizes
+            ]
+            self._next = self._pending = self._sent = 0
+            self._total = sum(self._sizes[digest] for digest in self._missing)
+            self._fill()
+
+
+class DeltaDownload(Transfer):
+    """
+    Download a database from the server, reusing the chunks of an older
+    local copy. The manifest of the database is downloaded first using a
+    DownloadManifest query, then the chunks missing from the local copy
+    using DownloadChunks queries. They are spooled as they arrive, and the
+    database is rebuilt once they have all been received.
+    """
+
+    FEATURE = "delta"
+
+    def __init__(
+        self, network, project, binary, snapshot, file_path, spool_dir
+    ):
+        super(DeltaDownload, self).__init__(
+            network, project, binary, snapshot, spool_dir
+        )
+        self._file_path = file_path
+        self._spool = Spool(self._spool_path)
+        self._offsets = {}
+        if os.path.isfile(file_path):
+            self._offsets = index_file(file_path)[1]
+        self._digest = None
+        self._manifest = None
+        self._sizes = {}
+        self._missing = []
+        self._ends = []
+        self._next = 0
+        self._pending = 0
+
+    def start(self):
+        self._send_manifest()
+
+    def resume(self):
+        self._epoch += 1
+        self._send_manifest()
+
+    def _send_manifest(self):
+        packet = DownloadManifest.Query(
+            self._project, self._binary, self._snapshot
+        )
+        self._send(packet, None)
+
+    def _restart(self):
+        """Request the missing chunks following the spooled ones."""
+        self._epoch += 1
+        offset = self._spool.offset
+        if offset and offset not in self._ends:
+            self._spool.discard()
+            offset = 0
+        self._next = self._ends.index(offset) + 1 if offset else 0
+        self._pending = 0
+        self._fill()
+
+    def _fill(self):
+        """Request batches of missing chunks until the window is full."""
+        while self._next < len(self._missing) and self._pending < WINDOW:
+            end = _batch_end(self._missing, self._sizes, self._next)
+            batch = self._missing[self._next : end]  # noqa: E203
+            packet = DownloadChunks.Query(
+                self._project,
+                self._binary,
+                self._snapshot,
+                self._digest,
+                [digest.hex() for digest in batch],
+            )
+            if not self._send(packet, (self._next, end)):
+                return  # Disconnected, we'll resume later
+            self._next = end
+            self._pending += 1
+
+        # Rebuild the database once all the chunks have been received
+        if self._next == len(self._missing) and not self._pending:
+            self._rebuild()
+
+    def _manifest_replied(self, reply):
+        if reply.digest is None:
+            self._finish(IOError("The snapshot has no database"))
+            return
+        if reply.digest != self._digest:
+            # The database is new or has changed, start over
+            self._spool.discard()
+            self._digest = reply.digest
+            self._manifest = bytes(reply.content)
+            self._sizes = dict(read_manifest(self._manifest))
+            missing = set(self._sizes) - set(self._offsets)
+            self._missing = []
+            for digest, _ in read_manifest(self._manifest):
+                if digest in missing:
+                    missing.discard(digest)
+                    self._missing.append(digest)
+            self._ends = []
+            for digest in self._missing:
+                previous = self._ends[-1] if self._ends else 0
+                self._ends.append(previous + self._sizes[digest])
+        self._restart()
+
+    def _chunk_replied(self, epoch, batch, reply):
+        if epoch != self._epoch or self._done:
+            return
+        if batch is None:
+            self._manifest_replied(reply)
+            return
+        if reply.digest != self._digest:
+            # The database has changed on the server, start over
+            self.resume()
+            return
+
+        start, end = batch
+        chunks = self._missing[start:end]
+        try:
+            codec = get_file_codec(reply.codec)
+            sizes = [self._sizes[digest] for digest in chunks]
+            data = unpack_chunks(reply.content, sizes, codec)
+        except Exception:
+            self._restart()
+            return
+        for digest, chunk in zip(chunks, data):
+            if hashlib.sha256(chunk).digest() != digest:
+                self._restart()
+                return
+        offset = self._ends[start - 1] if start else 0
+        data = b"".join(data)
+        if not self._spool.write(offset, data, checksum(data)):
+            self._restart()
+            return
+        self._pending -= 1
+        self._report(self._ends[end - 1], self._ends[-1])
+        self._fill()
+
+    def _rebuild(self):
+        """Rebuild the database from the local copy and the spooled chunks."""
+        spooled = {}
+        for digest, end in zip(self._missing, self._ends):
+            spooled[digest] = end - self._sizes[digest]
+
+        tmp_path = self._file_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as output_file:
+                self._write_chunks(output_file, spooled)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._finish(e)
+            return
+        os.replace(tmp_path, self._file_path)
+        self._spool.discard()
+        self._finish()
+
+    def _write_chunks(self, output_file, spooled):
+        local_file = spool_file = None
+        try:
+            if self._offsets:
+                local_file = open(self._file_path, "rb")
+            if spooled:
+                spool_file = open(self._spool_path, "rb")
+            for digest, size in read_manifest(self._manifest):
+                if digest in spooled:
+                    input_file, offset = spool_file, spooled[digest]
+                else:
+                    input_file, offset = local_file, self._offsets[digest]
+                input_file.seek(offset)
+                data = input_file.read(size)
+                # The local copy may have been modified in the meantime
+                if hashlib.sha256(data).digest() != digest:
+                    raise IOError("Corrupted chunk")
+                output_file.write(data)
+        finally:
+            if local_file:
+                local_file.close()
+            if spool_file:
+                spool_file.close()
+
+    def _finish(self, error=None):
+        if error:
+            self._spool.discard()
+        super(DeltaDownload, self)._finish(error)
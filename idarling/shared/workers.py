@@ -0,0 +1,150 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+
+from PyQt5.QtCore import QCoreApplication, QEvent, QObject, QTimer
+
+from .packets import PacketDeferred
+
+
+class JobEvent(QEvent):
+    """
+    This Qt event is fired when a job of the worker pool is done, so that
+    its deferred is fired from the event loop.
+    """
+
+    EVENT_TYPE = QEvent.Type(QEvent.registerEventType())
+
+    def __init__(self, future, deferred):
+        super(JobEvent, self).__init__(JobEvent.EVENT_TYPE)
+        self.future = future
+        self.deferred = deferred
+
+
+class WorkerPool(QObject):
+    """
+    A pool of threads running the blocking jobs of the server, such as the
+    file I/O and the (de)compression of the databases, so that they don't
+    stall the event loop serving all the clients. The jobs must not touch
+    anything else than the files: the results are posted back to the event
+    loop as Qt events, where the deferred returned by submit() is fired.
+
+    The queue depth is the number of jobs submitted but not completed yet.
+    A warning is logged when it exceeds a threshold, and statistics are
+    logged periodically.
+    """
+
+    @staticmethod
+    def default_config():
+        return {
+            "threads": 0,  # 0 means one per core
+            "queue_warning": 32,  # jobs
+            "report_interval": 60,  # s, 0 to disable
+        }
+
+    def __init__(self, logger, config=None, parent=None):
+        QObject.__init__(self, parent)
+        self._logger = logger
+        config = config or WorkerPool.default_config()
+        self._threads = config["threads"] or os.cpu_count() or 1
+        self._queue_warning = config["queue_warning"]
+        self._executor = ThreadPoolExecutor(
+            self._threads, thread_name_prefix="idarling-worker"
+        )
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._max_depth = 0
+        self._jobs = 0
+        self._busy = 0.0
+        self._warned = False
+
+        self._report_timer = None
+        if config["report_interval"]:
+            self._report_timer = QTimer(self)
+            self._report_timer.timeout.connect(self._report)
+            self._report_timer.start(config["report_interval"] * 1000)
+
+    @property
+    def threads(self):
+        """Get the number of threads of the pool."""
+        return self._threads
+
+    @property
+    def queue_depth(self):
+        """Get the number of jobs submitted but not completed yet."""
+        return self._depth
+
+    @property
+    def max_queue_depth(self):
+        """Get the highest queue depth since the last report."""
+        return self._max_depth
+
+    def submit(self, func, *args):
+        """Run a function on a worker thread, returning a deferred."""
+        d = PacketDeferred()
+        self._depth += 1
+        self._max_depth = max(self._max_depth, self._depth)
+        if self._depth > self._queue_warning and not self._warned:
+            self._logger.warning(
+                "Worker pool is falling behind: %d jobs queued" % self._depth
+            )
+            self._warned = True
+
+        future = self._executor.submit(self._run, func, *args)
+        future.add_done_callback(
+            lambda future: QCoreApplication.instance().postEvent(
+                self, JobEvent(future, d)
+            )
+        )
+        return d
+
+    def _run(self, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self._busy += time.perf_counter() - start
+
+    def event(self, event):
+        """Callback called when a Qt event is fired."""
+        if isinstance(event, JobEvent):
+            self._depth -= 1
+            self._jobs += 1
+            if self._depth <= self._queue_warning // 2:
+                self._warned = False
+            try:
+                result = event.future.result()
+            except Exception as e:
+                event.deferred.errback(e)
+            else:
+                event.deferred.callback(result)
+            event.accept()
+            return True
+        return super(WorkerPool, self).event(event)
+
+    def _report(self):
+        """Log the statistics of the pool since the last report."""
+        if not self._jobs and not self._depth:
+            return
+        with self._lock:
+            busy, self._busy = self._busy, 0.0
+        self._logger.info(
+            "Worker pool: %d jobs done in %.1fs, queue depth %d (max %d)"
+            % (self._jobs, busy, self._depth, self._max_depth)
+        )
+        self._jobs = 0
+        self._max_depth = self._depth
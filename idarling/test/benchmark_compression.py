@@ -0,0 +1,101 @@
+# Measure the compression ratio and throughput of the file codecs used for the
+# database transfers, on real IDB files:
+#
+#   python idarling/test/benchmark_compression.py file.i64 [file.idb ...]
+#
+# The data is streamed through the codecs in blocks, the same way it is done
+# during a transfer. Use --codec and --level to restrict the codecs/levels, and
+# --serial to compress using a single thread instead of all the cores.
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from idarling.shared.compression import (  # noqa: E402
+    file_codec_names,
+    get_file_codec,
+)
+
+BLOCK_SIZE = 1024 * 1024
+
+# The levels worth comparing for each codec, the default one first
+LEVELS = {
+    "none": [None],
+    "bz2": [9, 1],
+    "zlib": [6, 1, 9],
+    "lzma": [1, 0, 6],
+    "zstd": [3, 1, 9, 19],
+    "lz4": [0, 9],
+}
+
+
+def read_blocks(path):
+    with open(path, "rb") as input_file:
+        while True:
+            data = input_file.read(BLOCK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+def benchmark(path, codec, serial):
+    """Compress and decompress a file, returning the sizes and timings."""
+    compressed = []
+    start = time.perf_counter()
+    if serial:
+        compressor = codec.compressor()
+    else:
+        compressor = codec.parallel_compressor()
+    for data in read_blocks(path):
+        compressed.append(compressor.compress(data))
+    compressed.append(compressor.flush())
+    compress_time = time.perf_counter() - start
+
+    size = 0
+    start = time.perf_counter()
+    decompressor = codec.stream_decompressor()
+    for data in compressed:
+        size += len(decompressor.decompress(data))
+    decompress_time = time.perf_counter() - start
+    assert decompressor.eof and size == os.path.getsize(path)
+    return sum(len(data) for data in compressed), compress_time, decompress_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="the IDB files to compress")
+    parser.add_argument("--codec", action="append", help="codec to benchmark")
+    parser.add_argument("--level", type=int, help="level to benchmark")
+    parser.add_argument("--serial", action="store_true", help="use one thread")
+    args = parser.parse_args()
+
+    codecs = args.codec or file_codec_names()
+    print(
+        "%-24s %-6s %5s %12s %8s %10s %10s"
+        % ("file", "codec", "level", "compressed", "ratio", "comp MB/s", "dec MB/s")
+    )
+    for path in args.files:
+        size = os.path.getsize(path)
+        for name in codecs:
+            levels = LEVELS[name] if args.level is None else [args.level]
+            for level in levels:
+                codec = get_file_codec(name, level)
+                compressed, ctime, dtime = benchmark(path, codec, args.serial)
+                print(
+                    "%-24s %-6s %5s %12d %8.2f %10.1f %10.1f"
+                    % (
+                        os.path.basename(path)[-24:],
+                        name,
+                        codec.level,
+                        compressed,
+                        float(size) / max(compressed, 1),
+                        size / 1e6 / max(ctime, 1e-9),
+                        size / 1e6 / max(dtime, 1e-9),
+                    )
+                )
+                sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# Measure the size of the server database and the time taken to read back the
+# events of a snapshot: with the events keyed by names as in the previous
+# versions, keyed by snapshot id, and with their payloads compressed:
+#
+#   python idarling/test/benchmark_storage.py [--events N] [--snapshots N]
+#
+# The events are generated, or copied from the events table of an existing
+# server database with --database, and stored the way the server relays them.
+# Use --codec msgpack to store them the way the clients using MessagePack send
+# them. A database with the schema of the previous versions is filled first,
+# then converted the same way the server migrates it, and compressed the same
+# way idarling_compact.py does.
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", ".."))
+from idarling.shared.codecs import (  # noqa: E402
+    JsonCodec,
+    load_portable,
+    MsgPackCodec,
+)
+from idarling.shared.packets import DefaultEvent  # noqa: E402
+from idarling.shared.storage import Storage, train_dictionary  # noqa: E402
+
+# The tables of the snapshots and events before they were normalized
+OLD_SCHEMA = """
+create table snapshots (
+    project text not null, binary text not null, name text not null,
+    date text not null, primary key(project, binary, name));
+create table events (
+    project text not null, binary text not null, snapshot text not null,
+    tick integer not null, dict text not null,
+    primary key(project, binary, snapshot, tick));
+"""
+
+# The way the events were read before they were normalized
+OLD_SELECT_EVENTS = (
+    "select * from events where project = ? and binary = ? and snapshot = ? "
+    "and tick > ? order by tick asc;"
+)
+
+
+def generate_events(count):
+    """Generate the content of events looking like the ones of the plugin."""
+    random.seed(0)
+    events = []
+    for _ in range(count):
+        ea = random.randrange(0x140001000, 0x140800000)
+        kind = random.random()
+        if kind < 0.5:
+            suffix = random.choice(["init", "parse"])
+            dct = {
+                "event_type": "RenamedEvent",
+                "ea": ea,
+                "new_name": "sub_%X_%s" % (ea, suffix),
+                "local_name": False,
+            }
+        elif kind < 0.8:
+            dct = {
+                "event_type": "CmtChangedEvent",
+                "ea": ea,
+                "comment": "checks the %s of the %s"
+                % (
+                    random.choice(["size", "flags"]),
+                    random.choice(["header", "packet"]),
+                ),
+                "rptble": False,
+            }
+        else:
+            dct = {
+                "event_type": "UserLvarSettingsEvent",
+                "ea": ea,
+                "lvar_settings": {
+                    "lvvec": [
+                        {"name": "v%d" % i, "type": "int"} for i in range(3)
+                    ]
+                },
+            }
+        events.append(dct)
+    return events
+
+
+def load_events(path, count):
+    """Copy the content of the events of an existing server database."""
+    conn = sqlite3.connect(path)
+    rows = conn.execute("select dict from events limit ?;", [count]).fetchall()
+    conn.close()
+    storage = Storage(path)
+    return [load_portable(storage.unpack_payload(row[0])) for row in rows]
+
+
+def relayed(dct, tick, codec):
+    """Get the payload of an event as stored by the server relaying it."""
+    dct = dict(dct)
+    event = {
+        "type": "event",
+        "event_type": dct.pop("event_type"),
+        "tick": tick,
+    }
+    event.update((key, val) for key, val in dct.items() if key not in event)
+    if codec == "msgpack":
+        return MsgPackCodec().encode(event)
+    return JsonCodec.dumps(event)
+
+
+def fill_old(path, events, snapshots, codec):
+    """Fill a database with the schema used before the normalization."""
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    names = []
+    for i in range(snapshots):
+        name = (
+            "malware_family",
+            "ntoskrnl.exe",
+            "ntoskrnl.exe_2020_05_%02d" % i,
+        )
+        conn.execute(
+            "insert into snapshots values (?, ?, ?, ?);", name + ("now",)
+        )
+        names.append(name)
+    rows = []
+    for i, dct in enumerate(events):
+        name, tick = names[i % snapshots], i // snapshots + 1
+        rows.append(name + (tick, relayed(dct, tick, codec)))
+    conn.executemany("insert into events values (?, ?, ?, ?, ?);", rows)
+    conn.commit()
+    conn.execute("vacuum;")
+    conn.close()
+    return names
+
+
+def old_select_events(conn, project, binary, snapshot, tick):
+    events = []
+    for result in conn.execute(
+        OLD_SELECT_EVENTS, [project, binary, snapshot, tick]
+    ):
+        dct = load_portable(result["dict"])
+        dct["tick"] = result["tick"]
+        events.append(DefaultEvent.new(dct))
+    return events
+
+
+def timed(func, *args, repeat=5):
+    """Get the best time of a few calls, and the result of the last one."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def measure(label, path, select, name, last):
+    full, events = timed(select, *(name + (0,)))
+    tail, _ = timed(select, *(name + (last - 100,)))
+    print(
+        "%-8s %12d %10d %14.2f %12.0f %14.3f"
+        % (
+            label,
+            os.path.getsize(path),
+            len(events),
+            full * 1e3,
+            len(events) / full,
+            tail * 1e3,
+        )
+    )
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--events", type=int, default=200000, help="event count"
+    )
+    parser.add_argument(
+        "--snapshots", type=int, default=20, help="snapshot count"
+    )
+    parser.add_argument(
+        "--database", help="server database to copy events from"
+    )
+    parser.add_argument("--codec", choices=["json", "msgpack"], default="json")
+    args = parser.parse_args()
+
+    if args.database:
+        events = load_events(args.database, args.events)
+    else:
+        events = generate_events(args.events)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        old_path = os.path.join(tmpdir, "old.db")
+        names = fill_old(old_path, events, args.snapshots, args.codec)
+        new_path = os.path.join(tmpdir, "new.db")
+        shutil.copyfile(old_path, new_path)
+        start = time.perf_counter()
+        Storage(new_path).normalize()
+        elapsed = time.perf_counter() - start
+        print("converted %d events in %.2fs" % (len(events), elapsed))
+        packed_path = os.path.join(tmpdir, "packed.db")
+        shutil.copyfile(new_path, packed_path)
+        start = time.perf_counter()
+        storage = Storage(packed_path)
+        storage.initialize()
+        samples = storage.sample_payloads(Storage.DICTIONARY_SAMPLES * 4)
+        storage.insert_dictionary(train_dictionary(samples))
+        storage.compress_events()
+        storage.vacuum()
+        elapsed = time.perf_counter() - start
+        print("compressed %d events in %.2fs" % (len(events), elapsed))
+
+        name, last = names[0], len(events) // args.snapshots
+        print(
+            "%-8s %12s %10s %14s %12s %14s"
+            % (
+                "schema",
+                "size",
+                "events",
+                "full read ms",
+                "events/s",
+                "last 100 ms",
+            )
+        )
+        conn = sqlite3.connect(old_path)
+        conn.row_factory = sqlite3.Row
+        measure(
+            "names",
+            old_path,
+            lambda *a: old_select_events(conn, *a),
+            name,
+            last,
+        )
+        conn.close()
+        storage = Storage(new_path)
+        measure("id", new_path, storage.select_events, name, last)
+        storage = Storage(packed_path)
+        measure("packed", packed_path, storage.select_events, name, last)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
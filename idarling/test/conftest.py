@@ -0,0 +1,2 @@
+# The other scripts of this directory are run from inside IDA
+collect_ignore = ["test_hook.py"]
@@ -0,0 +1,108 @@
+import hashlib
+import random
+
+import pytest
+
+from idarling.shared.chunks import (
+    chunk_stream,
+    CHUNK_MAX,
+    CHUNK_MIN,
+    ENTRY,
+    read_manifest,
+)
+
+# Random data, with some padding like in the databases
+rand = random.Random(0)
+DATA = bytes(rand.getrandbits(8) for _ in range(1 << 20))
+DATA = DATA[:500000] + b"\x00" * 300000 + DATA[500000:]
+
+
+def split(data, block_size):
+    blocks = (
+        data[pos : pos + block_size]  # noqa: E203
+        for pos in range(0, len(data), block_size)
+    )
+    return list(chunk_stream(blocks))
+
+
+def test_chunk_sizes():
+    chunks = split(DATA, 65536)
+    assert b"".join(chunks) == DATA
+    assert all(len(chunk) <= CHUNK_MAX for chunk in chunks)
+    assert all(len(chunk) >= CHUNK_MIN for chunk in chunks[:-1])
+
+
+def test_chunks_dont_depend_on_blocks():
+    assert split(DATA, 4096) == split(DATA, 65536) == split(DATA, len(DATA))
+
+
+def test_chunks_are_stable():
+    # Inserting some data only changes the chunks around it
+    edited = DATA[:200000] + b"inserted" + DATA[200000:]
+    before, after = set(split(DATA, 65536)), set(split(edited, 65536))
+    assert len(before - after) <= 2
+    assert len(after - before) <= 2
+
+
+@pytest.fixture
+def store(tmp_path):
+    pytest.importorskip("PyQt5")
+    from idarling.shared.chunks import ChunkStore
+    from idarling.shared.models import Binary, Project, Snapshot
+    from idarling.shared.storage import Storage
+
+    storage = Storage(str(tmp_path / "database.db"))
+    storage.initialize()
+    storage.insert_project(Project("p", "date"))
+    storage.insert_binary(Binary("p", "b", "hash", "file", "type", "date"))
+    storage.insert_snapshot(Snapshot("p", "b", "s", "date"))
+    return ChunkStore(str(tmp_path / "chunks"), storage)
+
+
+def test_missing_chunks(store):
+    chunks = split(DATA, 65536)
+    manifest, sizes = store.write_chunks(chunks[1:])
+    store.add_chunks(sizes)
+
+    full_manifest = b"".join(
+        ENTRY.pack(hashlib.sha256(chunk).digest(), len(chunk))
+        for chunk in chunks
+    )
+    first = hashlib.sha256(chunks[0]).digest()
+    assert store.missing_chunks(full_manifest) == [first]
+    assert store.missing_chunks(manifest) == []
+
+    # Once stored, the file can be read back from its chunks
+    manifest, sizes = store.write_chunks(chunks[:1])
+    store.add_chunks(sizes)
+    assert store.missing_chunks(full_manifest) == []
+    store.commit_file("p", "b", "s", full_manifest)
+    reader, size, _ = store.open_file("p", "b", "s")
+    assert size == len(DATA)
+    assert reader.read(size) == DATA
+    entries = read_manifest(store.read_manifest("p", "b", "s"))
+    assert len(entries) == len(chunks)
+
+
+def test_store_and_delete_files(store):
+    chunks = split(DATA, 65536)
+    _, sizes = store.write_chunks(chunks[1:])
+    full_manifest = b"".join(
+        ENTRY.pack(hashlib.sha256(chunk).digest(), len(chunk))
+        for chunk in chunks
+    )
+    first = hashlib.sha256(chunks[0]).digest()
+    missing, unused = store.store_file("p", "b", "s", full_manifest, sizes)
+    assert missing == [first] and unused == []
+    assert store.file_digest("p", "b", "s") is None
+
+    _, sizes = store.write_chunks(chunks[:1])
+    missing, unused = store.store_file("p", "b", "s", full_manifest, sizes)
+    assert missing == [] and unused == []
+    digest = store.file_digest("p", "b", "s")
+    assert digest is not None
+
+    # The file isn't used by any snapshot once deleted
+    assert store.delete_files("p", "b") == [digest]
+    assert store.file_digest("p", "b", "s") is None
+    assert store.missing_chunks(full_manifest) != []
@@ -0,0 +1,68 @@
+import pytest
+
+from idarling.shared import codecs
+from idarling.shared.codecs import JsonCodec, load_portable, MsgPackCodec
+
+PACKET = {
+    "type": "event",
+    "event_type": "renamed",
+    "tick": 42,
+    "ea": 0x140001000,
+    "new_name": "sub_é",
+    "local_name": False,
+    "negative": -5,
+    "big": 1 << 40,
+    "ratio": 0.5,
+    "nothing": None,
+    "blob": b"\x00\xff\x80",
+    "list": [1, "two", [3]],
+    "nested": {"bytes": b"", "text": ""},
+}
+NAMES = ["event", "command", "renamed"]
+
+
+@pytest.fixture(params=[JsonCodec, MsgPackCodec])
+def codec(request):
+    return request.param(NAMES)
+
+
+@pytest.fixture(params=[True, False])
+def pure_python(request, monkeypatch):
+    """Also test the MessagePack implementation used without the module."""
+    if request.param:
+        monkeypatch.setattr(codecs, "msgpack", None)
+    elif codecs.msgpack is None:
+        pytest.skip("msgpack is not installed")
+    return request.param
+
+
+def test_round_trip(codec, pure_python):
+    data = codec.encode(PACKET)
+    assert isinstance(data, bytes)
+    assert codec.decode(data) == PACKET
+
+
+def test_decode_header(codec, pure_python):
+    data = codec.encode(PACKET)
+    assert codec.decode_header(data, 3) == {
+        "type": "event",
+        "event_type": "renamed",
+        "tick": 42,
+    }
+
+
+def test_json_header_with_escapes():
+    data = JsonCodec.dumps({"type": 'a"b', "tick": 1.5, "ea": 1}).encode()
+    assert JsonCodec().decode_header(data, 2) == {"type": 'a"b', "tick": 1.5}
+
+
+def test_names_are_compacted(pure_python):
+    data = MsgPackCodec(NAMES).encode(PACKET)
+    assert len(data) < len(MsgPackCodec().encode(PACKET))
+    # The names table is only known to the connection
+    portable = MsgPackCodec(NAMES).portable(data)
+    assert portable == MsgPackCodec().encode(PACKET)
+
+
+def test_portable(codec, pure_python):
+    assert load_portable(codec.portable(codec.encode(PACKET))) == PACKET
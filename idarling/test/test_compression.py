@@ -1,38 +1,66 @@
-# https://docs.python.org/3/library/bz2.html#examples-of-usage
-# https://www.programcreek.com/python/example/6089/bz2.BZ2Decompressor
+import pytest
 
-import bz2, hexdump
+from idarling.shared.compression import (
+    compression_names,
+    file_codec_names,
+    get_compression,
+    get_file_codec,
+)
 
-original_data = b'abc'*1000
+PACKETS = [
+    b'{"type": "event", "tick": %d, "name": "sub_%x"}' % (i, i)
+    for i in range(50)
+]
 
-def gen_data(data, chunk_size=1000):
-    """Yield incremental blocks of chunksize bytes."""
-    len_data = len(data)
-    total_count_sent = 0
-    for i in range(int(len_data/chunk_size)):
-        yield data[chunk_size*i: chunk_size*(i+1)]
-    if len_data % chunk_size != 0:
-        yield data[-(len_data%chunk_size):]
-    else:
-        yield b''
 
-comp = bz2.BZ2Compressor()
-out = b""
-for chunk in gen_data(original_data):
-    out = out + comp.compress(chunk)
+@pytest.fixture(
+    params=[name for name in compression_names() if name != "none"]
+)
+def compression(request):
+    return request.param
 
-# Finish the compression process.  Call this once you have
-# finished providing data to the compressor.
-out = out + comp.flush()
 
-hexdump.hexdump(out)
-print("-"*30)
+def test_stream_round_trip(compression):
+    sender = get_compression(compression)
+    receiver = get_compression(compression)
+    for packet in PACKETS + [b"", b"\x00" * 100000]:
+        data = sender.compress(packet)
+        # Each packet can be decompressed as soon as it is received
+        assert receiver.decompress(memoryview(data)) == packet
 
 
-decomp = bz2.BZ2Decompressor()
-data_decompressed = b''
-for chunk in gen_data(out):
-    data_decompressed += decomp.decompress(chunk)
+def test_stream_shares_context(compression):
+    sender = get_compression(compression)
+    first = len(sender.compress(PACKETS[0]))
+    assert len(sender.compress(PACKETS[0])) < first
 
-print(len(data_decompressed))
-hexdump.hexdump(data_decompressed[:100])
\ No newline at end of file
+
+def test_unknown_compression():
+    assert get_compression("none") is None
+
+
+@pytest.fixture(params=file_codec_names())
+def file_codec(request):
+    return get_file_codec(request.param)
+
+
+def test_parallel_round_trip(file_codec, monkeypatch):
+    # Use small blocks, so that the data spans several of them
+    monkeypatch.setattr(
+        "idarling.shared.compression.COMPRESSION_BLOCK_SIZE", 4096
+    )
+    data = b"".join(PACKETS) * 200
+    compressor = file_codec.parallel_compressor()
+    compressed = b"".join(
+        compressor.compress(data[pos : pos + 10000])  # noqa: E203
+        for pos in range(0, len(data), 10000)
+    )
+    compressed += compressor.flush()
+
+    decompressor = file_codec.stream_decompressor()
+    output = b"".join(
+        decompressor.decompress(compressed[pos : pos + 1000])  # noqa: E203
+        for pos in range(0, len(compressed), 1000)
+    )
+    assert output == data
+    assert decompressor.eof
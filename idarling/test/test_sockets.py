@@ -0,0 +1,171 @@
+import logging
+import socket
+
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from PyQt5.QtCore import QCoreApplication  # noqa: E402
+
+from idarling.shared.commands import (  # noqa: E402
+    UpdateLocation,
+    UploadChunks,
+)
+from idarling.shared.packets import DefaultEvent  # noqa: E402
+from idarling.shared.sockets import ClientSocket  # noqa: E402
+
+logger = logging.getLogger("idarling.test")
+
+
+class SampleEvent(DefaultEvent):
+    __event__ = "sample_event"
+
+    def __init__(self, ea, blob):
+        super(SampleEvent, self).__init__()
+        self.ea = ea
+        self.blob = blob
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.fixture
+def pair(app):
+    """Two sockets connected to each other, using the binary framing."""
+    sockets = []
+    for sock in socket.socketpair():
+        client = ClientSocket(logger)
+        client.wrap_socket(sock)
+        client._apply_features({"framing": "binary", "codec": "msgpack"}, [])
+        sockets.append(client)
+    yield sockets
+    for client in sockets:
+        client.disconnect()
+
+
+def encode(client, packet):
+    return b"".join(bytes(buf) for buf in client._encode_packet(packet))
+
+
+def receive(client, data, step=None):
+    """Feed the data to the socket, a few bytes at a time if a step is given."""
+    step = step or len(data)
+    for pos in range(0, len(data), step):
+        client._read_buffer += data[pos : pos + step]  # noqa: E203
+        client._read_packets()
+    packets = list(client._incoming)
+    client._incoming.clear()
+    return packets
+
+
+def test_frames_are_reassembled(pair):
+    sender, receiver = pair
+    event = SampleEvent(0x401000, b"\x00\xff")
+    event.tick = 7
+    data = encode(sender, event) + encode(sender, UpdateLocation("me", 42, 0))
+
+    packets = receive(receiver, data, step=3)
+    assert [type(packet) for packet in packets] == [
+        SampleEvent,
+        UpdateLocation,
+    ]
+    assert packets[0].tick == 7
+    assert packets[0].ea == 0x401000
+    assert packets[0].blob == b"\x00\xff"
+    assert packets[1].name == "me" and packets[1].ea == 42
+
+
+def test_incomplete_frame_is_kept(pair):
+    sender, receiver = pair
+    data = encode(sender, UpdateLocation("me", 42, 0))
+
+    assert receive(receiver, data[:-1]) == []
+    packets = receive(receiver, data[-1:])
+    assert len(packets) == 1 and packets[0].ea == 42
+
+
+def test_content_chunks_are_reassembled(pair):
+    sender, receiver = pair
+    query = UploadChunks.Query("p", "b", "s", [1], "none")
+    query.content = bytes(range(256)) * 2500
+    buffers = [bytes(buf) for buf in sender._encode_packet(query)]
+    assert len(buffers) > 4  # The header, then several chunks
+
+    # Other packets can be sent in-between the chunks
+    location = encode(sender, UpdateLocation("me", 42, 0))
+    data = b"".join(buffers[:4]) + location + b"".join(buffers[4:])
+    packets = receive(receiver, data, step=65536)
+    assert [type(packet) for packet in packets] == [
+        UpdateLocation,
+        UploadChunks.Query,
+    ]
+    assert packets[1].content == query.content
+    assert not receiver._read_streams
+
+
+def test_oversized_frame_disconnects(pair):
+    _, receiver = pair
+    header = ClientSocket.FRAME_HEADER.pack(
+        ClientSocket.MAX_FRAME_SIZE + 1, ClientSocket.FRAME_PACKET
+    )
+    assert receive(receiver, header) == []
+    assert receiver._socket is None
+
+
+def test_chunked_files_are_negotiated(pair):
+    client, server = pair
+    features = server._negotiate(client._handshake_features())
+    assert features["files"] == "chunked"
+    server._apply_features(features, [])
+    assert server.chunked_files
+
+    # The older clients don't offer it, nor anything else
+    server._apply_features(server._negotiate({}), [])
+    assert not server.chunked_files
+
+
+def test_delta_is_negotiated(pair):
+    client, server = pair
+    server._apply_features(server._negotiate(client._handshake_features()), [])
+    assert server.delta
+    server._apply_features(server._negotiate({}), [])
+    assert not server.delta
+
+
+def test_legacy_framing_falls_back(pair):
+    client, server = pair
+    # The client fell back to the defaults before the handshake reply
+    client._apply_features({}, [])
+    packets = receive(server, encode(client, UpdateLocation("user", 1, 0)))
+    assert not server.framed
+    assert [packet.ea for packet in packets] == [1]
+
+
+def test_frames_are_skipped_by_legacy_framing(pair):
+    client, server = pair
+    data = encode(server, UpdateLocation("user", 1, 0))
+    client._apply_features({}, [])
+    server._apply_features({}, [])
+    data += encode(server, UpdateLocation("user", 2, 0))
+    packets = receive(client, data, step=3)
+    assert [packet.ea for packet in packets] == [2]
+
+
+def test_waiting_queries_fail_on_disconnect(pair):
+    client, _ = pair
+    client._connected = True
+    client.set_query_limits(client.QUERY_TIMEOUT, 1)
+    errors = []
+    for _ in range(3):
+        query = UploadChunks.Query("p", "b", "s", [], "none")
+        query.content = b""
+        client.send_packet(query).add_errback(errors.append)
+
+    # The waiting queries must not be sent on the closed socket
+    sent = []
+    client._send_query = sent.append
+    client.disconnect()
+    assert len(errors) == 3
+    assert not sent
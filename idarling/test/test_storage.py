@@ -0,0 +1,130 @@
+import logging
+import sqlite3
+import types
+
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from idarling.shared.codecs import (  # noqa: E402
+    JsonCodec,
+    load_portable,
+    MsgPackCodec,
+)
+from idarling.shared.server import Migrate  # noqa: E402
+from idarling.shared.storage import Storage, train_dictionary  # noqa: E402
+
+# The tables of the snapshots and events before they were normalized
+OLD_SCHEMA = """
+create table snapshots (
+    project text not null, binary text not null, name text not null,
+    date text not null, primary key(project, binary, name));
+create table events (
+    project text not null, binary text not null, snapshot text not null,
+    tick integer not null, dict text not null,
+    primary key(project, binary, snapshot, tick));
+"""
+
+
+def payload(tick):
+    return JsonCodec.dumps(
+        {
+            "type": "event",
+            "event_type": "sample_event",
+            "tick": tick,
+            "ea": tick,
+        }
+    )
+
+
+@pytest.fixture
+def old_database(tmp_path):
+    path = str(tmp_path / "database.db")
+    conn = sqlite3.connect(path)
+    conn.executescript(OLD_SCHEMA)
+    for name in ("s1", "s2"):
+        conn.execute(
+            "insert into snapshots values ('p', 'b', ?, 'date');", [name]
+        )
+    rows = [
+        ("p", "b", name, tick, payload(tick))
+        for name in ("s1", "s2")
+        for tick in (1, 2, 3)
+    ]
+    # The events of a snapshot that was deleted
+    rows.append(("p", "b", "deleted", 1, payload(1)))
+    conn.executemany("insert into events values (?, ?, ?, ?, ?);", rows)
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_normalize(old_database):
+    storage = Storage(old_database)
+    assert storage.normalize() == 6
+    assert storage.normalize() is None
+    storage.initialize()
+
+    events = storage.select_events("p", "b", "s2", 1)
+    assert [event.tick for event in events] == [2, 3]
+    assert [load_portable(event.payload)["ea"] for event in events] == [2, 3]
+    assert storage.last_ticks("p", "b") == {"s1": 3, "s2": 3}
+    assert storage.select_events("p", "b", "deleted", 0) == []
+
+
+def test_migrate(old_database):
+    server = types.SimpleNamespace(
+        _logger=logging.getLogger("idarling.test"),
+        server_file=lambda name: old_database,
+    )
+    Migrate.do2(server)
+    assert Storage(old_database).last_tick("p", "b", "s1") == 3
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = Storage(str(tmp_path / "database.db"))
+    storage.initialize()
+    return storage
+
+
+@pytest.fixture(params=["json", "msgpack"])
+def payloads(request):
+    dumps = {"json": JsonCodec.dumps, "msgpack": MsgPackCodec().encode}
+    return [
+        dumps[request.param](
+            {
+                "type": "event",
+                "event_type": "renamed",
+                "tick": tick,
+                "ea": 0x140001000 + tick,
+                "new_name": "sub_%x" % tick,
+            }
+        )
+        for tick in range(100)
+    ]
+
+
+def test_pack_payload(storage, payloads):
+    for payload in payloads:
+        packed = storage.pack_payload(payload)
+        assert storage.unpack_payload(packed) == payload
+
+
+def test_pack_payload_with_dictionary(storage, payloads, tmp_path):
+    plain = [storage.pack_payload(payload) for payload in payloads]
+    storage.insert_dictionary(train_dictionary(payloads))
+    packed = [storage.pack_payload(payload) for payload in payloads]
+    assert sum(map(len, packed)) < sum(map(len, plain))
+    # The payloads packed before the dictionary can still be read
+    assert [storage.unpack_payload(data) for data in plain] == payloads
+    assert [storage.unpack_payload(data) for data in packed] == payloads
+
+    # The dictionary is loaded by the other connections
+    other = Storage(str(tmp_path / "database.db"))
+    assert [other.unpack_payload(data) for data in packed] == payloads
+
+
+def test_small_payload_is_kept(storage):
+    assert storage.pack_payload("{}") == "{}"
+    assert storage.unpack_payload("{}") == "{}"
@@ -0,0 +1,71 @@
+import os
+
+import pytest
+
+from idarling.shared.compression import get_file_codec
+from idarling.shared.transfers import (
+    checksum,
+    is_transfer_id,
+    new_transfer_id,
+    Spool,
+)
+
+
+def compress(data, codec):
+    compressor = codec.compressor()
+    return compressor.compress(data) + compressor.flush()
+
+
+def test_spool_write(tmp_path):
+    spool = Spool(str(tmp_path / "file.part"))
+    assert spool.offset == 0
+    assert spool.write(0, b"abc", checksum(b"abc"))
+    assert spool.offset == 3
+    # The chunks must be the next one, and not corrupted
+    assert not spool.write(0, b"abc", checksum(b"abc"))
+    assert not spool.write(6, b"ghi", checksum(b"ghi"))
+    assert not spool.write(3, b"def", checksum(b"xyz"))
+    assert spool.offset == 3
+    assert spool.write(3, b"def", checksum(b"def"))
+    assert spool.offset == 6
+
+
+def test_spool_resumes(tmp_path):
+    path = str(tmp_path / "file.part")
+    Spool(path).write(0, b"abc", checksum(b"abc"))
+    assert Spool(path).offset == 3
+
+
+def test_spool_extract(tmp_path):
+    codec = get_file_codec("zlib")
+    data = os.urandom(100000) * 3
+    compressed = compress(data, codec)
+    spool = Spool(str(tmp_path / "file.part"))
+    for offset in range(0, len(compressed), 4096):
+        chunk = compressed[offset : offset + 4096]  # noqa: E203
+        assert spool.write(offset, chunk, checksum(chunk))
+
+    file_path = str(tmp_path / "file.idb")
+    spool.extract(file_path, codec)
+    with open(file_path, "rb") as input_file:
+        assert input_file.read() == data
+    assert spool.offset == 0
+
+
+def test_spool_truncated(tmp_path):
+    codec = get_file_codec("zlib")
+    compressed = compress(os.urandom(10000), codec)[:-10]
+    spool = Spool(str(tmp_path / "file.part"))
+    spool.write(0, compressed, checksum(compressed))
+
+    file_path = str(tmp_path / "file.idb")
+    with pytest.raises(IOError):
+        spool.extract(file_path, codec)
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(file_path + ".tmp")
+
+
+def test_transfer_id():
+    assert is_transfer_id(new_transfer_id())
+    assert not is_transfer_id("../../database.db")
+    assert not is_transfer_id(None)
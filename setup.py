@@ -12,6 +12,9 @@ setup(
     include_package_data=True,
     entry_points={
         "idapython_plugins": ["idarling=idarling.plugin:Plugin"],
-        "console_scripts": ["idarling_server=idarling.server:main"],
+        "console_scripts": [
+            "idarling_server=idarling.server:main",
+            "idarling_compact=idarling.compact:main",
+        ],
     },
 )